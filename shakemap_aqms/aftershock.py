@@ -3,15 +3,102 @@
 # System imports
 import os
 import os.path
-import logging
-from logging.handlers import TimedRotatingFileHandler
 import math
+import fcntl
+from contextlib import contextmanager
+from functools import wraps
 from datetime import datetime
 from time import time
 
 # Third-party imports
 import sqlite3
 
+# Local imports
+from shakemap_aqms.logs import get_async_logging
+
+
+def _in_transaction(method):
+    """Run a method of aftershockDB as one transaction.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._transaction():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class ZoneMirror(object):
+    """An in-memory copy of the triangles of the aftershock zones, with
+    the denominators of the point-in-triangle test already computed, so
+    that events can be checked without going to SQLite.
+
+    The arrays are replaced as a whole when the mirror is reloaded, so a
+    check that is in progress always sees one consistent set of zones.
+    """
+
+    COLUMNS = ('eruleid', 'emaglimit', 'eplacename',
+               'ev1y', 'ev1x', 'ev2y', 'ev2x', 'ev3y', 'ev3x')
+
+    def __init__(self):
+        self.version = None
+        self._zones = None
+
+    def load(self, cursor):
+        """Read the zones from the database.
+        """
+        import numpy as np
+
+        cursor.execute('SELECT %s FROM excludes ORDER BY eid;' %
+                       ', '.join(self.COLUMNS))
+        rows = cursor.fetchall()
+        zones = {}
+        for ix, name in enumerate(self.COLUMNS):
+            values = [row[ix] for row in rows]
+            if name == 'eplacename':
+                zones[name] = values
+            else:
+                zones[name] = np.array(values, dtype=float)
+        zones['denom'] = \
+            (zones['ev2x'] - zones['ev1x']) * (zones['ev3y'] - zones['ev1y']) - \
+            (zones['ev3x'] - zones['ev1x']) * (zones['ev2y'] - zones['ev1y'])
+        self._zones = zones
+
+    def __len__(self):
+        return 0 if self._zones is None else len(self._zones['eplacename'])
+
+    def find(self, lat, lon):
+        """Find the first zone (in the order the triangles were added)
+        that contains a point. The test is the one done by the SQL of
+        aftershockDB.checkAftershockZone(), term for term.
+
+        Returns:
+            tuple: (eruleid, emaglimit, eplacename), or None if the point
+            is not in any zone.
+        """
+        import numpy as np
+
+        z = self._zones
+        if z is None or len(z['eplacename']) == 0:
+            return None
+        x = lon
+        y = lat
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inside = \
+                ((((z['ev2x'] - x) * (z['ev3y'] - y)) -
+                  ((z['ev3x'] - x) * (z['ev2y'] - y))) / z['denom'] >= 0) & \
+                ((((z['ev3x'] - x) * (z['ev1y'] - y)) -
+                  ((z['ev1x'] - x) * (z['ev3y'] - y))) / z['denom'] >= 0) & \
+                ((((z['ev1x'] - x) * (z['ev2y'] - y)) -
+                  ((z['ev2x'] - x) * (z['ev1y'] - y))) / z['denom'] >= 0)
+        # SQLite gives NULL (not in the zone) for degenerate triangles
+        inside &= z['denom'] != 0
+        hits = np.flatnonzero(inside)
+        if len(hits) == 0:
+            return None
+        ix = hits[0]
+        return (int(z['eruleid'][ix]), float(z['emaglimit'][ix]),
+                z['eplacename'][ix])
+
 
 class aftershockDB(object):
     """Class to build or retrieve a database for aftershock suppression. 
@@ -19,15 +106,14 @@ class aftershockDB(object):
     """
     def __init__(self, ipath):
 
-        self.ASlogger = logging.getLogger('aftershock')
-        self.ASlogger.setLevel(logging.INFO)
-        self.ASlogger.propagate = False
+        # The log is written by a background thread so that a slow disk
+        # doesn't delay the handling of alarms
         self.logFile = os.path.join(ipath, 'logs', 'aftershock.log')
-        self.AShandler = TimedRotatingFileHandler(self.logFile,
-                                                  when="d",
-                                                  interval=1,
-                                                  backupCount=60)
-        self.ASlogger.addHandler(self.AShandler)
+        self.ASlogger = get_async_logging().add_file('aftershock',
+                                                     self.logFile,
+                                                     when="d",
+                                                     interval=1,
+                                                     backup_count=60)
         self.ASlogger.info('aftershock DB initiated')
 
         exclude_table = """ CREATE TABLE excludes (
@@ -49,13 +135,21 @@ class aftershockDB(object):
         self._connection = sqlite3.connect(self.db_file, timeout=15, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
         if self._connection is None:
             raise RuntimeError('Could not connect to %s' % self.db_file)
-        self._connection.isolation_level = 'EXCLUSIVE'
+        # Reads run in autocommit mode, so in WAL mode they never wait
+        # for (or hold up) a writer; the writes are explicit
+        # BEGIN IMMEDIATE transactions (see _transaction())
+        self._connection.isolation_level = None
         self._cursor = self._connection.cursor()
         self._cursor.execute('PRAGMA foreign_keys = ON')
         self._cursor.execute('PRAGMA journal_mode = WAL')
         if not db_exists:
             self._cursor.execute(exclude_table)
 
+        # The zones are checked against a copy in memory, which is
+        # reloaded when the file has been changed (by this process or
+        # by another one)
+        self._mirror = ZoneMirror()
+        self._depth = 0
 
 
     def __del__(self):
@@ -77,7 +171,61 @@ class aftershockDB(object):
         """
         self._connection.commit()
 
+    @contextmanager
+    def _transaction(self):
+        """Make the writes done in the block (and in any blocks nested in
+        it) a single BEGIN IMMEDIATE transaction. The mirror is marked
+        out of date only if the transaction changed any rows.
+        """
+        self._depth += 1
+        if self._depth == 1:
+            changes = self._connection.total_changes
+            self._cursor.execute('BEGIN IMMEDIATE;')
+        try:
+            yield
+            if self._depth == 1:
+                self._cursor.execute('COMMIT;')
+        except Exception:
+            if self._depth == 1:
+                self._cursor.execute('ROLLBACK;')
+            raise
+        finally:
+            self._depth -= 1
+            if self._depth == 0 and \
+                    self._connection.total_changes != changes:
+                self._mirror.version = None
+
+    def _refresh_mirror(self):
+        """Reload the mirror if the database has changed since it was
+        loaded. PRAGMA data_version changes when another connection
+        commits; the mirror is marked out of date after our own writes.
+        """
+        self._cursor.execute('PRAGMA data_version;')
+        version = self._cursor.fetchone()[0]
+        if self._mirror.version != version:
+            self._mirror.load(self._cursor)
+            self._mirror.version = version
+            self.ASlogger.debug('Loaded %d aftershock zone triangles',
+                                len(self._mirror))
+
+    @contextmanager
+    def lock(self):
+        """Hold an exclusive lock while a zone is defined, so that two
+        processes can't both define zones for events that overlap (the
+        definition checks the zones again, with a query, under the
+        lock). The lock is an flock on a file beside the database, so it
+        is respected by every process on the host that uses this class;
+        checks against the mirror don't take it.
+        """
+        with open(self.db_file + '.lock', 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
 
+    @_in_transaction
     def insertAftershockZone(self, valuesDict):
         """Construct and insert a new aftershock exclusion zone into the database
         --source of the values--
@@ -109,7 +257,7 @@ class aftershockDB(object):
         for row in rows:
             if row[0] is not None:
                 self.eruleID = row[0] + 1;
-            self.ASlogger.info('Assigning eruleid %i to event %s' % (self.eruleID, self.eventID))
+            self.ASlogger.info('Assigning eruleid %i to event %s', self.eruleID, self.eventID)
 
         gmdate = datetime.now().strftime("%d-%b-%Y %H:%M:%S")
     #
@@ -125,7 +273,7 @@ class aftershockDB(object):
     #
     # Multiply by 2 for two rupture lengths
         ruptureLength = ruptureLength * 2
-        self.ASlogger.info("Length is %f km" % ruptureLength)
+        self.ASlogger.debug("Length is %f km", ruptureLength)
 
         radToDeg = 57.295779
         earthradius = 6371            # earthradius in km
@@ -143,27 +291,27 @@ class aftershockDB(object):
         northlat = self.lat + latdiff
         southlat = self.lat - latdiff
 
-        self.ASlogger.info("Zone runs from %3.3f to %3.3f" % (eastlon,westlon))
-        self.ASlogger.info("Lat goes from %3.3f to %3.3f" % (northlat,southlat))
+        self.ASlogger.info("Zone runs from %3.3f to %3.3f", eastlon, westlon)
+        self.ASlogger.info("Lat goes from %3.3f to %3.3f", northlat, southlat)
 
-        self.ASlogger.info("Proposed points are: ")
-        self.ASlogger.info("%3.3f/%3.3f" % (self.lat,westlon))
-        self.ASlogger.info("%3.3f/%3.3f" % (northlat,westlon2))
-        self.ASlogger.info("%3.3f/%3.3f" % (northlat,eastlon2))
-        self.ASlogger.info("%3.3f/%3.3f" % (self.lat,eastlon))
-        self.ASlogger.info("%3.3f/%3.3f" % (southlat,eastlon2))
-        self.ASlogger.info("%3.3f/%3.3f" % (southlat,westlon2))
+        self.ASlogger.debug("Proposed points are: ")
+        self.ASlogger.debug("%3.3f/%3.3f", self.lat, westlon)
+        self.ASlogger.debug("%3.3f/%3.3f", northlat, westlon2)
+        self.ASlogger.debug("%3.3f/%3.3f", northlat, eastlon2)
+        self.ASlogger.debug("%3.3f/%3.3f", self.lat, eastlon)
+        self.ASlogger.debug("%3.3f/%3.3f", southlat, eastlon2)
+        self.ASlogger.debug("%3.3f/%3.3f", southlat, westlon2)
 
 
-        self.ASlogger.info("Triangles are:  ")
-        self.ASlogger.info("%3.3f/%3.3f, %3.3f/%3.3f, %3.3f/%3.3f" % (self.lat, westlon,
-          northlat, westlon2, northlat, eastlon2))
-        self.ASlogger.info("%3.3f/%3.3f, %3.3f/%3.3f, %3.3f/%3.3f" % (self.lat, westlon,
-          northlat, eastlon2, southlat, westlon2))
-        self.ASlogger.info("%3.3f/%3.3f, %3.3f/%3.3f, %3.3f/%3.3f" % (northlat,
-          eastlon2, self.lat, eastlon, southlat, westlon2))
-        self.ASlogger.info("%3.3f/%3.3f, %3.3f/%3.3f, %3.3f/%3.3f" % (self.lat, eastlon,
-          southlat, eastlon2, southlat, westlon2))
+        self.ASlogger.debug("Triangles are:  ")
+        self.ASlogger.debug("%3.3f/%3.3f, %3.3f/%3.3f, %3.3f/%3.3f", self.lat, westlon,
+          northlat, westlon2, northlat, eastlon2)
+        self.ASlogger.debug("%3.3f/%3.3f, %3.3f/%3.3f, %3.3f/%3.3f", self.lat, westlon,
+          northlat, eastlon2, southlat, westlon2)
+        self.ASlogger.debug("%3.3f/%3.3f, %3.3f/%3.3f, %3.3f/%3.3f", northlat,
+          eastlon2, self.lat, eastlon, southlat, westlon2)
+        self.ASlogger.debug("%3.3f/%3.3f, %3.3f/%3.3f, %3.3f/%3.3f", self.lat, eastlon,
+          southlat, eastlon2, southlat, westlon2)
 
         triangleDict = {0: [self.lat, westlon, northlat, westlon2, northlat, eastlon2],
                         1: [self.lat, westlon, northlat, eastlon2, southlat, westlon2],
@@ -171,7 +319,7 @@ class aftershockDB(object):
                         3: [self.lat, eastlon, southlat, eastlon2, southlat, westlon2]}
 
         self.DBemaglimit = self.mag - self.emaglimit;
-        self.ASlogger.info("Magnitude level is %3.1f" % self.DBemaglimit)
+        self.ASlogger.info("Magnitude level is %3.1f", self.DBemaglimit)
 
 
         for key, value in triangleDict.items():
@@ -179,18 +327,17 @@ class aftershockDB(object):
             insertQuery = """INSERT INTO excludes (eruleid,ev1y,ev1x,ev2y,ev2x,ev3y,ev3x,emaglimit,eplacename,added)
                              VALUES ('%d','%4.2f','%4.2f','%4.2f','%4.2f','%4.2f','%4.2f','%3.1f','%s','%s');
                           """ % (self.eruleID, value[0], value[1], value[2], value[3], value[4], value[5], self.DBemaglimit, self.eventID, gmdate)
-            self.ASlogger.info("SQL is " + insertQuery)
+            self.ASlogger.debug("SQL is %s", insertQuery)
             self._cursor.execute(insertQuery)
-            self.commit()
-        
+
             datelineTriangle = triangleDict.get(0)
 
             if (datelineTriangle[1] > 180) or (datelineTriangle[3] > 180) or (datelineTriangle[5] > 180):
-                self.ASlogger.info("This triangle crosses the Date Line at 180")
+                self.ASlogger.debug("This triangle crosses the Date Line at 180")
                 datelineflag = 1
 
             if (datelineTriangle[1] < -180) or (datelineTriangle[3] < -180) or (datelineTriangle[5] < -180):
-                self.ASlogger.info("This triangle crosses the Date Line at -180")
+                self.ASlogger.debug("This triangle crosses the Date Line at -180")
                 datelineflag = -1
 
             if datelineflag != 0:
@@ -200,14 +347,43 @@ class aftershockDB(object):
                 insertQuery = """INSERT INTO excludes (eruleid,ev1y,ev1x,ev2y,ev2x,ev3y,ev3x,emaglimit,eplacename,added)
                                  VALUES ('%d','%4.2f','%4.2f','%4.2f','%4.2f','%4.2f','%4.2f','%3.1f','%s','%s');
                               """ % (self.eruleID, value[0], value[1], value[2], value[3], value[4], value[5], self.DBemaglimit, self.eventID, gmdate)
-                self.ASlogger.info("SQL is " + insertQuery)
+                self.ASlogger.debug("SQL is %s", insertQuery)
                 self._cursor.execute(insertQuery)
-                self.commit()
 
         return True
 
 
-    def checkAftershockZone(self, valuesDict):
+    def _query_zone(self):
+        """Find the aftershock zone containing self.lat/self.lon with a
+        query.
+        """
+        self.sql = """SELECT DISTINCT eruleid,emaglimit,eplacename,(((((ev2x-(%s))*(ev3y-(%s))) - ((ev3x-(%s))*(ev2y-(%s))))/(((ev2x-ev1x)*(ev3y-ev1y)) - ((ev3x-ev1x)*(ev2y-ev1y))))>=0 AND ((((ev3x-(%s))*(ev1y-(%s))) - ((ev1x-(%s))*(ev3y-(%s))))/(((ev2x-ev1x)*(ev3y-ev1y)) - ((ev3x-ev1x)*(ev2y-ev1y))))>=0 AND ((((ev1x-(%s))*(ev2y-(%s))) - ((ev2x-(%s))*(ev1y-(%s))))/(((ev2x-ev1x)*(ev3y-ev1y)) - ((ev3x-ev1x)*(ev2y-ev1y))))>=0) as exclude from excludes;
+                   """ % (self.lon, self.lat, self.lon, self.lat, self.lon, self.lat, self.lon, self.lat, self.lon, self.lat, self.lon, self.lat)
+        self.ASlogger.debug("SQL is %s", self.sql)
+        self._cursor.execute(self.sql)
+        self.rows = self._cursor.fetchall()
+        for row in self.rows:
+            self.exclude = row[3]
+            if self.exclude == 1:
+                self.olderuleid = row[0]
+                self.DBemaglimit = row[1]
+                self.excludename = row[2]
+                self.excluderegion = 1
+                break
+
+    def checkAftershockZone(self, valuesDict, mirror=True):
+        """Check whether an event is in an aftershock zone.
+
+        Args:
+            valuesDict (dict): The event's "lat", "lon", "mag", "eventID",
+                and "emaglimit".
+            mirror (bool): Check against the copy of the zones in memory
+                (reloaded first if the database has changed), rather than
+                with a query.
+
+        Returns:
+            tuple: (excluderegion, excludename, olderuleid, oldmag).
+        """
 
         self.lat = valuesDict.get("lat")
         self.lon = valuesDict.get("lon")
@@ -224,23 +400,18 @@ class aftershockDB(object):
         # 2 = in an exclude region, and it's larger than the exclude level
         # 3 = in an exclude region, and it's larger than the previous mainshock
 
-        self.ASlogger.info("Checking to see if the event is in an already defined exclude region")
-        self.sql = """SELECT DISTINCT eruleid,emaglimit,eplacename,(((((ev2x-(%s))*(ev3y-(%s))) - ((ev3x-(%s))*(ev2y-(%s))))/(((ev2x-ev1x)*(ev3y-ev1y)) - ((ev3x-ev1x)*(ev2y-ev1y))))>=0 AND ((((ev3x-(%s))*(ev1y-(%s))) - ((ev1x-(%s))*(ev3y-(%s))))/(((ev2x-ev1x)*(ev3y-ev1y)) - ((ev3x-ev1x)*(ev2y-ev1y))))>=0 AND ((((ev1x-(%s))*(ev2y-(%s))) - ((ev2x-(%s))*(ev1y-(%s))))/(((ev2x-ev1x)*(ev3y-ev1y)) - ((ev3x-ev1x)*(ev2y-ev1y))))>=0) as exclude from excludes;
-                   """ % (self.lon, self.lat, self.lon, self.lat, self.lon, self.lat, self.lon, self.lat, self.lon, self.lat, self.lon, self.lat)
-        self.ASlogger.info("SQL is %s" % self.sql)
-        self._cursor.execute(self.sql)
-        self.rows = self._cursor.fetchall()
-        for row in self.rows:
-            self.exclude = row[3]
-            if self.exclude == 1:
-                self.olderuleid = row[0]
-                self.DBemaglimit = row[1]
-                self.excludename = row[2]
+        self.ASlogger.debug("Checking to see if the event is in an already defined exclude region")
+        if mirror:
+            self._refresh_mirror()
+            zone = self._mirror.find(self.lat, self.lon)
+            if zone is not None:
+                self.olderuleid, self.DBemaglimit, self.excludename = zone
                 self.excluderegion = 1
-                break
+        else:
+            self._query_zone()
 
         if self.excluderegion > 0:
-            self.ASlogger.info("This event falls inside an exclude region eruleid %d M%3.1f for event %s" % (self.olderuleid, self.DBemaglimit, self.excludename))
+            self.ASlogger.info("This event falls inside an exclude region eruleid %d M%3.1f for event %s", self.olderuleid, self.DBemaglimit, self.excludename)
             if self.mag > self.DBemaglimit:
                 self.excluderegion = 2
             self.oldmag = self.DBemaglimit + self.emaglimit
@@ -252,6 +423,7 @@ class aftershockDB(object):
 
 
 
+    @_in_transaction
     def defineAftershockZone(self, valuesDict):
         self.lat = valuesDict.get("lat")
         self.lon = valuesDict.get("lon")
@@ -262,9 +434,9 @@ class aftershockDB(object):
         self.eruleID = None
 
         self.gmdate = datetime.now().strftime("%d-%b-%Y %H:%M:%S")
-        self.ASlogger.info("Defining aftershock zone for event %s" % self.eplacename)
-        self.ASlogger.info("Now it is %s" % self.gmdate)
-        self.ASlogger.info("Event has location %s/%s. Magnitude is %s" % (self.lat, self.lon, self.mag))
+        self.ASlogger.info("Defining aftershock zone for event %s", self.eplacename)
+        self.ASlogger.debug("Now it is %s", self.gmdate)
+        self.ASlogger.info("Event has location %s/%s. Magnitude is %s", self.lat, self.lon, self.mag)
 
         try:
             self.sql = "SELECT eruleid,added from excludes where eplacename='%s' LIMIT 1;" % self.eplacename
@@ -274,39 +446,39 @@ class aftershockDB(object):
                 if row[0] is not None:
                     self.eruleID = row[0]
                     self.gmdate  = row[1]
-                    self.ASlogger.info('Event %s has eruleID %s' % (self.eplacename, self.eruleID))
+                    self.ASlogger.info('Event %s has eruleID %s', self.eplacename, self.eruleID)
 
             if self.eruleID is not None:
                 # There is already a region for this event, but we need to update it.
                 self.ASlogger.info("There is already a defined exclude region for this event. Delete it and re-make it with the new event parameters")
                 self.sql = "DELETE FROM excludes where eruleid=%s;" % self.eruleID
-                self.ASlogger.info("SQL is %s" % self.sql)
+                self.ASlogger.debug("SQL is %s", self.sql)
                 self._cursor.execute(self.sql)
-                self.commit()
 
         except Exception as e:
             self.ASlogger.error("Aftershock DB query failed")
             self.ASlogger.error(e)
-        zoneTuple = self.checkAftershockZone(valuesDict)
+        # The zone deleted above is still in the mirror, so ask the
+        # database (which sees the delete) rather than the mirror
+        zoneTuple = self.checkAftershockZone(valuesDict, mirror=False)
         self.excluderegion = zoneTuple[0]
         self.excludename = zoneTuple[1]
         self.olderuleID = zoneTuple[2]
         self.oldmag = zoneTuple[3]
 
-        self.ASlogger.info("Values returned are: %d, %s, %d, %f" % (self.excluderegion, self.excludename, self.olderuleID, self.oldmag))
+        self.ASlogger.debug("Values returned are: %d, %s, %d, %f", self.excluderegion, self.excludename, self.olderuleID, self.oldmag)
 
         if self.excluderegion == 0:
             self.ASlogger.info("This event does not fall in a previously defined exclude region")
 
         if self.excluderegion == 3:
-            self.ASlogger.info("This event falls in the exclude region for event %s" % self.excludename)
-            self.ASlogger.info("This event is larger than event %s, so it supersedes it" % self.excludename)
-            self.ASlogger.info("This event is M%3.1f and is larger than M%3.1f for the old event. Create a new region for this event and delete the old one." % (self.mag, self.oldmag))
+            self.ASlogger.info("This event falls in the exclude region for event %s", self.excludename)
+            self.ASlogger.info("This event is larger than event %s, so it supersedes it", self.excludename)
+            self.ASlogger.info("This event is M%3.1f and is larger than M%3.1f for the old event. Create a new region for this event and delete the old one.", self.mag, self.oldmag)
 
             self.sql = "DELETE FROM excludes where eruleid=%s;" % self.olderuleID
-            self.ASlogger.info("SQL is %s" % self.sql)
+            self.ASlogger.debug("SQL is %s", self.sql)
             self._cursor.execute(self.sql)
-            self.commit()
 
 
         # For excluderegion == 1||2, don't do anything, since this event is
@@ -321,6 +493,7 @@ class aftershockDB(object):
 
 
 
+    @_in_transaction
     def cleanupAftershockZones(self, emaglimit):
         """This cleans up any aftershock exclusion zones that have passed their expiration date.
            The number of days for an aftershock zone to be kept is calculated as 14.5*(($oldmag - 5.24)**2) + 10. 
@@ -343,25 +516,24 @@ class aftershockDB(object):
                 self.eplacename = row[1]
                 self.DBemaglimit = row[2]
                 self.gmdate = row[3]
-            self.ASlogger.info('Event eruleid %d (%s) has mag limit %3.1f. It was added on %s' % (self.eruleID, self.eplacename, self.DBemaglimit, self.gmdate))
+            self.ASlogger.debug('Event eruleid %d (%s) has mag limit %3.1f. It was added on %s', self.eruleID, self.eplacename, self.DBemaglimit, self.gmdate)
             oldmag = emaglimit + self.DBemaglimit
 
             timelimit = 14.5*((oldmag - 5.24)**2) + 10
-            self.ASlogger.info("timelimit is %3.2f days" % timelimit)
+            self.ASlogger.debug("timelimit is %3.2f days", timelimit)
 
             cutofftime = self.epochTime - 86400 * timelimit
             testtime = int(datetime.strptime(self.gmdate, "%d-%b-%Y %H:%M:%S").timestamp())
-            self.ASlogger.info("Added time is %d, cutoff is %f (%f days)" % (testtime, cutofftime, timelimit))
+            self.ASlogger.debug("Added time is %d, cutoff is %f (%f days)", testtime, cutofftime, timelimit)
             timeleft = testtime - cutofftime
             daysleft = timeleft/86400
-            self.ASlogger.info("Time left for this rule: %f (%f days)" % (timeleft, daysleft))
+            self.ASlogger.debug("Time left for this rule: %f (%f days)", timeleft, daysleft)
 
             if cutofftime > testtime:
-                self.ASlogger.info("This exclusion rule (eruleid:%d) should be axed" % self.eruleID)
+                self.ASlogger.info("This exclusion rule (eruleid:%d) should be axed", self.eruleID)
                 self.sql1 = "DELETE from excludes where eruleid=%d;" % self.eruleID
-                self.ASlogger.info("SQL is %s" % self.sql1)
+                self.ASlogger.debug("SQL is %s", self.sql1)
                 self._cursor.execute(self.sql1)
-                self.commit()
 
-        self.ASlogger.info("Ending aftershock exclusion zone cleanup run")
+        self.ASlogger.debug("Ending aftershock exclusion zone cleanup run")
         return True
@@ -0,0 +1,514 @@
+# stdlib imports
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+# Third party imports
+from shakelib.rupture import constants
+
+# Local imports
+from shakemap_aqms.aftershock import aftershockDB
+from shakemap_aqms.logs import kv
+from shakemap_aqms.prefetch import discard_prefetch
+from shakemap_aqms.scheduler import WorkItem
+from shakemap_aqms.tracing import NullTraceStore
+from shakemap_aqms.util import get_aqms_config
+
+# How often (s) the expired aftershock zones are removed
+AFTERSHOCK_CLEANUP_INTERVAL = 600
+
+
+def dispatch(action, eventid, processor=None, work_queue=None):
+    """Hand on a message received by aqms_queue: put it on the shared
+    work queue if there is one, otherwise give it to the processor.
+
+    Args:
+        action (str): 'shake_alarm' or 'shake_cancel'.
+        eventid (str): The event ID.
+        processor (AlarmProcessor): The processor (without a work queue).
+        work_queue (WorkQueue): The shared work queue.
+    """
+    if work_queue is not None:
+        work_queue.put('origin' if action == 'shake_alarm' else 'cancel',
+                       eventid)
+    elif action == 'shake_alarm':
+        processor.alarm(eventid)
+    else:
+        processor.cancel(eventid)
+
+
+def default_send(install_path):
+    """Return a function that sends a message to sm_queue.
+
+    Args:
+        install_path (str): The ShakeMap install path.
+
+    Returns:
+        function: send(action, data).
+    """
+    import shakemap.utils.queue as queue
+
+    port = queue.get_config(install_path)['port']
+
+    def send(action, data):
+        queue.send_queue(action, data, port)
+    return send
+
+
+def default_prefetch(install_path, logger):
+    """Return a function that prefetches the data of an event for
+    aqms_db2xml.
+
+    Args:
+        install_path (str): The ShakeMap install path.
+        logger (logger): The logger for this process.
+
+    Returns:
+        function: prefetch(event).
+    """
+    from shakemap_aqms.prefetch import prefetch_event
+
+    def prefetch(event):
+        prefetch_event(install_path, event, get_aqms_config(), logger)
+    return prefetch
+
+
+class AlarmProcessor(object):
+    """Do the work of aqms_queue for the messages it receives: look up
+    the events, apply the aftershock suppression, and send the origins
+    and cancels on to sm_queue.
+
+    Alarms are looked up by a pool of threads and then queued by
+    magnitude on the scheduler; a single worker thread takes the
+    messages off the scheduler and processes them. Alternatively, the
+    jobs leased from a shared work queue (see shakemap_aqms.workqueue)
+    are handled one at a time with handle(), in which case there may be
+    several processes using the aftershock database at once.
+
+    If "prefetch_max_age" in aqms.conf is set, the station metadata and
+    amps of each event that is sent on are fetched in the background
+    for aqms_db2xml (see shakemap_aqms.prefetch). If "watch_amps" in
+    aqms_queue.conf is set, the amps of those events are watched, and
+    the events are sent again when their amps change materially (see
+    shakemap_aqms.ampwatch). The reruns go through the scheduler or the
+    work queue like the alarms, so they are dropped if the event has
+    been cancelled.
+    """
+
+    def __init__(self, install_path, scheduler, logger, get_eqinfo=None,
+                 send=None, lookup_workers=4, tracer=None, prefetch=None,
+                 telemetry=None, work_queue=None):
+        """Create an alarm processor.
+
+        Args:
+            install_path (str): The ShakeMap install path.
+            scheduler (AlarmScheduler): The queue of work; None if the
+                jobs come from a shared work queue.
+            logger (logger): The logger for this process.
+            get_eqinfo (function): The event lookup, called as
+                get_eqinfo(eventid, config, logger); defaults to
+                shakemap_aqms.util.get_eqinfo.
+            send (function): Sends a message to sm_queue, called as
+                send(action, data); defaults to default_send().
+            lookup_workers (int): The number of threads looking up
+                events.
+            tracer (TraceStore): The store for the events' traces; by
+                default nothing is traced.
+            prefetch (function): Prefetches the data of an event, called
+                as prefetch(event); defaults to default_prefetch().
+            telemetry (Telemetry): If given, the memory allocated while
+                each job from the work queue is handled is recorded (see
+                shakemap_aqms.telemetry). This isn't done with the
+                scheduler, where the lookups of other alarms allocate
+                at the same time.
+            work_queue (WorkQueue): The shared work queue the jobs come
+                from, if scheduler is None; reruns are put on it.
+        """
+        if get_eqinfo is None:
+            from shakemap_aqms.util import get_eqinfo
+        if send is None:
+            send = default_send(install_path)
+        if prefetch is None:
+            prefetch = default_prefetch(install_path, logger)
+        self.install_path = install_path
+        self.scheduler = scheduler
+        self.logger = logger
+        self.get_eqinfo = get_eqinfo
+        self.send = send
+        self.tracer = NullTraceStore() if tracer is None else tracer
+        self.prefetch = prefetch
+        self.telemetry = telemetry
+        self.work_queue = work_queue
+        self.aftershock_db = None
+        self._cleaned = 0
+        self.watcher = None
+        self._lookups = ThreadPoolExecutor(max_workers=lookup_workers)
+        self._prefetches = ThreadPoolExecutor(max_workers=2)
+        self._thread = None
+
+    def alarm(self, eventid):
+        """Handle a shake_alarm: look the event up in the background and
+        queue it.
+
+        Args:
+            eventid (str): The event ID.
+
+        Returns:
+            Future: The lookup.
+        """
+        return self._lookups.submit(self._lookup, eventid, WorkItem(
+            'origin', eventid))
+
+    def _lookup(self, eventid, item):
+        if self.lookup(item):
+            return self.scheduler.put(item)
+        return False
+
+    def lookup(self, item):
+        """Look up the event of an origin.
+
+        Args:
+            item (WorkItem): The item; its event is set if the lookup
+                succeeds.
+
+        Returns:
+            bool: True if the event was found.
+        """
+        eventid = item.eventid
+        #
+        # The event's trace starts when the alarm was received
+        #
+        item.trace_id = self.tracer.new_trace(eventid, item.received)
+        try:
+            event = self.get_eqinfo(eventid, get_aqms_config(), self.logger)
+        except Exception as err:
+            self.tracer.record(item.trace_id, 'lookup', item.received,
+                               time.time(), 'error', str(err))
+            self.logger.error('Lookup of event %s failed: %s', eventid, err,
+                              extra=kv(event=eventid))
+            return False
+        if event is None:
+            self.tracer.record(item.trace_id, 'lookup', item.received,
+                               time.time(), 'error', 'not found')
+            self.logger.warning("Couldn't find event %s in database",
+                                eventid, extra=kv(event=eventid))
+            return False
+        self.tracer.record(item.trace_id, 'lookup', item.received,
+                           time.time())
+        item.event = event
+        self.logger.info('Event mag is %f', event.get('mag'),
+                         extra=kv(event=eventid))
+        return True
+
+    def cancel(self, eventid):
+        """Handle a shake_cancel: queue it.
+
+        Args:
+            eventid (str): The event ID.
+
+        Returns:
+            bool: True if the cancel was queued.
+        """
+        return self.scheduler.put(WorkItem('cancel', eventid))
+
+    def process(self, item, claim=None):
+        """Process a work item taken off the scheduler.
+
+        Args:
+            item (WorkItem): The item.
+            claim (function): If given, called just before the message is
+                sent to sm_queue; if it returns False (another process
+                has taken over the item) nothing is sent.
+
+        Returns:
+            bool: True if a message was sent to sm_queue.
+        """
+        fields = kv(event=item.eventid, action=item.action,
+                    wait='%.3f' % item.wait)
+        detail = None
+        if self.scheduler is not None:
+            depth = self.scheduler.depth
+            fields['kv']['depth'] = depth
+            detail = 'depth=%d' % depth
+        self.logger.info('Processing %s for event %s', item.action,
+                         item.eventid, extra=fields)
+        if item.trace_id is None:
+            item.trace_id = self.tracer.new_trace(item.eventid,
+                                                  item.received)
+        self.tracer.record(item.trace_id, 'queue', item.queued,
+                           item.dequeued, detail=detail)
+        if item.action == 'cancel':
+            if claim is not None and not claim():
+                self.logger.warning('Lost the claim on cancel event %s; '
+                                    'not sending it', item.eventid,
+                                    extra=kv(event=item.eventid))
+                return False
+            try:
+                with self.tracer.span(item.trace_id, 'send_cancel'):
+                    self.send('cancel', {'id': item.eventid})
+            except Exception:
+                self.logger.error("Couldn't send cancel event %s to "
+                                  "sm_queue", item.eventid,
+                                  extra=kv(event=item.eventid))
+                return False
+            self.logger.info('Sent cancel event %s to sm_queue',
+                             item.eventid, extra=kv(event=item.eventid))
+            if self.watcher is not None:
+                self.watcher.unwatch(item.eventid)
+            return True
+
+        event = item.event
+        if item.action == 'rerun':
+            #
+            # The aftershock suppression isn't applied again, and the
+            # prefetched amps are out of date
+            #
+            discard_prefetch(self.install_path, item.eventid)
+        else:
+            with self.tracer.span(item.trace_id, 'aftershock'):
+                if not self.check_aftershock(event):
+                    return False
+            if get_aqms_config()['prefetch_max_age'] > 0:
+                self._prefetches.submit(self._prefetch, item)
+        try:
+            data = self._origin_data(item)
+            if claim is not None and not claim():
+                self.logger.warning('Lost the claim on event %s; not '
+                                    'sending it', item.eventid,
+                                    extra=kv(event=item.eventid))
+                return False
+            with self.tracer.span(item.trace_id, 'send'):
+                self.send('origin', data)
+        except Exception as e:
+            self.logger.error("Couldn't send event %s to sm_queue: %s",
+                              item.eventid, e, extra=kv(event=item.eventid))
+            return False
+        if item.action == 'rerun':
+            self.logger.info('Sent event %s to sm_queue again',
+                             item.eventid,
+                             extra=kv(event=item.eventid, reason='amps'))
+            return True
+        self.logger.info('Sent event %s to sm_queue', item.eventid,
+                         extra=kv(event=item.eventid))
+        self._watch(item)
+        return True
+
+    def _origin_data(self, item):
+        # Shakemap code keeps value as datetime, need string for JSON
+        # parsing by queue
+        data = dict(item.event)
+        data['time'] = item.event['time'].strftime(constants.TIMEFMT)
+        if item.trace_id is not None:
+            data['trace_id'] = item.trace_id
+        return data
+
+    def _watch(self, item):
+        if not get_aqms_config('aqms_queue')['watch_amps']:
+            return
+        if self.watcher is None:
+            from shakemap_aqms.ampwatch import AmpWatcher
+            self.watcher = AmpWatcher(self.install_path, self.rerun,
+                                      self.logger)
+            self.watcher.start()
+        self.watcher.watch(item.event, item.received)
+
+    def rerun(self, eventid, reasons, since):
+        """Queue an event to be sent to sm_queue again because its amps
+        have changed (see shakemap_aqms.ampwatch). The event is looked up
+        again, but the aftershock suppression isn't applied again. The
+        rerun is dropped, and the event is no longer watched, if the
+        event has been cancelled since its alarm.
+
+        Args:
+            eventid (str): The event ID.
+            reasons (list): Why the event is being run again.
+            since (float): The time of the event's alarm.
+
+        Returns:
+            bool: True if the rerun was queued.
+        """
+        queue = self.scheduler if self.work_queue is None \
+            else self.work_queue
+        if queue.cancelled(eventid, since):
+            self.logger.info('Not running event %s again: it has been '
+                             'cancelled', eventid, extra=kv(event=eventid))
+            if self.watcher is not None:
+                self.watcher.unwatch(eventid)
+            return False
+        self.logger.info('Queueing event %s to run again (%s)', eventid,
+                         '; '.join(reasons),
+                         extra=kv(event=eventid, reason='amps'))
+        if self.work_queue is not None:
+            return self.work_queue.put('rerun', eventid,
+                                       since=since) is not None
+        item = WorkItem('rerun', eventid)
+        item.alarmed = since
+        if not self.lookup(item):
+            return False
+        return self.scheduler.put(item)
+
+    def _prefetch(self, item):
+        try:
+            with self.tracer.span(item.trace_id, 'prefetch'):
+                self.prefetch(item.event)
+        except Exception as err:
+            self.logger.warning('Prefetch for event %s failed: %s',
+                                item.eventid, err,
+                                extra=kv(event=item.eventid))
+
+    def handle(self, job, claim=None):
+        """Handle a job leased from the work queue: look up the event of
+        an origin and process it.
+
+        Args:
+            job (Job): The job (see shakemap_aqms.workqueue).
+            claim (function): See process().
+
+        Returns:
+            bool: True if a message was sent to sm_queue.
+        """
+        item = WorkItem(job.action, job.eventid, received=job.received)
+        item.queued = job.received
+        item.dequeued = job.leased
+        item.wait = job.leased - job.received
+        with self._measure(item.eventid):
+            if item.action != 'cancel' and not self.lookup(item):
+                return False
+            return self.process(item, claim)
+
+    def work(self, owner):
+        """Lease the next job from the work queue, handle it, and mark
+        it done (or failed).
+
+        Args:
+            owner (str): The name of this worker (see
+                shakemap_aqms.workqueue.worker_name()).
+
+        Returns:
+            Job: The job, or None if there was nothing to do.
+        """
+        work_queue = self.work_queue
+        job = work_queue.lease(owner)
+        if job is None:
+            return None
+        try:
+            sent = self.handle(job,
+                               claim=lambda: work_queue.renew(job, owner))
+        except Exception as err:
+            self.logger.error('Processing of event %s failed: %s',
+                              job.eventid, err,
+                              extra=kv(event=job.eventid, job=job.id))
+            work_queue.complete(job, owner, result=str(err), failed=True)
+            return job
+        if not work_queue.complete(job, owner,
+                                   result='sent' if sent else 'skipped'):
+            self.logger.warning('Lease on job %d (event %s) expired before '
+                                'it was done', job.id, job.eventid,
+                                extra=kv(event=job.eventid, job=job.id))
+        return job
+
+    def _measure(self, eventid):
+        if self.telemetry is None:
+            return nullcontext()
+        return self.telemetry.measure(eventid)
+
+    def _get_aftershock_db(self):
+        if self.aftershock_db is None:
+            self.aftershock_db = aftershockDB(self.install_path)
+        return self.aftershock_db
+
+    def cleanup_aftershock(self):
+        """Remove the expired aftershock zones, if it has been
+        AFTERSHOCK_CLEANUP_INTERVAL seconds since the last time. This is
+        called between alarms rather than for each one, so that the
+        zones in memory stay valid from one alarm to the next.
+
+        Returns:
+            bool: True if the zones were cleaned up.
+        """
+        queue_conf = get_aqms_config('aqms_queue')
+        if float(queue_conf['aftershock']) <= 0:
+            return False
+        if time.time() - self._cleaned < AFTERSHOCK_CLEANUP_INTERVAL:
+            return False
+        self._cleaned = time.time()
+        try:
+            self._get_aftershock_db().cleanupAftershockZones(
+                float(queue_conf['emaglimit']))
+        except Exception as err:
+            self.logger.error('Aftershock zone cleanup failed: %s', err)
+            return False
+        self.logger.debug('Aftershock zone cleanup finished')
+        return True
+
+    def check_aftershock(self, event):
+        """Apply the aftershock suppression to an event, defining a new
+        aftershock zone if the event is big enough. The event is checked
+        against the zones in memory without any lock; a zone is defined
+        under the database's lock, and the definition checks the zones
+        again with a query, so that two processes can't both define
+        zones for events that overlap.
+
+        Args:
+            event (dict): The event information.
+
+        Returns:
+            bool: False if the event should be skipped.
+        """
+        queue_conf = get_aqms_config('aqms_queue')
+        aftershockThreshold = float(queue_conf['aftershock'])
+        if aftershockThreshold <= 0:
+            return True
+        aftershock_db = self._get_aftershock_db()
+        eventID = event.get("netid") + str(event.get("id"))
+        emaglimit = float(queue_conf['emaglimit'])
+        self.logger.debug('emaglimit configuration set to %f', emaglimit)
+        aftershockDict = {"lat": event.get('lat'), "lon": event.get('lon'),
+                          "eventID": eventID, "mag": event.get('mag'),
+                          "emaglimit": emaglimit}
+        zoneTuple = aftershock_db.checkAftershockZone(aftershockDict)
+        if zoneTuple[0] == 1:
+            # this event is in an exclusion zone and below limit, skip
+            self.logger.warning("Event is in an aftershock zone and "
+                                "below the exclusion limit, will skip",
+                                extra=kv(event=eventID, zone=zoneTuple[1]))
+            return False
+
+        # define aftershock zone if necessary
+        if event.get('mag') >= aftershockThreshold:
+            self.logger.warning("Event is over M%3.1f, do aftershock "
+                                "define for event %s",
+                                aftershockThreshold, eventID)
+            with aftershock_db.lock():
+                excluderegion = aftershock_db.defineAftershockZone(
+                    aftershockDict)
+            if excluderegion == 1:
+                # Another process defined a zone around this event
+                # since it was checked
+                self.logger.warning("Event is in an aftershock zone and "
+                                    "below the exclusion limit, will skip",
+                                    extra=kv(event=eventID))
+                return False
+        return True
+
+    def run(self):
+        """Process work items forever (the body of the worker thread).
+        """
+        while True:
+            self.cleanup_aftershock()
+            item = self.scheduler.get(timeout=AFTERSHOCK_CLEANUP_INTERVAL)
+            if item is None:
+                continue
+            try:
+                self.process(item)
+            except Exception as err:
+                self.logger.error('Processing of event %s failed: %s',
+                                  item.eventid, err,
+                                  extra=kv(event=item.eventid))
+
+    def start(self):
+        """Start the worker thread.
+        """
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
@@ -0,0 +1,94 @@
+# stdlib imports
+import os
+import os.path
+
+# Third party imports
+import pandas as pd
+
+#
+# The Parquet and HDF5 amp files written beside the XML (see
+# "columnar_format" in aqms.conf). This module doesn't need a database
+# client, so the files can be read anywhere pandas is installed.
+#
+
+# The file name extensions of the columnar formats (see write_columnar())
+COLUMNAR_EXTENSIONS = {'parquet': '.parquet', 'hdf5': '.h5'}
+
+# The key of the amp table in an HDF5 file
+HDF_KEY = 'amps'
+
+# The text columns, which are stored as strings in the columnar files
+STRING_COLUMNS = ('station', 'channel', 'imt', 'netid', 'name', 'loc',
+                  'source', 'location', 'provenance')
+
+
+def write_columnar(df, datadir, dbname, fmt):
+    """Write an amp set to a Parquet or HDF5 file, <dbname>_dat.parquet
+    or <dbname>_dat.h5, beside its XML file. The file holds the same
+    table as the XML (plus the SEED location, the load date, and the
+    distance), with its values at full precision; read it with
+    read_amps().
+
+    Args:
+        df (DataFrame): The amps.
+        datadir (str): The event's current directory.
+        dbname (str): The name of the amp set.
+        fmt (str): 'parquet' or 'hdf5'.
+
+    Returns:
+        str: The path of the file.
+
+    Raises:
+        ImportError: If the package needed for the format (pyarrow or
+            fastparquet for Parquet, PyTables for HDF5) isn't installed.
+    """
+    path = os.path.join(datadir, dbname + '_dat' + COLUMNAR_EXTENSIONS[fmt])
+    df = df.reset_index(drop=True)
+    for column in STRING_COLUMNS:
+        if column in df:
+            df[column] = df[column].astype(str)
+    if fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_hdf(path, key=HDF_KEY, mode='w', format='table',
+                  complevel=5, complib='zlib')
+    return path
+
+
+def read_amps(path):
+    """Read an amp set written by write_columnar().
+
+    Args:
+        path (str): The path of the Parquet (.parquet) or HDF5 (.h5)
+            file.
+
+    Returns:
+        DataFrame: The amps.
+    """
+    if path.endswith(COLUMNAR_EXTENSIONS['hdf5']):
+        return pd.read_hdf(path, key=HDF_KEY)
+    return pd.read_parquet(path)
+
+
+def load_amps(datadir):
+    """Read all of the columnar amp files in an event's directory.
+
+    Args:
+        datadir (str): The event's current directory.
+
+    Returns:
+        list: (dbname, DataFrame) tuples, like those of get_amps(), in
+        the order of the names; if an amp set was written in both
+        formats, only the Parquet file is read.
+    """
+    ampsets = {}
+    suffixes = [('_dat' + COLUMNAR_EXTENSIONS[fmt], fmt)
+                for fmt in ('hdf5', 'parquet')]
+    for filename in sorted(os.listdir(datadir)):
+        for suffix, fmt in suffixes:
+            if filename.endswith(suffix):
+                dbname = filename[:-len(suffix)]
+                if fmt == 'hdf5' and dbname in ampsets:
+                    continue
+                ampsets[dbname] = read_amps(os.path.join(datadir, filename))
+    return sorted(ampsets.items())
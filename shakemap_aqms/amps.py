@@ -0,0 +1,566 @@
+# stdlib imports
+import os
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+
+# Third party imports
+import cx_Oracle
+import numpy as np
+import pandas as pd
+
+# Local imports
+from shakemap_aqms.ampfiles import write_columnar
+from shakemap_aqms.stationxml import dataframe_to_xml
+
+# The strong motion amps (of any event)
+AMP_JOIN = ("FROM amp a, assocevampset asoc, ampset s "
+            "WHERE asoc.ampsetid = s.ampsetid AND asoc.isvalid = 1 "
+            "AND asoc.ampsettype = 'sm' "
+            "AND s.ampid  = a.ampid "
+            "AND a.amptype IN ('PGA', 'PGV', 'SP.3', 'SP1.0', "
+            "'SP3.0') ")
+
+# The amps of an event
+AMP_FILTER = AMP_JOIN + "AND asoc.evid = :evid "
+
+AMP_QUERY = ("WITH q1 AS ("
+             "SELECT a.net, a.sta, a.seedchan, a.location, "
+             "a.amplitude, a.amptype, a.cflag, a.quality, "
+             "a.units, a.lddate " +
+             AMP_FILTER +
+             "ORDER BY a.net, a.sta, a.seedchan, a.location, "
+             "a.amptype, a.lddate desc "
+             ") "
+             "SELECT UNIQUE net, sta, seedchan, location, "
+             "amplitude, amptype, cflag, quality, units, lddate "
+             "FROM q1 "
+             "ORDER BY net, sta, seedchan, location, amptype, lddate desc")
+
+#
+# The number of stations with usable amps, used to choose the database
+# for query_modes 1 and 2 before any amps are fetched; it can be more
+# than the number in the amp set, since stations without metadata (or
+# with disqualifying site codes) are dropped later
+#
+COUNT_QUERY = ("SELECT COUNT(DISTINCT a.net || '.' || a.sta) " +
+               AMP_FILTER +
+               "AND a.quality >= 0.5")
+
+#
+# The number of stations and amps, and the time the last amp was loaded,
+# for each of a batch of events (the binds are filled in by
+# query_amp_summary()), and the amps of an event loaded since a given
+# time; these are used by the amp watcher (see shakemap_aqms.ampwatch)
+#
+AMP_SUMMARY_QUERY = ("SELECT asoc.evid, "
+                     "COUNT(DISTINCT a.net || '.' || a.sta), COUNT(*), "
+                     "MAX(a.lddate) " +
+                     AMP_JOIN +
+                     "AND a.quality >= 0.5 "
+                     "AND asoc.evid IN (%s) "
+                     "GROUP BY asoc.evid")
+
+NEW_AMP_QUERY = ("SELECT a.net, a.sta, a.amptype, a.amplitude, a.units, "
+                 "a.lddate " +
+                 AMP_FILTER +
+                 "AND a.quality >= 0.5 "
+                 "AND a.lddate > :since")
+
+# Maximum number of bind variables in an IN list
+MAX_BINDS = 1000
+
+#
+# 'location' (the SEED location code) and 'lddate' (the time the amp was
+# loaded) are not written to the XML; they are used to merge the amps
+# from several databases (query_mode 4)
+#
+COLUMNS = ('station', 'channel', 'imt', 'value', 'lat',
+           'lon', 'netid', 'flag', 'name', 'loc', 'source',
+           'location', 'lddate')
+
+# The amps that are duplicates of each other in a merge
+MERGE_KEYS = ['station', 'location', 'channel', 'imt']
+
+# The name of the merged amp set (and thus of its file, merged_dat.xml)
+MERGED_NAME = 'merged'
+
+EARTH_RADIUS = 6371.0  # km
+
+IMTS = {'PGA': 'pga', 'PGV': 'pgv', 'SP.3': 'psa03', 'SP1.0': 'psa10',
+        'SP3.0': 'psa30'}
+
+
+def make_amp_rows(rows, stadict, config):
+    """Match amps up with the station info.
+
+    Args:
+        rows (iterable): Rows of AMP_QUERY.
+        stadict (dict): The station dictionary.
+        config (dict): The AQMS configuration dictionary.
+
+    Returns:
+        list: Rows of data with the columns in COLUMNS.
+    """
+    ampdata = {}
+    amprows = []
+    for row in rows:
+        (net, sta, chan, loc, amp, amptype, cflag, quality,
+         units, lddate) = row
+        loc = loc.replace(' ', '-')
+        netsta = net + '.' + sta
+        try:
+            sd = stadict[netsta][loc][chan]
+        except KeyError:
+            # Can't get station info for some reason
+            continue
+        # Skip amps with unknown or disqualifying Cosmos Site Codes
+        # unless no adhod file was provided, then trust everything
+        if config['adhoc_file']:
+            if 't6' not in sd:
+                continue
+            if int(sd['t6']) not in config['valid_codes']:
+                continue
+        if quality < 0.5:
+            continue
+        if netsta not in ampdata:
+            ampdata[netsta] = {loc: {chan: {'n_amps_on_scale': 0}}}
+        elif loc not in ampdata[netsta]:
+            ampdata[netsta][loc] = {chan: {'n_amps_on_scale': 0}}
+        elif chan not in ampdata[netsta][loc]:
+            ampdata[netsta][loc][chan] = {'n_amps_on_scale': 0}
+        # Use only the most recently loaded amp, which are returned
+        # in descending order of lddate.
+        if amptype.upper() in ampdata[netsta][loc][chan]:
+            continue
+        ampdata[netsta][loc][chan][amptype.upper()] = True
+        # CISN flag values are:
+        #   BN  ->  below noise
+        #   OS  ->  on scale
+        #   CL  ->  clipped
+        # Quality values are:
+        #   1.0 ->  complete time window
+        #   0.5 ->  partial time window, approved for use by analyst
+        #   0.0 ->  incomplete time window
+        if 'os' in cflag or 'OS' in cflag:
+            ampdata[netsta][loc][chan]['n_amps_on_scale'] += 1
+            cflag = 0
+        else:
+            cflag = 1
+        imt = IMTS[amptype]
+        if units == 'cmss':
+            amp = amp / 9.81
+        newrow = (netsta, chan, imt, amp, sd['lat'], sd['lon'],
+                  net, cflag, sd['staname'], sd['staloc'],
+                  sd['netdesc'], loc, lddate)
+        amprows.append(newrow)
+    return amprows
+
+
+def query_amps(connector, dbname, eventid, stadict, config, logger):
+    """Get the amps for an event from one database.
+
+    Args:
+        connector (Connector): The database connector.
+        dbname (str): The name of the database.
+        eventid (str): The event ID.
+        stadict (dict): The station dictionary.
+        config (dict): The AQMS configuration dictionary.
+        logger (logger): The logger for this process.
+
+    Returns:
+        DataFrame: The amps, with the columns in COLUMNS, or None if
+        the query failed or returned no usable amps.
+    """
+    with connector.connect(dbname) as con:
+        if con is None:
+            return None
+        cursor = con.cursor()
+        try:
+            cursor.execute(AMP_QUERY, {'evid': eventid})
+            amprows = make_amp_rows(cursor, stadict, config)
+        except cx_Oracle.DatabaseError as err:
+            logger.warn('Error: amp query failed: %s' % err)
+            connector.failed(dbname, err)
+            return None
+        finally:
+            cursor.close()
+    if len(amprows) == 0:
+        return None
+    return pd.DataFrame.from_records(amprows, columns=COLUMNS,
+                                     coerce_float=True)
+
+
+def query_count(connector, dbname, eventid, logger):
+    """Count the stations with amps for an event in one database (see
+    COUNT_QUERY).
+
+    Args:
+        connector (Connector): The database connector.
+        dbname (str): The name of the database.
+        eventid (str): The event ID.
+        logger (logger): The logger for this process.
+
+    Returns:
+        int: The number of stations, or None if the query failed.
+    """
+    with connector.connect(dbname) as con:
+        if con is None:
+            return None
+        cursor = con.cursor()
+        try:
+            cursor.execute(COUNT_QUERY, {'evid': eventid})
+            return cursor.fetchone()[0]
+        except cx_Oracle.DatabaseError as err:
+            logger.warn('Error: station count query failed: %s' % err)
+            connector.failed(dbname, err)
+            return None
+        finally:
+            cursor.close()
+
+
+def count_stations(connector, dbnames, eventid, logger):
+    """Count the stations with amps for an event in all of the databases
+    at once.
+
+    Args:
+        connector (Connector): The database connector.
+        dbnames (list): The names of the databases.
+        eventid (str): The event ID.
+        logger (logger): The logger for this process.
+
+    Returns:
+        dict: The number of stations in each database that answered.
+    """
+    if len(dbnames) == 0:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(dbnames)) as executor:
+        counts = executor.map(
+            lambda dbname: query_count(connector, dbname, eventid, logger),
+            dbnames)
+        counts = dict(zip(dbnames, counts))
+    logger.info('Stations with amps for event %s: %s' %
+                (eventid, ', '.join('%s %s' % item
+                                    for item in counts.items())))
+    return {dbname: count for dbname, count in counts.items()
+            if count is not None}
+
+
+def rank_databases(dbnames, counts, config):
+    """Order the databases in which to fetch the amps for query_modes 1
+    and 2, from their station counts (see count_stations()).
+
+    With query_mode 1, the databases with at least query_min_stas
+    stations come first, in their usual order, followed (in case none
+    of them has enough) by the others in decreasing order of their
+    counts. With query_mode 2, the databases are in decreasing order of
+    their counts, ties going by the usual order. Databases without any
+    stations, or that didn't answer, are left out.
+
+    Args:
+        dbnames (list): The names of the databases in their usual
+            order.
+        counts (dict): The number of stations in each database.
+        config (dict): The AQMS configuration dictionary.
+
+    Returns:
+        list: The names of the databases.
+    """
+    dbnames = [dbname for dbname in dbnames if counts.get(dbname, 0) > 0]
+    by_count = sorted(dbnames, key=lambda dbname: -counts[dbname])
+    if config['query_mode'] == 2:
+        return by_count
+    enough = [dbname for dbname in dbnames
+              if counts[dbname] >= config['query_min_stas']]
+    return enough + [dbname for dbname in by_count if dbname not in enough]
+
+
+def query_amp_summary(connector, eventids, logger):
+    """Get the number of stations and amps, and the time the last amp
+    was loaded, for many events at once (see AMP_SUMMARY_QUERY).
+
+    The databases are tried in order until one answers.
+
+    Args:
+        connector (Connector): The database connector.
+        eventids (list): The event IDs.
+        logger (logger): The logger for this process.
+
+    Returns:
+        dict: (nstations, namps, lddate) for each event with amps; None
+        if no database answered.
+    """
+    for dbname in connector.dbnames():
+        with connector.connect(dbname) as con:
+            if con is None:
+                continue
+            cursor = con.cursor()
+            try:
+                summary = {}
+                for ix in range(0, len(eventids), MAX_BINDS):
+                    chunk = [int(evid) for evid in
+                             eventids[ix:ix + MAX_BINDS]]
+                    binds = ', '.join([':%d' % (i + 1)
+                                       for i in range(len(chunk))])
+                    cursor.execute(AMP_SUMMARY_QUERY % binds, chunk)
+                    for evid, nstas, namps, lddate in cursor:
+                        summary[str(evid)] = (nstas, namps, lddate)
+                return summary
+            except cx_Oracle.DatabaseError as err:
+                logger.warn('Error: amp summary query failed: %s' % err)
+                connector.failed(dbname, err)
+                continue
+            finally:
+                cursor.close()
+    return None
+
+
+def query_new_amps(connector, eventid, since, logger):
+    """Get the amps of an event loaded after a given time (see
+    NEW_AMP_QUERY).
+
+    The databases are tried in order until one answers.
+
+    Args:
+        connector (Connector): The database connector.
+        eventid (str): The event ID.
+        since (datetime): Only amps loaded after this time are returned.
+        logger (logger): The logger for this process.
+
+    Returns:
+        list: (NET.STA, amptype, amplitude, lddate) tuples, with the
+        accelerations in %g; None if no database answered.
+    """
+    for dbname in connector.dbnames():
+        with connector.connect(dbname) as con:
+            if con is None:
+                continue
+            cursor = con.cursor()
+            try:
+                cursor.execute(NEW_AMP_QUERY, {'evid': eventid,
+                                               'since': since})
+                amps = []
+                for net, sta, amptype, amp, units, lddate in cursor:
+                    if units == 'cmss':
+                        amp = amp / 9.81
+                    amps.append((net + '.' + sta, amptype, amp, lddate))
+                return amps
+            except cx_Oracle.DatabaseError as err:
+                logger.warn('Error: new amp query failed: %s' % err)
+                connector.failed(dbname, err)
+                continue
+            finally:
+                cursor.close()
+    return None
+
+
+def merge_amps(ampsets, config, logger):
+    """Merge the amp sets from several databases into one, keeping one
+    amp for each station, location, channel, and IMT.
+
+    With merge_rule 'lddate' the most recently loaded amp is kept and
+    ties go to the database with the higher priority; with merge_rule
+    'priority' the amp from the database with the highest priority is
+    kept. Databases are prioritized in the order given by
+    merge_priority, and then in lexicographic order.
+
+    Args:
+        ampsets (list): (dbname, DataFrame) tuples.
+        config (dict): The AQMS configuration dictionary.
+        logger (logger): The logger for this process.
+
+    Returns:
+        DataFrame: The merged amps, with a 'provenance' column holding
+        the name of the database each amp came from.
+    """
+    priority = list(config['merge_priority'])
+    dbnames = [dbname for dbname, _ in ampsets]
+    ranked = [dbname for dbname in priority if dbname in dbnames] + \
+        sorted([dbname for dbname in dbnames if dbname not in priority])
+    frames = []
+    for dbname, df in ampsets:
+        df = df.assign(provenance=dbname, rank=ranked.index(dbname))
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+    if config['merge_rule'] == 'lddate':
+        df = df.sort_values(MERGE_KEYS + ['lddate', 'rank'],
+                            ascending=[True] * len(MERGE_KEYS) +
+                            [False, True],
+                            na_position='last', kind='mergesort')
+    else:
+        df = df.sort_values(MERGE_KEYS + ['rank'], kind='mergesort')
+    merged = df.drop_duplicates(subset=MERGE_KEYS, keep='first')
+    logger.info('Merged %d amps from %d database(s) into %d' %
+                (len(df), len(ampsets), len(merged)))
+    return merged.drop(columns='rank').reset_index(drop=True)
+
+
+def get_amps(connector, eventid, stadict, config, logger):
+    """Get the amps for an event from the database(s), following the
+    configured query_mode.
+
+    Args:
+        connector (Connector): The database connector.
+        eventid (str): The event ID.
+        stadict (dict): The station dictionary.
+        config (dict): The AQMS configuration dictionary.
+        logger (logger): The logger for this process.
+
+    Returns:
+        list: (dbname, DataFrame) tuples of the amp sets to be written;
+        with query_mode 4 this is a single merged set named MERGED_NAME.
+    """
+    dbnames = connector.dbnames()
+    ampsets = []
+    if config['query_mode'] in (1, 2):
+        #
+        # Choose the database by counting the stations in all of them,
+        # and fetch only its amps (or the next one's, if it turns out
+        # to have fewer usable stations than needed). The counts are
+        # at least the usable stations, so with query_mode 2 the next
+        # database is only worth fetching while its count is more
+        # than the most usable stations found so far.
+        #
+        counts = count_stations(connector, dbnames, eventid, logger)
+        best = None
+        best_nstas = 0
+        for dbname in rank_databases(dbnames, counts, config):
+            if config['query_mode'] == 2 and best is not None and \
+                    counts[dbname] <= best_nstas:
+                break
+            df = query_amps(connector, dbname, eventid, stadict, config,
+                            logger)
+            if df is None:
+                continue
+            nstas = len(set(df['station']))
+            if config['query_mode'] == 1 and \
+                    nstas >= config['query_min_stas']:
+                best = (dbname, df)
+                break
+            if best is None or nstas > best_nstas:
+                best = (dbname, df)
+                best_nstas = nstas
+        if best is not None:
+            ampsets.append(best)
+        return ampsets
+    for dbname in dbnames:
+        df = query_amps(connector, dbname, eventid, stadict, config, logger)
+        if df is None:
+            continue
+        ampsets.append((dbname, df))
+    if config['query_mode'] == 4 and len(ampsets) > 0:
+        ampsets = [(MERGED_NAME, merge_amps(ampsets, config, logger))]
+    return ampsets
+
+
+def add_distances(df, lat, lon):
+    """Add a 'distance' column with the great circle distance (km) from
+    the origin to each station.
+
+    Args:
+        df (DataFrame): The amps, with the columns in COLUMNS.
+        lat (float): The latitude of the origin.
+        lon (float): The longitude of the origin.
+
+    Returns:
+        DataFrame: The amps with the distance column.
+    """
+    lat1 = np.radians(lat)
+    lat2 = np.radians(df['lat'].to_numpy(dtype=float))
+    dlat = lat2 - lat1
+    dlon = np.radians(df['lon'].to_numpy(dtype=float) - lon)
+    a = np.sin(dlat / 2)**2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    dist = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    return df.assign(distance=dist)
+
+
+def get_max_distance(mag, config):
+    """Get the distance beyond which stations are dropped for an event
+    of a given magnitude, interpolated from max_distance_mags and
+    max_distance_radii.
+
+    Args:
+        mag (float): The magnitude of the event.
+        config (dict): The AQMS configuration dictionary.
+
+    Returns:
+        float: The maximum distance (km), or None if there is no limit.
+
+    Raises:
+        ValueError: If the lists are not the same length.
+    """
+    mags = config['max_distance_mags']
+    radii = config['max_distance_radii']
+    if len(mags) == 0 and len(radii) == 0:
+        return None
+    if len(mags) != len(radii):
+        raise ValueError('max_distance_mags and max_distance_radii must '
+                         'have the same length')
+    order = np.argsort(mags)
+    return float(np.interp(mag, np.asarray(mags)[order],
+                           np.asarray(radii)[order]))
+
+
+def locate_amps(ampsets, lat, lon, mag, config, logger):
+    """Add the station distances to the amp sets and drop the stations
+    that are farther from the origin than the maximum distance for the
+    event's magnitude (see get_max_distance()).
+
+    Args:
+        ampsets (list): (dbname, DataFrame) tuples as returned by
+            get_amps().
+        lat (float): The latitude of the origin.
+        lon (float): The longitude of the origin.
+        mag (float): The magnitude of the event.
+        config (dict): The AQMS configuration dictionary.
+        logger (logger): The logger for this process.
+
+    Returns:
+        list: (dbname, DataFrame) tuples; sets left with no amps are
+        dropped.
+    """
+    maxdist = get_max_distance(mag, config)
+    located = []
+    for dbname, df in ampsets:
+        df = add_distances(df, lat, lon)
+        if maxdist is not None:
+            keep = df['distance'] <= maxdist
+            if not keep.all():
+                logger.info('Dropped %d of %d amps from %s beyond %.1f km' %
+                            ((~keep).sum(), len(df), dbname, maxdist))
+            df = df[keep]
+            if len(df) == 0:
+                continue
+        located.append((dbname, df))
+    return located
+
+
+def write_amps(ampsets, datadir, columnar='none', logger=None):
+    """Write the amp sets to ShakeMap input XML files and, optionally,
+    to columnar files beside them (see
+    shakemap_aqms.ampfiles.write_columnar()).
+
+    Args:
+        ampsets (list): (dbname, DataFrame) tuples as returned by
+            get_amps().
+        datadir (str): The event's current directory.
+        columnar (str): 'parquet', 'hdf5', or 'none'.
+        logger (logger): The logger for this process.
+
+    Returns:
+        list: The paths of the files written.
+    """
+    files = []
+    for dbname, df in ampsets:
+        xmlfile = os.path.join(datadir, dbname + '_dat.xml')
+        dataframe_to_xml(df, xmlfile)
+        files.append(xmlfile)
+        if columnar != 'none':
+            try:
+                files.append(write_columnar(df, datadir, dbname, columnar))
+            except ImportError as err:
+                # pyarrow (or fastparquet) and PyTables are optional
+                if logger is not None:
+                    logger.warning("Couldn't write %s file for %s: %s" %
+                                   (columnar, dbname, err))
+    return files
@@ -0,0 +1,405 @@
+"""
+Watch the amps of the events that aqms_queue has sent on to sm_queue,
+and send an event again when its amp set changes enough to matter:
+when enough new stations have reported, or a new station is close to
+the epicenter, or a new amplitude is high (see "watch_amps" in
+aqms_queue.conf).
+
+All of the events that are due are polled together with one cheap
+query of the number of stations and amps and the time the last amp was
+loaded; only for the events where that has changed are the new amps
+fetched. Each event is polled at the times (after its alarm) listed in
+the schedule, and then forgotten.
+"""
+
+# stdlib imports
+import copy
+import threading
+import time
+from datetime import datetime
+
+# Local imports
+from shakemap_aqms.logs import kv
+from shakemap_aqms.util import get_aqms_config
+
+# The time before any amp was loaded
+EPOCH = datetime(1970, 1, 1)
+
+# The longest the watcher sleeps between looks at its events (s)
+MAX_SLEEP = 5.0
+
+
+class WatchedEvent(object):
+    """The state of the amps of one event.
+    """
+
+    def __init__(self, event, started):
+        self.eventid = event['id']
+        self.lat = event['lat']
+        self.lon = event['lon']
+        self.time = event['time']
+        self.started = started
+        # The number of the scheduled polls that have been done
+        self.polls = 0
+        # (nstations, namps, lddate) at the last poll; None until the
+        # first (baseline) poll
+        self.summary = None
+        # The load time of the last amp when the event was last run
+        self.baseline = None
+        # The load time of the last amp fetched
+        self.since = None
+        # The stations in the last run (None until the amps are first
+        # fetched), those that have reported since, and those with a
+        # high amplitude
+        self.known = None
+        self.new = set()
+        self.high = set()
+        self.reruns = 0
+        self.stations = None
+        # Counts the restarts, so that a poll that overlaps one can
+        # tell that its state is stale
+        self.generation = 0
+
+    def restart(self):
+        """Start again from the current amp set, after the event has
+        been run.
+        """
+        self.summary = None
+        self.baseline = None
+        self.since = None
+        self.known = None
+        self.new = set()
+        self.generation += 1
+
+    def copy(self):
+        """Return a copy of the state that a poll can change without
+        holding the watcher's lock.
+        """
+        state = copy.copy(self)
+        if self.known is not None:
+            state.known = set(self.known)
+        state.new = set(self.new)
+        state.high = set(self.high)
+        return state
+
+
+def station_coords(stadict):
+    """Return the (lat, lon) of each station in a station dictionary.
+    """
+    coords = {}
+    for netsta, locs in stadict.items():
+        for chans in locs.values():
+            for cdict in chans.values():
+                coords[netsta] = (cdict['lat'], cdict['lon'])
+                break
+            break
+    return coords
+
+
+def material_changes(watched, amps, coords, config):
+    """Add newly loaded amps to the state of an event, and decide whether
+    its amp set has changed enough for it to be run again.
+
+    Args:
+        watched (WatchedEvent): The event.
+        amps (list): (NET.STA, amptype, amplitude, lddate) tuples of the
+            new amps (see shakemap_aqms.amps.query_new_amps()).
+        coords (dict): The (lat, lon) of the stations; stations that
+            aren't in it are taken to be far away.
+        config (dict): The aqms_queue configuration.
+
+    Returns:
+        list: The reasons for running the event again; empty if there
+        are none.
+    """
+    from shakemap_aqms.geocoder import distance_azimuth
+
+    reasons = []
+    new = set(netsta for netsta, _, _, _ in amps) - watched.known
+    fresh = new - watched.new
+    watched.new |= new
+    if len(watched.new) >= config['watch_new_stations']:
+        reasons.append('%d new stations' % len(watched.new))
+    if config['watch_near_distance'] > 0:
+        for netsta in sorted(fresh):
+            if netsta not in coords:
+                continue
+            dist, _ = distance_azimuth(watched.lat, watched.lon,
+                                       *coords[netsta])
+            if dist <= config['watch_near_distance']:
+                reasons.append('new station %s at %.1f km' %
+                               (netsta, dist))
+    if config['watch_high_pga'] > 0:
+        for netsta, amptype, amp, _ in amps:
+            if amptype.upper() != 'PGA' or netsta in watched.high or \
+                    amp < config['watch_high_pga']:
+                continue
+            watched.high.add(netsta)
+            reasons.append('PGA %.1f %%g at %s' % (amp, netsta))
+    return reasons
+
+
+class AmpWatcher(object):
+    """Poll the amps of the recent events in a background thread, and
+    call fire(eventid, reasons) for those whose amp sets have changed
+    materially.
+    """
+
+    def __init__(self, install_path, fire, logger, connector=None):
+        """Args:
+            install_path (str): The ShakeMap install path.
+            fire (function): Runs an event again; called as
+                fire(eventid, reasons, since), where since is the time
+                of the event's alarm, returning True if it was queued.
+            logger (logger): The logger for this process.
+            connector (Connector): The database connector; if None, one
+                is made from aqms.conf when it is first needed.
+        """
+        self.install_path = install_path
+        self.fire = fire
+        self.logger = logger
+        self._connector = connector
+        self._events = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def connector(self):
+        if self._connector is None:
+            from shakemap_aqms.db import Connector, get_db_health
+            self._connector = Connector(get_aqms_config(), self.logger,
+                                        get_db_health(self.install_path))
+        return self._connector
+
+    def __len__(self):
+        return len(self._events)
+
+    def watch(self, event, started=None):
+        """Start watching an event, or, if it is already watched, take
+        its current amps as those of its last run.
+
+        Args:
+            event (dict): The event, as returned by get_eqinfo().
+            started (float): The time of the event's alarm; the default
+                is now.
+        """
+        with self._lock:
+            watched = self._events.get(event['id'])
+            if watched is None:
+                if started is None:
+                    started = time.time()
+                self._events[event['id']] = WatchedEvent(event, started)
+            else:
+                watched.restart()
+
+    def unwatch(self, eventid):
+        """Stop watching an event (e.g., because it was cancelled).
+        """
+        with self._lock:
+            self._events.pop(eventid, None)
+
+    def query_summary(self, eventids):
+        from shakemap_aqms.amps import query_amp_summary
+        return query_amp_summary(self.connector, eventids, self.logger)
+
+    def query_new(self, eventid, since):
+        from shakemap_aqms.amps import query_new_amps
+        return query_new_amps(self.connector, eventid, since, self.logger)
+
+    def get_coords(self, watched):
+        """Return the coordinates of the stations for an event, from
+        the prefetched data, the station snapshot, or the database.
+        """
+        if watched.stations is not None:
+            return watched.stations
+        from shakemap_aqms.prefetch import read_prefetch
+        prefetched = read_prefetch(self.install_path, watched.eventid,
+                                   float('inf'), self.logger)
+        if prefetched is not None:
+            stadict = prefetched[0]
+        else:
+            from shakemap_aqms.snapshot import load_snapshot
+            from shakemap_aqms.stations import get_station_dict
+            config = get_aqms_config()
+            snapshot = None
+            if config['station_snapshot'] > 0:
+                snapshot = load_snapshot(self.install_path,
+                                         config['station_snapshot'],
+                                         self.logger)
+            if snapshot is not None:
+                stadict = snapshot.stations_at(watched.time)
+            else:
+                stadict = get_station_dict(
+                    self.connector,
+                    watched.time.strftime('%Y/%m/%d %H%M%S'),
+                    config, self.logger)
+        watched.stations = station_coords(stadict)
+        return watched.stations
+
+    def due(self, now, schedule):
+        """Return the events to poll now, forgetting those that are past
+        the end of the schedule.
+        """
+        due = []
+        with self._lock:
+            for eventid, watched in list(self._events.items()):
+                if watched.polls >= len(schedule):
+                    self.logger.info('Stopped watching the amps of event '
+                                     '%s (%d reruns)', eventid,
+                                     watched.reruns,
+                                     extra=kv(event=eventid))
+                    del self._events[eventid]
+                elif watched.summary is None or \
+                        now - watched.started >= schedule[watched.polls]:
+                    due.append(watched)
+        return due
+
+    def poll(self, now=None, config=None):
+        """Poll the events that are due and run again those whose amps
+        have changed materially.
+
+        Args:
+            now (float): The current time; the default is now.
+            config (dict): The aqms_queue configuration; the default is
+                the current one.
+
+        Returns:
+            list: The IDs of the events that were run again.
+        """
+        if now is None:
+            now = time.time()
+        if config is None:
+            config = get_aqms_config('aqms_queue')
+        due = self.due(now, config['watch_schedule'])
+        if not due:
+            return []
+        summary = self.query_summary([watched.eventid for watched in due])
+        if summary is None:
+            return []
+        fired = []
+        for watched in due:
+            current = summary.get(watched.eventid, (0, 0, None))
+            try:
+                if self.poll_event(watched, current, config):
+                    fired.append(watched.eventid)
+            except Exception as err:
+                self.logger.error('Amp watcher poll of event %s failed: %s',
+                                  watched.eventid, err,
+                                  extra=kv(event=watched.eventid))
+        return fired
+
+    def poll_event(self, watched, current, config):
+        """Poll one event, and run it again if its amps have changed
+        materially.
+
+        The poll works on a copy of the event's state, since a re-alarm
+        may restart the event at any time; the copy is saved only if
+        the event hasn't been restarted meanwhile. If the event can't
+        be run again, its state is left as it was, so that the same
+        changes are looked at again at its next poll.
+
+        Args:
+            watched (WatchedEvent): The event.
+            current (tuple): The (nstations, namps, lddate) of its amps
+                now.
+            config (dict): The aqms_queue configuration.
+
+        Returns:
+            bool: True if the event was run again.
+        """
+        with self._lock:
+            state = watched.copy()
+        if state.summary is None:
+            # The amps at the time of the (last) run
+            state.summary = current
+            state.baseline = current[2] or EPOCH
+            self._save(watched, state, ('summary', 'baseline'))
+            return False
+        with self._lock:
+            watched.polls += 1
+        if current == state.summary:
+            return False
+        state.summary = current
+        amps = self.query_new(state.eventid, state.since or EPOCH)
+        if amps is None:
+            return False
+        if amps:
+            state.since = max(amp[3] for amp in amps)
+        if state.known is None:
+            state.known = set(amp[0] for amp in amps
+                              if amp[3] <= state.baseline)
+            amps = [amp for amp in amps if amp[3] > state.baseline]
+        coords = {}
+        if config['watch_near_distance'] > 0:
+            try:
+                coords = self.get_coords(watched)
+            except Exception as err:
+                self.logger.warning("Couldn't get the stations for "
+                                    "event %s: %s", state.eventid,
+                                    err, extra=kv(event=state.eventid))
+        reasons = material_changes(state, amps, coords, config)
+        if not reasons:
+            self._save(watched, state, ('summary', 'since', 'known', 'new'))
+            return False
+        self.logger.info('Amps of event %s have changed: %s',
+                         state.eventid, '; '.join(reasons),
+                         extra=kv(event=state.eventid))
+        if not self.fire(state.eventid, reasons, state.started):
+            return False
+        state.known |= state.new
+        state.new = set()
+        self._save(watched, state, ('summary', 'since', 'known', 'new',
+                                    'high'))
+        with self._lock:
+            watched.reruns += 1
+        return True
+
+    def _save(self, watched, state, names):
+        """Copy the named attributes of a polled state to its event,
+        unless the event has been restarted since the state was copied.
+        """
+        with self._lock:
+            if watched.generation != state.generation:
+                return
+            for name in names:
+                setattr(watched, name, getattr(state, name))
+
+    def run(self):
+        """Poll the events until stopped (the body of the thread).
+        """
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as err:
+                self.logger.error('Amp watcher poll failed: %s', err)
+            self._stop.wait(self.sleep_time())
+
+    def sleep_time(self, now=None):
+        """Return the time until the next event is due to be polled.
+        """
+        if now is None:
+            now = time.time()
+        schedule = get_aqms_config('aqms_queue')['watch_schedule']
+        wait = MAX_SLEEP
+        with self._lock:
+            for watched in self._events.values():
+                if watched.summary is None:
+                    return 0.1
+                if watched.polls < len(schedule):
+                    wait = min(wait, watched.started +
+                               schedule[watched.polls] - now)
+        return max(wait, 0.1)
+
+    def start(self):
+        """Start the watcher thread.
+        """
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the watcher thread.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
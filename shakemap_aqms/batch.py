@@ -0,0 +1,227 @@
+# stdlib imports
+import os
+import os.path
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Third party imports
+import cx_Oracle
+
+# Local imports
+from shakemap_aqms.db import PooledConnector
+from shakemap_aqms.stations import get_channel_epochs, to_timestamp
+from shakemap_aqms.amps import get_amps, locate_amps, write_amps
+
+#
+# Origins selected by evid or by time window/region. AQMS stores origin
+# times as "true" (leap second) epoch times, so the window is padded
+# here and refined with the string form of the time.
+#
+ORIGIN_QUERY = ("SELECT e.evid, TrueTime.getStringf(o.datetime), "
+                "o.lat, o.lon, n.magnitude "
+                "FROM event e, origin o, netmag n "
+                "WHERE e.selectflag = 1 "
+                "AND o.orid = e.prefor "
+                "AND n.magid = e.prefmag ")
+
+TIMEFMT = '%Y/%m/%d %H:%M:%S.%f'
+
+# Maximum number of bind variables in an IN list
+MAX_BINDS = 1000
+
+
+def _parse_time(timestr):
+    return datetime.strptime(timestr, TIMEFMT)
+
+
+def select_events(connector, logger, evids=None, start=None, end=None,
+                  region=None, minmag=None):
+    """Get the origin times of the events to process.
+
+    Args:
+        connector (Connector): The database connector.
+        logger (logger): The logger for this process.
+        evids (list): A list of event IDs; if given, the other
+            selection criteria are ignored.
+        start (datetime): The start of the time window.
+        end (datetime): The end of the time window.
+        region (list): [lonmin, lonmax, latmin, latmax] of the region.
+        minmag (float): The minimum magnitude.
+
+    Returns:
+        list: (evid, datetime, lat, lon, mag) tuples in time order.
+
+    Raises:
+        RuntimeError: If the events could not be retrieved.
+    """
+    queries = []
+    if evids:
+        evids = [int(evid) for evid in evids]
+        for ix in range(0, len(evids), MAX_BINDS):
+            chunk = evids[ix:ix + MAX_BINDS]
+            binds = ', '.join([':%d' % (i + 1) for i in range(len(chunk))])
+            queries.append((ORIGIN_QUERY + 'AND e.evid IN (%s)' % binds,
+                            chunk))
+    else:
+        query = ORIGIN_QUERY + ('AND o.datetime BETWEEN :tstart AND :tend')
+        params = {'tstart': to_timestamp(start) - 60,
+                  'tend': to_timestamp(end) + 60}
+        if region is not None:
+            query += (' AND o.lon BETWEEN :lonmin AND :lonmax'
+                      ' AND o.lat BETWEEN :latmin AND :latmax')
+            params.update(dict(zip(('lonmin', 'lonmax', 'latmin', 'latmax'),
+                                   region)))
+        if minmag is not None:
+            query += ' AND n.magnitude >= :minmag'
+            params['minmag'] = minmag
+        queries.append((query, params))
+
+    for dbname in connector.dbnames():
+        with connector.connect(dbname) as con:
+            if con is None:
+                continue
+            cursor = con.cursor()
+            cursor.arraysize = 1000
+            rows = []
+            try:
+                for query, params in queries:
+                    cursor.execute(query, params)
+                    rows.extend(cursor.fetchall())
+            except cx_Oracle.DatabaseError as err:
+                logger.warn('Error: %s' % err)
+                connector.failed(dbname, err)
+                continue
+            finally:
+                cursor.close()
+        events = []
+        for evid, timestr, lat, lon, mag in rows:
+            evtime = _parse_time(timestr)
+            if not evids and not start <= evtime <= end:
+                continue
+            events.append((str(evid), evtime, lat, lon, mag))
+        return sorted(events, key=lambda x: x[1])
+    raise RuntimeError('Could not retrieve events from database(s)')
+
+
+class BatchProcessor(object):
+    """Regenerate the station data files of many events in one process.
+
+    The database connections, the station metadata (built once for
+    every channel epoch, or taken from the station snapshot) and the
+    adhoc file are shared by all of the events, which are processed by
+    a pool of worker threads.
+    """
+
+    def __init__(self, config, data_path, logger, workers=4, health=None,
+                 snapshot=None):
+        """Create a batch processor.
+
+        Args:
+            config (dict): The AQMS configuration dictionary.
+            data_path (str): The ShakeMap data path.
+            logger (logger): The logger for this process.
+            workers (int): The number of worker threads.
+            health (DBHealth): The database health tracker; by default
+                the process-wide tracker is used.
+            snapshot (StationSnapshot): The station snapshot to use for
+                the station metadata instead of the database.
+        """
+        self.config = config
+        self.data_path = data_path
+        self.logger = logger
+        self.workers = workers
+        self.connector = PooledConnector(config, logger,
+                                         max_sessions=workers + 1,
+                                         health=health)
+        self._epochs = snapshot
+
+    @property
+    def epochs(self):
+        """ChannelEpochs: The station metadata of every channel epoch,
+        retrieved the first time it is needed (or the StationSnapshot
+        given to the constructor).
+        """
+        if self._epochs is None:
+            t1 = time.time()
+            self._epochs = get_channel_epochs(self.connector, self.config,
+                                              self.logger)
+            self.logger.info('Retrieved %d channel epochs in %.1f s' %
+                             (len(self._epochs.keys), time.time() - t1))
+        return self._epochs
+
+    def process_event(self, eventid, evtime, lat, lon, mag, stadict=None):
+        """Write the station data file(s) of one event.
+
+        Args:
+            eventid (str): The event ID.
+            evtime (datetime): The origin time of the event.
+            lat (float): The latitude of the origin.
+            lon (float): The longitude of the origin.
+            mag (float): The magnitude of the event.
+            stadict (dict): The station dictionary for the event's origin
+                time; looked up if not given.
+
+        Returns:
+            list: The paths of the files written.
+        """
+        datadir = os.path.join(self.data_path, eventid, 'current')
+        if not os.path.isdir(datadir):
+            os.makedirs(datadir)
+        if stadict is None:
+            stadict = self.epochs.stations_at(evtime)
+        ampsets = get_amps(self.connector, eventid, stadict, self.config,
+                           self.logger)
+        ampsets = locate_amps(ampsets, lat, lon, mag, self.config,
+                              self.logger)
+        files = write_amps(ampsets, datadir, self.config['columnar_format'],
+                           self.logger)
+        if len(files) == 0:
+            self.logger.warn("No data found for event %s" % eventid)
+        return files
+
+    def run(self, events):
+        """Process a list of events.
+
+        Args:
+            events (list): (evid, datetime, lat, lon, mag) tuples, as
+                returned by select_events().
+
+        Returns:
+            dict: The number of files written for each event ID; events
+            that failed are not included.
+        """
+        #
+        # Look up the station metadata of all of the events at once;
+        # events with the same active epochs share a station dictionary
+        #
+        t1 = time.time()
+        stadicts = self.epochs.stations_at_times([ev[1] for ev in events])
+        self.logger.info('Looked up the stations for %d events (%d '
+                         'distinct sets) in %.1f s' %
+                         (len(events), len(set(map(id, stadicts))),
+                          time.time() - t1))
+        results = {}
+        t1 = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.process_event, *event,
+                                       stadict=stadict):
+                       event[0] for event, stadict in zip(events, stadicts)}
+            for future in as_completed(futures):
+                evid = futures[future]
+                try:
+                    files = future.result()
+                except Exception as err:
+                    self.logger.error('Event %s failed: %s' % (evid, err))
+                    continue
+                results[evid] = len(files)
+                self.logger.info('Event %s: wrote %d file(s)' %
+                                 (evid, len(files)))
+        self.logger.info('Processed %d of %d events in %.1f s' %
+                         (len(results), len(events), time.time() - t1))
+        return results
+
+    def close(self):
+        """Release the database connections.
+        """
+        self.connector.close()
@@ -0,0 +1,67 @@
+"""
+The messages sent to aqms_queue by shake_alarm and shake_cancel: a
+single line, "<action> <eventid> <update>", sent over a TCP connection
+that is then closed.
+"""
+
+# stdlib imports
+import socket
+
+ACTIONS = ('shake_alarm', 'shake_cancel')
+
+# The most that aqms_queue reads from a connection
+MAX_SIZE = 4096
+
+
+def format_message(action, eventid, update=0):
+    """Make the message for an alarm or cancel.
+
+    Args:
+        action (str): 'shake_alarm' or 'shake_cancel'.
+        eventid (str): The event ID.
+        update (int): The update number.
+
+    Returns:
+        bytes: The encoded message.
+    """
+    return ('%s %s %s' % (action, eventid, update)).encode('utf-8')
+
+
+def parse_message(data):
+    """Decode a message received by aqms_queue.
+
+    Args:
+        data (bytes): The message.
+
+    Returns:
+        tuple: (action, eventid, update); the update is '0' if the client
+        left it off.
+
+    Raises:
+        ValueError: If the message doesn't have an action and an event ID.
+    """
+    fields = data.decode('utf-8').split(maxsplit=2)
+    if len(fields) < 2:
+        raise ValueError('Malformed message: %r' % data[:80])
+    if len(fields) == 2:
+        fields.append('0')
+    return tuple(fields)
+
+
+def send_message(action, eventid, update=0, remote='localhost', port=2345,
+                 timeout=10):
+    """Send an alarm or cancel to aqms_queue.
+
+    Args:
+        action (str): 'shake_alarm' or 'shake_cancel'.
+        eventid (str): The event ID.
+        update (int): The update number.
+        remote (str): The host running aqms_queue.
+        port (int): The port aqms_queue listens on.
+        timeout (float): The timeout (s) for the connection.
+
+    Raises:
+        OSError: If the connection is refused or times out.
+    """
+    with socket.create_connection((remote, port), timeout=timeout) as csocket:
+        csocket.sendall(format_message(action, eventid, update))
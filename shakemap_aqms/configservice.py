@@ -0,0 +1,187 @@
+# stdlib imports
+import os
+import os.path
+import logging
+import threading
+from importlib import resources
+
+# Third party imports
+from configobj import ConfigObj
+from validate import Validator
+
+# Local imports
+from shakemap.utils.config import get_config_paths, config_error
+
+
+def get_spec_file(cname):
+    """Return the path to the configspec for the named config.
+
+    Args:
+        cname (str): The name of the config (e.g., 'aqms' or 'aqms_queue').
+
+    Returns:
+        str: The path to <cname>spec.conf in the package's config directory.
+    """
+    spec_path = resources.files('shakemap_aqms').joinpath('config')
+    return os.path.join(str(spec_path), cname + 'spec.conf')
+
+
+class ConfigService(object):
+    """Cache validated configurations and reload them when they change.
+
+    Each config is parsed and validated once, and then served from the
+    cache until the modification time of either the config file or its
+    spec changes. A config that fails to parse or validate on reload is
+    rejected and the last good version continues to be served.
+
+    The ConfigObj objects returned are shared by all callers and should
+    be treated as read-only.
+    """
+
+    def __init__(self, install_path=None):
+        """Create a config service.
+
+        Args:
+            install_path (str): The ShakeMap install path; if None, it
+                is taken from the current ShakeMap profile the first time
+                a config is loaded.
+        """
+        self._install_path = install_path
+        self._lock = threading.RLock()
+        self._cache = {}
+        self._logger = logging.getLogger(__name__)
+
+    def _get_paths(self, cname):
+        if self._install_path is None:
+            self._install_path, _ = get_config_paths()
+        conf_file = os.path.join(self._install_path, 'config',
+                                 cname + '.conf')
+        if not os.path.isfile(conf_file):
+            raise FileNotFoundError('No file "%s" exists.' % conf_file)
+        spec_file = get_spec_file(cname)
+        if not os.path.isfile(spec_file):
+            raise FileNotFoundError('No file "%s" exists.' % spec_file)
+        return conf_file, spec_file
+
+    def _load(self, cname):
+        """Parse and validate a config, returning (config, mtimes).
+
+        Raises:
+            FileNotFoundError: if the config or its spec is not found.
+            RuntimeError: if the config does not validate.
+        """
+        conf_file, spec_file = self._get_paths(cname)
+        mtimes = (os.path.getmtime(conf_file), os.path.getmtime(spec_file))
+        config = ConfigObj(conf_file, configspec=spec_file)
+
+        val = Validator()
+        results = config.validate(val)
+        if not isinstance(results, bool) or not results:
+            try:
+                config_error(config, results)
+            except RuntimeError as err:
+                logging.error('Error in {0}.conf: {1}'.format(cname, err))
+                raise
+        return config, mtimes
+
+    def _mtimes(self, cname):
+        try:
+            conf_file, spec_file = self._get_paths(cname)
+            return (os.path.getmtime(conf_file),
+                    os.path.getmtime(spec_file))
+        except (FileNotFoundError, OSError):
+            return None
+
+    def get(self, cname='aqms'):
+        """Return the validated config, reloading it if it has changed.
+
+        Args:
+            cname (str): The name of the config (without the '.conf').
+
+        Returns:
+            ConfigObj: The validated config.
+
+        Raises:
+            FileNotFoundError: if the config or spec is not found and
+                there is no previously loaded config to fall back on.
+            RuntimeError: if the config does not validate and there is
+                no previously loaded config to fall back on.
+        """
+        with self._lock:
+            if cname in self._cache:
+                config, mtimes = self._cache[cname]
+                if self._mtimes(cname) in (mtimes, None):
+                    return config
+            self._reload(cname)
+            return self._cache[cname][0]
+
+    def _reload(self, cname):
+        """Reload a config, keeping the last good version on failure.
+
+        Returns:
+            bool: True if a new config was loaded, False otherwise.
+        """
+        try:
+            self._cache[cname] = self._load(cname)
+        except (FileNotFoundError, RuntimeError, SyntaxError) as err:
+            if cname not in self._cache:
+                raise
+            self._logger.error('Rejected new %s.conf, keeping the last '
+                               'good config: %s' % (cname, err))
+            # Don't keep trying to load the bad file on every call
+            mtimes = self._mtimes(cname)
+            if mtimes is not None:
+                self._cache[cname] = (self._cache[cname][0], mtimes)
+            return False
+        self._logger.info('Loaded %s.conf' % cname)
+        return True
+
+    def reload(self, cname=None):
+        """Force a reload of one or all of the cached configs.
+
+        Args:
+            cname (str): The config to reload; if None, all of the
+                configs that have been loaded are reloaded.
+
+        Returns:
+            list: The names of the configs that were successfully
+            reloaded.
+        """
+        with self._lock:
+            if cname is None:
+                names = list(self._cache.keys())
+            else:
+                names = [cname]
+            return [name for name in names if self._reload(name)]
+
+    def check(self):
+        """Reload any cached configs whose files have changed.
+
+        This is intended to be called periodically by long-running
+        processes.
+
+        Returns:
+            list: The names of the configs that were successfully
+            reloaded.
+        """
+        with self._lock:
+            changed = [name for name, (_, mtimes) in self._cache.items()
+                       if self._mtimes(name) not in (mtimes, None)]
+            return [name for name in changed if self._reload(name)]
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_config_service():
+    """Return the process-wide ConfigService instance.
+
+    Returns:
+        ConfigService: The shared config service.
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = ConfigService()
+        return _service
@@ -3,14 +3,15 @@ import os
 import os.path
 
 # Third party imports
-import cx_Oracle
-import pandas as pd
+# (the modules that need cx_Oracle and pandas are imported in
+# execute() so that loading the coremods, which shake does on every
+# run, stays cheap)
 
 # local imports
 from shakemap.coremods.base import CoreModule
 from shakemap.utils.config import get_config_paths
 from shakemap_aqms.util import get_aqms_config
-from shakemap_aqms.util import dataframe_to_xml
+from shakemap_aqms.profiling import profiled
 from shakelib.rupture.origin import Origin
 
 
@@ -22,6 +23,7 @@ class AQMSDb2XMLModule(CoreModule):
 
     command_name = 'aqms_db2xml'
 
+    @profiled
     def execute(self):
         """
         Get amps from the database(s) and write the XML file(s) to the
@@ -32,6 +34,13 @@ class AQMSDb2XMLModule(CoreModule):
             FileNotFoundError: When the the shake_result HDF file does not
                 exist.
         """
+        from shakemap_aqms.db import Connector, get_db_health
+        from shakemap_aqms.stations import get_station_dict
+        from shakemap_aqms.amps import get_amps, locate_amps, write_amps
+        from shakemap_aqms.snapshot import load_snapshot
+        from shakemap_aqms.prefetch import read_prefetch
+        from shakemap_aqms.tracing import get_trace_store
+
         install_path, data_path = get_config_paths()
         datadir = os.path.join(data_path, self._eventid, 'current')
         if not os.path.isdir(datadir):
@@ -47,309 +56,62 @@ class AQMSDb2XMLModule(CoreModule):
 
         evtime = origin.time.strftime('%Y/%m/%d %H%M%S')
 
-        success = False
-        for dbname in sorted(config['dbs'].keys()):
-            db = config['dbs'][dbname]
-            dsn_tns = cx_Oracle.makedsn(db['host'], db['port'],
-                                        sid=db['sid'])
-            try:
-                con = cx_Oracle.connect(user=db['user'],
-                                        password=db['password'],
-                                        dsn=dsn_tns)
-            except cx_Oracle.DatabaseError as err:
-                self.logger.warn('Error connecting to database: %s' % dbname)
-                self.logger.warn('Error: %s' % err)
-                continue
-            cursor = con.cursor()
-
-            query = ("SELECT d.description, c.net, c.sta, c.seedchan, "
-                     "c.location, c.lat, c.lon, c.elev, s.staname "
-                     "FROM channel_data c, station_data s, "
-                     "d_abbreviation d "
-                     "WHERE TO_DATE(:evtime, 'YYYY/MM/DD HH24MISS') BETWEEN "
-                     "c.ondate AND c.offdate "
-                     "AND c.net = s.net AND c.sta = s.sta "
-                     "AND s.net_id = d.id")
-            try:
-                cursor.execute(query, {'evtime': evtime})
-            except cx_Oracle.DatabaseError as err:
-                self.logger.warn('Error: %s' % err)
-                cursor.close()
-                con.close()
-                continue
-            stadict = {}
-            nlines = 0
-            for line in cursor:
-                nlines += 1
-                desc, net, sta, chan, loc, lat, lon, elev, staname = line
-                loc = loc.replace(' ', '-')
-                netsta = net + '.' + sta
-                if staname is None:
-                    print("staname for %s.%s is empty - skipping"%(net, sta))
-                    continue
-                if ' - ' in staname:
-                    staname, staloc = staname.split(' - ', maxsplit=1)
-                else:
-                    staloc = ''
-                cdict = {'netdesc': desc, 'net': net, 'sta': sta,
-                         'lon': lon, 'lat': lat, 'elev': elev,
-                         'staname': staname, 'staloc': staloc}
-                if netsta not in stadict:
-                    stadict[netsta] = {loc: {chan: cdict}}
-                    continue
-                if loc not in stadict[netsta]:
-                    stadict[netsta][loc] = {chan: cdict}
-                    continue
-                stadict[netsta][loc][chan] = cdict
-            if nlines > 0:
-                success = True
-                break
-        if not success:
-            raise RuntimeError('Could not retrieve stations from database(s)')
+        connector = Connector(config, self.logger,
+                              get_db_health(install_path))
 
         #
-        # Here we're assuming that the last connection and cursor
-        # are still valid and the database has the station information
+        # Add our spans to the event's trace (started by aqms_queue)
         #
-        # The stamapping table may not exist on some databases, so
-        # we're going to ignore errors.
-        #
-        stalocdescr = {}
-        try:
-            cursor.execute('select sta, net, locdescr from stamapping')
-        except cx_Oracle.DatabaseError as err:
-            self.logger.warn('Warning: couldnt retrieve stamapping: %s' % err)
-        else:
-            for line in cursor:
-                sta, net, locdescr = line
-                if net not in stalocdescr:
-                    stalocdescr[net] = {sta: locdescr}
-                    continue
-                stalocdescr[net][sta] = locdescr
+        tracer = get_trace_store(install_path, config, self.logger)
+        trace_id = tracer.event_trace(self._eventid)
 
         #
-        # Now read the adhoc file and add the "table 6" values to
-        # any stations/channels that are listed, also add any
-        # unlisted stations to stadict
+        # Use the station metadata and amps that aqms_queue fetched
+        # when it got the alarm, if they are recent enough
         #
-        netcode = {}
-        if config['adhoc_file'] and os.path.isfile(config['adhoc_file']):
-            widths = [6, 3, 4, 3, 4, 10, 11, 6, 60]
-            columns = ['sta', 'net', 'chan', 'loc', 't6', 'lat', 'lon',
-                       'elev', 'name']
-            df = pd.read_fwf(config['adhoc_file'], widths=widths,
-                             names=columns)
-            for row in df.itertuples():
-                _, sta, net, chan, loc, t6, lat, lon, elev, name = row
-                net = str(net) # cast to string
-                loc = str(loc) # cast to string
-                netsta = "%s.%s" % (net, sta) # modified concatenation style - GG
-                loc = loc.replace(' ', '-')
-                try:
-                    stadict[netsta][loc][chan]['t6'] = t6
-                    continue
-                except KeyError:
-                    pass
-                name = str(name)  # cast to string
-                if ' - ' in name:
-                    nn, desc = name.split(' - ', maxsplit=1)
-                else:
-                    nn = name
-                    desc = ''
-                cdict = {'staloc': desc, 'net': net, 'sta': sta,
-                         'lon': lon, 'lat': lat, 'elev': elev,
-                         'staname': nn, 't6': t6}
-                if net in netcode:
-                    cdict['netdesc'] = netcode[net]
-                else:
-                    try:
-                        cursor.execute('select d.description '
-                                       'from d_abbreviation d, station_data s '
-                                       'where s.net = :net '
-                                       'and s.net_id = d.id', {'net': net})
-                    except cx_Oracle.DatabaseError as err:
-                        self.logger.warn(
-                                'Error retrieving net description: %s' % err)
-                        netdesc = ['Unknown']
-                    else:
-                        netdesc = cursor.fetchone()
-                        if not netdesc:
-                            netdesc = ['Unknown']
-                    netcode[net] = netdesc[0]
-                    cdict['netdesc'] = netcode[net]
-                if netsta not in stadict:
-                    stadict[netsta] = {loc: {chan: cdict}}
-                    continue
-                if loc not in stadict[netsta]:
-                    stadict[netsta][loc] = {chan: cdict}
-                    continue
-                stadict[netsta][loc][chan] = cdict
-        elif config['adhoc_file']:
-            self.logger.warn('Warning: adhoc_file %s does not exist' %
-                             config['adhoc_file'])
+        prefetched = None
+        if config['prefetch_max_age'] > 0:
+            prefetched = read_prefetch(install_path, self._eventid,
+                                       config['prefetch_max_age'],
+                                       self.logger)
 
         #
-        # Get the station location strings if possible; if it is just
-        # a (possibly truncated copy of the station name, leave it blank
+        # Get the station metadata, with the adhoc file and
+        # stamapping applied, from the shared snapshot if there is
+        # a recent one, otherwise from the database
         #
-        for netsta in stadict.keys():
-            net, sta = netsta.split('.', maxsplit=1)
-            try:
-                staloc = stalocdescr[net][sta]
-            except KeyError:
-                staloc = ''
-            for loc in stadict[netsta].keys():
-                for chan in stadict[netsta][loc].keys():
-                    if stadict[netsta][loc][chan]['staloc']:
-                        continue
-                    staname = stadict[netsta][loc][chan]['staname']
-                    if staloc and staloc not in staname:
-                        stadict[netsta][loc][chan]['staloc'] = staloc
-
-        cursor.close()
-        con.close()
+        with tracer.span(trace_id, 'db2xml_stations'):
+            snapshot = None
+            if prefetched is None and config['station_snapshot'] > 0:
+                snapshot = load_snapshot(install_path,
+                                         config['station_snapshot'],
+                                         self.logger)
+            if prefetched is not None:
+                stadict = prefetched[0]
+            elif snapshot is not None:
+                stadict = snapshot.stations_at(origin.time)
+            else:
+                stadict = get_station_dict(connector, evtime, config,
+                                           self.logger)
 
         #
-        # Now get the amps and match them up with the station info
-        # and write the XML
+        # Now get the amps and match them up with the station info,
+        # add the distances (dropping far-off stations), and write
+        # the XML
         #
-        qm2 = {}
-        files_written = 0
-        columns = ('station', 'channel', 'imt', 'value', 'lat',
-                   'lon', 'netid', 'flag', 'name', 'loc', 'source')
-        for dbname in sorted(config['dbs'].keys()):
-            db = config['dbs'][dbname]
-            dsn_tns = cx_Oracle.makedsn(db['host'], db['port'],
-                                        sid=db['sid'])
-            try:
-                con = cx_Oracle.connect(user=db['user'],
-                                        password=db['password'],
-                                        dsn=dsn_tns)
-            except cx_Oracle.DatabaseError as err:
-                self.logger.warn('Error connecting to database: %s' % dbname)
-                self.logger.warn('Error: %s' % err)
-                continue
-            cursor = con.cursor()
-
-            query = ("WITH q1 AS ("
-                     "SELECT a.net, a.sta, a.seedchan, a.location, "
-                     "a.amplitude, a.amptype, a.cflag, a.quality, "
-                     "a.units, a.lddate "
-                     "FROM amp a, assocevampset asoc, ampset s "
-                     "WHERE asoc.evid   = :evid "
-                     "AND asoc.ampsetid = s.ampsetid AND asoc.isvalid = 1 "
-                     "AND asoc.ampsettype = 'sm' "
-                     "AND s.ampid  = a.ampid "
-                     "AND a.amptype IN ('PGA', 'PGV', 'SP.3', 'SP1.0', "
-                     "'SP3.0') "
-                     "ORDER BY a.net, a.sta, a.seedchan, a.location, "
-                     "a.amptype, a.lddate desc "
-                     ") "
-                     "SELECT UNIQUE net, sta, seedchan, location, "
-                     "amplitude, amptype, cflag, quality, units "
-                     "FROM q1 "
-                     "ORDER BY net, sta, seedchan, location, amptype")
-
-            try:
-                cursor.execute(query, {'evid': self._eventid})
-            except cx_Oracle.DatabaseError as err:
-                self.logger.warn('Error: amp query failed: %s' % err)
-                continue
-
-            ampdata = {}
-            amprows = []
-            for row in cursor:
-                (net, sta, chan, loc, amp, amptype, cflag, quality,
-                 units) = row
-                loc = loc.replace(' ', '-')
-                netsta = net + '.' + sta
-                try:
-                    sd = stadict[netsta][loc][chan]
-                except KeyError:
-                    # Can't get station info for some reason
-                    continue
-                # Skip amps with unknown or disqualifying Cosmos Site Codes
-                # unless no adhod file was provided, then trust everything
-                if config['adhoc_file']:
-                    if 't6' not in sd:
-                        continue
-                    if int(sd['t6']) not in config['valid_codes']:
-                        continue
-                if quality < 0.5:
-                    continue
-                if netsta not in ampdata:
-                    ampdata[netsta] = {loc: {chan: {'n_amps_on_scale': 0}}}
-                elif loc not in ampdata[netsta]:
-                    ampdata[netsta][loc] = {chan: {'n_amps_on_scale': 0}}
-                elif chan not in ampdata[netsta][loc]:
-                    ampdata[netsta][loc][chan] = {'n_amps_on_scale': 0}
-                # Use only the most recently loaded amp, which are returned
-                # in descending order of lddate.
-                if amptype.upper() in ampdata[netsta][loc][chan]:
-                    continue
-                ampdata[netsta][loc][chan][amptype.upper()] = True
-                # CISN flag values are:
-                #   BN  ->  below noise
-                #   OS  ->  on scale
-                #   CL  ->  clipped
-                # Quality values are:
-                #   1.0 ->  complete time window
-                #   0.5 ->  partial time window, approved for use by analyst
-                #   0.0 ->  incomplete time window
-                if 'os' in cflag or 'OS' in cflag:
-                    ampdata[netsta][loc][chan]['n_amps_on_scale'] += 1
-                    cflag = 0
-                else:
-                    cflag = 1
-                if amptype == 'PGA' or amptype == 'PGV':
-                    imt = amptype.lower()
-                elif amptype == 'SP.3':
-                    imt = 'psa03'
-                elif amptype == 'SP1.0':
-                    imt = 'psa10'
-                elif amptype == 'SP3.0':
-                    imt = 'psa30'
-                if units == 'cmss':
-                    amp = amp / 9.81
-                newrow = (netsta, chan, imt, amp, sd['lat'], sd['lon'],
-                          net, cflag, sd['staname'], sd['staloc'],
-                          sd['netdesc'])
-                amprows.append(newrow)
-            cursor.close()
-            con.close()
-            #
-            # Create a pandas dataframe then (possibly) write the data
-            # to an XML file
-            #
-            if len(amprows) == 0:
-                continue
-            df = pd.DataFrame.from_records(amprows, columns=columns,
-                                           coerce_float=True)
-            xmlfile = os.path.join(datadir, dbname + '_dat.xml')
-            nstas = len(set(df['station']))
-            if config['query_mode'] == 3:
-                dataframe_to_xml(df, xmlfile)
-                files_written += 1
-                continue
-            elif config['query_mode'] == 1 and \
-                    nstas >= config['query_min_stas']:
-                dataframe_to_xml(df, xmlfile)
-                files_written += 1
-                break
-            elif config['query_mode'] == 2:
-                qm2[dbname] = {'nstas': nstas, 'df': df}
-        # End of db loop
-        if config['query_mode'] == 2:
-            smax = 0
-            for dbname, dbinfo in qm2:
-                if qm2['nstas'] > smax:
-                    smax = qm2['nstas']
-                    dbmax = dbname
-            if smax > 0:
-                xmlfile = os.path.join(datadir, dbmax + '_dat.xml')
-                dataframe_to_xml(qm2[dbmax]['df'], xmlfile)
-                files_written += 1
-        if files_written == 0:
+        with tracer.span(trace_id, 'db2xml_amps'):
+            if prefetched is not None and len(prefetched[1]) > 0:
+                ampsets = prefetched[1]
+            else:
+                ampsets = get_amps(connector, self._eventid, stadict,
+                                   config, self.logger)
+            ampsets = locate_amps(ampsets, origin.lat, origin.lon,
+                                  origin.mag, config, self.logger)
+        with tracer.span(trace_id, 'db2xml_write'):
+            files_written = write_amps(ampsets, datadir,
+                                       config['columnar_format'],
+                                       self.logger)
+        if len(files_written) == 0:
             self.logger.warn("No data found for event %s" % self._eventid)
 
         return
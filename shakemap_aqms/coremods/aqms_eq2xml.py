@@ -7,7 +7,8 @@ import os.path
 # local imports
 from shakemap.coremods.base import CoreModule
 from shakemap.utils.config import get_config_paths
-from shakemap_aqms.util import get_aqms_config, get_eqinfo
+from shakemap_aqms.util import get_aqms_config
+from shakemap_aqms.profiling import profiled
 from shakelib.rupture.origin import write_event_file
 
 
@@ -19,10 +20,15 @@ class AQMSEq2XMLModule(CoreModule):
 
     command_name = 'aqms_eq2xml'
 
+    @profiled
     def execute(self):
         """
         Write event.xml to the event's current directory
         """
+        from shakemap_aqms.db import Connector, get_db_health
+        from shakemap_aqms.eqinfo import get_eqinfo
+        from shakemap_aqms.tracing import get_trace_store
+
         install_path, data_path = get_config_paths()
         datadir = os.path.join(data_path, self._eventid, 'current')
         if not os.path.isdir(datadir):
@@ -31,8 +37,18 @@ class AQMSEq2XMLModule(CoreModule):
 
         config = get_aqms_config()
 
-        event = get_eqinfo(self._eventid, config, self.logger)
+        #
+        # Add our spans to the event's trace (started by aqms_queue)
+        #
+        tracer = get_trace_store(install_path, config, self.logger)
+        trace_id = tracer.event_trace(self._eventid)
+
+        connector = Connector(config, self.logger,
+                              get_db_health(install_path))
+        with tracer.span(trace_id, 'eq2xml_lookup'):
+            event = get_eqinfo(self._eventid, config, self.logger, connector)
 
 #        outfile = open(datafile, 'w')  
         # SEND FILEPATH TO WRITE TO STRAIGHT TO METHOD, LET THE FILE HANDLING BE DONE DOWNSTREAM - GG      
-        write_event_file(event, datafile)
+        with tracer.span(trace_id, 'eq2xml_write'):
+            write_event_file(event, datafile)
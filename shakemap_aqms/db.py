@@ -0,0 +1,533 @@
+# stdlib imports
+import copy
+import os
+import os.path
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Third party imports
+import cx_Oracle
+
+HEALTH_FILE = 'aqms_dbhealth.json'
+
+# Oracle errors that mean the database (or the network path to it) is
+# unhealthy, as opposed to errors in a particular query
+CONNECTION_ERRORS = (1012, 1033, 1034, 1089, 1090, 3113, 3114, 3135,
+                     12170, 12514, 12516, 12519, 12520, 12528, 12537,
+                     12541, 12543, 12545, 12547, 12560, 12571)
+CONNECTION_DPI_ERRORS = ('DPI-1067', 'DPI-1080')
+
+# Weight of the newest sample in the latency moving average
+LATENCY_ALPHA = 0.3
+
+# The latency moving average is written to the shared state file when it
+# has changed by more than this fraction since it was last written
+LATENCY_SAVE_CHANGE = 0.2
+
+
+def make_dsn(db, connect_timeout=0):
+    """Make the DSN for one of the databases in aqms.conf.
+
+    Args:
+        db (dict): A subsection of the [dbs] section of aqms.conf.
+        connect_timeout (int): The connect timeout in seconds; if 0,
+            the Oracle client's default is used.
+
+    Returns:
+        str: The DSN.
+    """
+    if connect_timeout <= 0:
+        return cx_Oracle.makedsn(db['host'], db['port'], sid=db['sid'])
+    return ('(DESCRIPTION=(CONNECT_TIMEOUT=%d)'
+            '(TRANSPORT_CONNECT_TIMEOUT=%d)'
+            '(ADDRESS=(PROTOCOL=TCP)(HOST=%s)(PORT=%d))'
+            '(CONNECT_DATA=(SID=%s)))' %
+            (connect_timeout, connect_timeout, db['host'], db['port'],
+             db['sid']))
+
+
+def is_connection_error(err):
+    """Decide whether a database error is a sign of an unhealthy
+    database rather than a problem with a particular query.
+
+    Args:
+        err (cx_Oracle.DatabaseError): The error.
+
+    Returns:
+        bool: True if the error indicates an unhealthy database.
+    """
+    error = err.args[0] if err.args else None
+    code = getattr(error, 'code', None)
+    message = getattr(error, 'message', str(error))
+    if code in CONNECTION_ERRORS:
+        return True
+    return message.startswith(CONNECTION_DPI_ERRORS)
+
+
+class DBHealth(object):
+    """Track the health of the databases.
+
+    For each database this keeps the number of consecutive failures and
+    a moving average of the connect latency. After failure_threshold
+    consecutive failures the database's circuit is opened and it is
+    skipped until retry_interval seconds have passed. The circuit is
+    then half open: the next caller is let through to try the database,
+    and for everyone else it stays open for another retry_interval. A
+    success closes the circuit; a failure opens it again.
+
+    If a state file is given, the state is shared with other processes
+    (e.g., the shake runs started by sm_queue) through it. To spare a
+    write on every connection, the latency average is written only when
+    it has changed by more than LATENCY_SAVE_CHANGE; a process keeps its
+    own unwritten average when it reads the file. Two processes that
+    read the file at the same moment may both try a half-open database.
+    """
+
+    def __init__(self, state_file=None):
+        """Create a health tracker.
+
+        Args:
+            state_file (str): The path to the shared state file, or None.
+        """
+        self.state_file = state_file
+        self._state = {}
+        self._saved = {}
+        self._mtime = None
+        self._lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        if self.state_file is None:
+            return
+        try:
+            mtime = os.path.getmtime(self.state_file)
+            if mtime == self._mtime:
+                return
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        saved = copy.deepcopy(state)
+        #
+        # Keep the databases and latencies this process hasn't written
+        #
+        for dbname, local in self._state.items():
+            if dbname not in state:
+                state[dbname] = local
+            elif local['latency'] != \
+                    self._saved.get(dbname, {}).get('latency'):
+                state[dbname]['latency'] = local['latency']
+        self._state = state
+        self._saved = saved
+        self._mtime = mtime
+
+    def _save(self):
+        self._saved = copy.deepcopy(self._state)
+        if self.state_file is None:
+            return
+        tmpfile = '%s.%d' % (self.state_file, os.getpid())
+        try:
+            with open(tmpfile, 'w') as f:
+                json.dump(self._state, f)
+            os.replace(tmpfile, self.state_file)
+            self._mtime = os.path.getmtime(self.state_file)
+        except OSError:
+            pass
+
+    def _get(self, dbname):
+        if dbname not in self._state:
+            self._state[dbname] = {'failures': 0, 'latency': None,
+                                   'open_until': 0, 'last_failure': 0,
+                                   'retry_interval': 0}
+        return self._state[dbname]
+
+    def _latency_changed(self, dbname):
+        saved = self._saved.get(dbname, {}).get('latency')
+        latency = self._state[dbname]['latency']
+        return saved is None or \
+            abs(latency - saved) > LATENCY_SAVE_CHANGE * saved
+
+    def record_success(self, dbname, latency):
+        """Record a successful connection.
+
+        Args:
+            dbname (str): The name of the database.
+            latency (float): The time it took to connect (seconds).
+        """
+        with self._lock:
+            self._load()
+            state = self._get(dbname)
+            was_open = state['open_until'] > 0
+            state['failures'] = 0
+            state['open_until'] = 0
+            if state['latency'] is None:
+                state['latency'] = latency
+            else:
+                state['latency'] = (LATENCY_ALPHA * latency +
+                                    (1 - LATENCY_ALPHA) * state['latency'])
+            # The latency alone isn't worth a write on every success
+            if was_open or dbname not in self._saved or \
+                    self._latency_changed(dbname):
+                self._save()
+            return was_open
+
+    def record_failure(self, dbname, failure_threshold, retry_interval):
+        """Record a failure, opening the database's circuit if there
+        have been too many in a row.
+
+        Args:
+            dbname (str): The name of the database.
+            failure_threshold (int): The number of consecutive failures
+                that opens the circuit.
+            retry_interval (float): The time (seconds) for which the
+                circuit stays open.
+
+        Returns:
+            bool: True if the circuit is now open.
+        """
+        with self._lock:
+            self._load()
+            state = self._get(dbname)
+            state['failures'] += 1
+            state['last_failure'] = time.time()
+            if state['failures'] >= failure_threshold:
+                state['open_until'] = time.time() + retry_interval
+                state['retry_interval'] = retry_interval
+            self._save()
+            return state['open_until'] > 0
+
+    def is_open(self, dbname):
+        """Return True if the database's circuit is open, i.e., it
+        should be skipped. If the circuit is half open, False is
+        returned to this caller only, which should then try the
+        database.
+        """
+        with self._lock:
+            self._load()
+            state = self._state.get(dbname)
+            if state is None or state['open_until'] == 0:
+                return False
+            now = time.time()
+            if state['open_until'] > now:
+                return True
+            state['open_until'] = now + state.get('retry_interval', 0)
+            self._save()
+            return False
+
+    def open_circuits(self):
+        """Return the names of the databases with open circuits.
+        """
+        with self._lock:
+            self._load()
+            return [dbname for dbname, state in self._state.items()
+                    if state['open_until'] > 0]
+
+    def latency(self, dbname):
+        """Return the moving average of the connect latency of a
+        database, or None if it is unknown.
+        """
+        with self._lock:
+            state = self._state.get(dbname)
+            return None if state is None else state['latency']
+
+    def order(self, dbnames, by_latency=False):
+        """Order the databases in which they should be tried.
+
+        Databases with open circuits are dropped, unless all of them are
+        open, in which case they are all tried, starting with the one
+        that failed least recently.
+
+        Args:
+            dbnames (list): The names of the databases in their
+                configured order.
+            by_latency (bool): Order the available databases by their
+                latency (those with unknown latency first, in their
+                configured order) rather than the configured order.
+
+        Returns:
+            list: The database names.
+        """
+        with self._lock:
+            self._load()
+            available = [dbname for dbname in dbnames
+                         if not self.is_open(dbname)]
+            if not available:
+                return sorted(dbnames,
+                              key=lambda x: self._get(x)['last_failure'])
+            if by_latency:
+                def key(dbname):
+                    latency = self.latency(dbname)
+                    return (latency is not None, latency or 0)
+                available = sorted(available, key=key)
+            return available
+
+
+_health = None
+_health_lock = threading.Lock()
+
+
+def get_db_health(install_path=None):
+    """Return the process-wide DBHealth instance.
+
+    Args:
+        install_path (str): The ShakeMap install path; the first time
+            this is given the health state is shared through a file in
+            <install_path>/data.
+
+    Returns:
+        DBHealth: The health tracker.
+    """
+    global _health
+    with _health_lock:
+        if _health is None:
+            _health = DBHealth()
+        if install_path is not None and _health.state_file is None:
+            datadir = os.path.join(install_path, 'data')
+            if os.path.isdir(datadir):
+                _health.state_file = os.path.join(datadir, HEALTH_FILE)
+                _health._load()
+        return _health
+
+
+#
+# The number of database connections handed out by Connector.connect()
+# and not yet given back, and the number handed out in all, for the
+# daemon's telemetry (see shakemap_aqms.telemetry)
+#
+_connections = {'open': 0, 'total': 0}
+_connections_lock = threading.Lock()
+
+
+def _count_connection(change):
+    with _connections_lock:
+        _connections['open'] += change
+        if change > 0:
+            _connections['total'] += change
+
+
+def connection_counts():
+    """Return the number of database connections in use, and the
+    number made since the process started.
+
+    Returns:
+        dict: 'open' and 'total'.
+    """
+    with _connections_lock:
+        return dict(_connections)
+
+
+class Connector(object):
+    """Open connections to the databases configured in aqms.conf.
+
+    A new connection is made for each call to connect(), and it is
+    closed when the caller is done with it. The databases are offered
+    in an order that skips those that are known to be down.
+    """
+
+    def __init__(self, config, logger, health=None):
+        """Create a connector.
+
+        Args:
+            config (dict): The AQMS configuration dictionary.
+            logger (logger): The logger for this process.
+            health (DBHealth): The health tracker; by default the
+                process-wide tracker is used.
+        """
+        self.config = config
+        self.logger = logger
+        if health is None:
+            health = get_db_health()
+        self.health = health
+
+    def dbnames(self):
+        """Return the names of the databases in the order in which
+        they should be tried.
+
+        Returns:
+            list: The database names.
+        """
+        dbnames = sorted(self.config['dbs'].keys())
+        ordered = self.health.order(
+            dbnames, by_latency=self.config['db_order'] == 'latency')
+        for dbname in dbnames:
+            if dbname not in ordered:
+                self.logger.info('Skipping database %s: it is marked down'
+                                 % dbname)
+        return ordered
+
+    def _open(self, dbname):
+        db = self.config['dbs'][dbname]
+        return cx_Oracle.connect(
+            user=db['user'], password=db['password'],
+            dsn=make_dsn(db, self.config['connect_timeout']))
+
+    def _release(self, dbname, con):
+        con.close()
+
+    def failed(self, dbname, err):
+        """Record an error from a query, if it indicates that the
+        database is unhealthy.
+
+        Args:
+            dbname (str): The name of the database.
+            err (cx_Oracle.DatabaseError): The error.
+        """
+        if not is_connection_error(err):
+            return
+        if self.health.record_failure(dbname,
+                                      self.config['db_failure_threshold'],
+                                      self.config['db_retry_interval']):
+            self.logger.warn('Marking database %s down' % dbname)
+
+    @contextmanager
+    def connect(self, dbname):
+        """Connect to a database.
+
+        Args:
+            dbname (str): The name of the database in aqms.conf.
+
+        Yields:
+            Connection: The connection, or None if it could not be made.
+        """
+        t1 = time.time()
+        try:
+            con = self._open(dbname)
+        except cx_Oracle.DatabaseError as err:
+            self.logger.warn('Error connecting to database: %s' % dbname)
+            self.logger.warn('Error: %s' % err)
+            if self.health.record_failure(
+                    dbname, self.config['db_failure_threshold'],
+                    self.config['db_retry_interval']):
+                self.logger.warn('Marking database %s down' % dbname)
+            con = None
+        else:
+            if self.health.record_success(dbname, time.time() - t1):
+                self.logger.info('Database %s is back up' % dbname)
+            if self.config['call_timeout'] > 0:
+                con.callTimeout = int(self.config['call_timeout'] * 1000)
+            _count_connection(1)
+        try:
+            yield con
+        finally:
+            if con is not None:
+                _count_connection(-1)
+                self._release(dbname, con)
+
+
+class PooledConnector(Connector):
+    """Share connections to the databases among threads.
+
+    A session pool is created for each database the first time it is
+    used, and connections are returned to the pool rather than closed.
+    Call close() when done.
+    """
+
+    def __init__(self, config, logger, max_sessions=4, health=None):
+        """Create a pooled connector.
+
+        Args:
+            config (dict): The AQMS configuration dictionary.
+            logger (logger): The logger for this process.
+            max_sessions (int): The maximum number of connections to
+                each database.
+            health (DBHealth): The health tracker; by default the
+                process-wide tracker is used.
+        """
+        super(PooledConnector, self).__init__(config, logger, health)
+        self.max_sessions = max_sessions
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self, dbname):
+        with self._lock:
+            if dbname not in self._pools:
+                db = self.config['dbs'][dbname]
+                self._pools[dbname] = cx_Oracle.SessionPool(
+                    user=db['user'], password=db['password'],
+                    dsn=make_dsn(db, self.config['connect_timeout']),
+                    min=1, max=self.max_sessions, increment=1,
+                    threaded=True, getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT)
+            return self._pools[dbname]
+
+    def _open(self, dbname):
+        return self._get_pool(dbname).acquire()
+
+    def _release(self, dbname, con):
+        self._pools[dbname].release(con)
+
+    def close(self):
+        """Close all of the session pools.
+        """
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools = {}
+
+
+class HealthProber(object):
+    """Periodically probe the databases that are marked down, in a
+    background thread, so that they are put back into use as soon as
+    they recover.
+    """
+
+    def __init__(self, get_config, logger, health=None):
+        """Create a prober.
+
+        Args:
+            get_config (function): A function returning the current AQMS
+                configuration dictionary.
+            logger (logger): The logger for this process.
+            health (DBHealth): The health tracker; by default the
+                process-wide tracker is used.
+        """
+        self.get_config = get_config
+        self.logger = logger
+        if health is None:
+            health = get_db_health()
+        self.health = health
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start probing.
+        """
+        self._thread.start()
+
+    def stop(self):
+        """Stop probing.
+        """
+        self._stop.set()
+
+    def probe(self, connector, dbname):
+        """Check whether a database is up.
+
+        Returns:
+            bool: True if the database answered.
+        """
+        with connector.connect(dbname) as con:
+            if con is None:
+                return False
+            cursor = con.cursor()
+            try:
+                cursor.execute('SELECT 1 FROM dual')
+                cursor.fetchall()
+            except cx_Oracle.DatabaseError as err:
+                connector.failed(dbname, err)
+                return False
+            finally:
+                cursor.close()
+        return True
+
+    def _run(self):
+        while True:
+            config = self.get_config()
+            if self._stop.wait(config['db_probe_interval']):
+                return
+            connector = Connector(config, self.logger, self.health)
+            for dbname in self.health.open_circuits():
+                if dbname not in config['dbs']:
+                    continue
+                self.logger.info('Probing database %s' % dbname)
+                self.probe(connector, dbname)
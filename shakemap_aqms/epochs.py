@@ -0,0 +1,215 @@
+# stdlib imports
+import os.path
+
+# Third party imports
+import numpy as np
+
+#
+# The index is an array of int64 keys, one per epoch, that combine the
+# channel's group id (in the high bits) with the epoch's start time (in
+# the low TIME_BITS bits, as seconds after TIME_BASE). Sorting the keys
+# sorts the epochs by channel and then by start time, so one
+# searchsorted() finds, for every channel at once, the last epoch that
+# started at or before a given time.
+#
+TIME_BITS = 36
+TIME_BASE = -(2**35)  # seconds relative to 1970; about the year 881
+TIME_MASK = 2**TIME_BITS - 1
+
+# The maximum number of (time, channel) queries made at once
+MAX_QUERIES = 2000000
+
+# The arrays that make up an index, as saved by EpochIndex.save()
+INDEX_ARRAYS = ('order', 'gid', 'on', 'off', 'keys', 'maxoff', 'start')
+INDEX_PREFIX = 'epochindex_'
+
+
+def _time_offsets(times, round_up=False):
+    """Convert times (seconds since 1970) to offsets from TIME_BASE that
+    fit in TIME_BITS bits.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    if round_up:
+        times = np.ceil(times)
+    else:
+        times = np.floor(times)
+    times = np.nan_to_num(times, nan=0, posinf=TIME_MASK + TIME_BASE,
+                          neginf=TIME_BASE)
+    return np.clip(times - TIME_BASE, 0, TIME_MASK).astype(np.int64)
+
+
+class EpochIndex(object):
+    """An interval index over the epochs of many channels that answers
+    "which epochs are active at time T" in memory.
+
+    The epochs of each channel are kept in sorted arrays (in the manner
+    of an interval tree flattened into arrays): along with the start
+    times, the index keeps the running maximum of the end times, so a
+    lookup only steps back past the last epoch to start before T when
+    a channel has overlapping epochs.
+    """
+
+    def __init__(self, keys, ondates, offdates):
+        """Build the index.
+
+        Args:
+            keys (list): The channel of each epoch; any hashable values
+                (e.g., ('NET.STA', loc, chan) tuples).
+            ondates (array): The start time of each epoch, in seconds
+                since 1970.
+            offdates (array): The end time of each epoch, in seconds
+                since 1970.
+        """
+        ondates = np.asarray(ondates, dtype=np.float64)
+        offdates = np.asarray(offdates, dtype=np.float64)
+        groups = {}
+        gids = np.array([groups.setdefault(key, len(groups))
+                         for key in keys], dtype=np.int64)
+        self.ngroups = len(groups)
+
+        order = np.lexsort((ondates, gids))
+        self.order = order
+        self._gid = gids[order]
+        self._on = ondates[order]
+        self._off = offdates[order]
+        self._keys = (self._gid << TIME_BITS) | _time_offsets(self._on)
+        #
+        # The running maximum of the end times within each channel. The
+        # group id in the high bits keeps the maximum from carrying
+        # over from one channel to the next.
+        #
+        offkeys = (self._gid << TIME_BITS) | \
+            _time_offsets(self._off, round_up=True)
+        maxoff = np.maximum.accumulate(offkeys) if len(order) else offkeys
+        self._maxoff = (maxoff & TIME_MASK) + TIME_BASE
+        self._start = np.searchsorted(self._gid,
+                                      np.arange(self.ngroups,
+                                                dtype=np.int64))
+
+    def __len__(self):
+        return len(self.order)
+
+    def save(self, path):
+        """Save the index as .npy files in a directory.
+
+        Args:
+            path (str): The directory.
+        """
+        for name in INDEX_ARRAYS:
+            attr = 'order' if name == 'order' else '_' + name
+            np.save(os.path.join(path, INDEX_PREFIX + name + '.npy'),
+                    getattr(self, attr))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load an index saved by save().
+
+        Args:
+            path (str): The directory.
+            mmap_mode (str): Passed to numpy.load(); by default the
+                arrays are memory-mapped read-only.
+
+        Returns:
+            EpochIndex: The index.
+
+        Raises:
+            FileNotFoundError: If the directory doesn't hold an index.
+        """
+        index = cls.__new__(cls)
+        for name in INDEX_ARRAYS:
+            attr = 'order' if name == 'order' else '_' + name
+            setattr(index, attr,
+                    np.load(os.path.join(path, INDEX_PREFIX + name + '.npy'),
+                            mmap_mode=mmap_mode))
+        index.ngroups = len(index._start)
+        return index
+
+    def active_many(self, times):
+        """Find the epochs active at each of many times.
+
+        Args:
+            times (array): Times in seconds since 1970.
+
+        Returns:
+            tuple: Two arrays of equal length, (time_index, epoch_index),
+            pairing the index of each time with the (original) index of
+            each epoch active at that time; sorted by time index and
+            then by epoch index.
+        """
+        times = np.asarray(times, dtype=np.float64).ravel()
+        if self.ngroups == 0 or len(times) == 0:
+            return (np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.int64))
+        tix_parts = []
+        eix_parts = []
+        gids = np.arange(self.ngroups, dtype=np.int64)
+        chunk = max(1, MAX_QUERIES // self.ngroups)
+        for first in range(0, len(times), chunk):
+            block = times[first:first + chunk]
+            qtix = np.repeat(np.arange(first, first + len(block)),
+                             self.ngroups)
+            qgid = np.tile(gids, len(block))
+            qts = np.repeat(block, self.ngroups)
+            queries = (qgid << TIME_BITS) | _time_offsets(qts)
+            cur = np.searchsorted(self._keys, queries, side='right') - 1
+            #
+            # Keep the queries whose channel has an epoch that started
+            # before the time, and step back through the channel's
+            # earlier epochs while any of them could still be active
+            #
+            live = cur >= self._start[qgid]
+            cur, qtix, qgid, qts = cur[live], qtix[live], qgid[live], \
+                qts[live]
+            while len(cur):
+                ok = (self._on[cur] <= qts) & (self._off[cur] >= qts)
+                tix_parts.append(qtix[ok])
+                eix_parts.append(self.order[cur[ok]])
+                cur = cur - 1
+                more = cur >= self._start[qgid]
+                more[more] = self._maxoff[cur[more]] >= qts[more]
+                cur, qtix, qgid, qts = cur[more], qtix[more], \
+                    qgid[more], qts[more]
+        tix = np.concatenate(tix_parts) if tix_parts else \
+            np.zeros(0, dtype=np.int64)
+        eix = np.concatenate(eix_parts) if eix_parts else \
+            np.zeros(0, dtype=np.int64)
+        order = np.lexsort((eix, tix))
+        return tix[order], eix[order]
+
+    def active(self, ts):
+        """Find the epochs active at a time.
+
+        Args:
+            ts (float): The time in seconds since 1970.
+
+        Returns:
+            array: The (original) indices of the active epochs, sorted.
+        """
+        return self.active_many([ts])[1]
+
+    def active_sets(self, times):
+        """Find the epochs active at each of many times, sharing the
+        result between times at which the same epochs are active (as is
+        usual for the events of a sequence).
+
+        Args:
+            times (array): Times in seconds since 1970.
+
+        Returns:
+            tuple: (sets, which), where sets is a list of arrays of epoch
+            indices and which gives the index into sets for each time.
+        """
+        times = np.asarray(times, dtype=np.float64).ravel()
+        tix, eix = self.active_many(times)
+        bounds = np.searchsorted(tix, np.arange(len(times) + 1))
+        sets = []
+        seen = {}
+        which = []
+        for ix in range(len(times)):
+            indices = eix[bounds[ix]:bounds[ix + 1]]
+            key = indices.tobytes()
+            if key not in seen:
+                seen[key] = len(sets)
+                sets.append(indices)
+            which.append(seen[key])
+        return sets, which
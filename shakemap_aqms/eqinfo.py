@@ -0,0 +1,530 @@
+# stdlib imports
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+# Third party imports
+import cx_Oracle
+import numpy as np
+
+# Local imports
+from shakelib.rupture import constants  # added by GG
+from shakemap_aqms.db import Connector
+from shakemap_aqms.geocoder import (compass_point, get_geocoder,
+                                    lookup_places)
+from shakemap_aqms.mech import classify_mech, classify_mechs
+
+ORIGIN_SELECT = ('SELECT o.lat, o.lon, n.magnitude, o.depth, '
+                 'TrueTime.getStringf(o.datetime), '
+                 'm.rake1, m.rake2 '
+                 'INTO :lat, :lon, :mag, :depth, :datetime, '
+                 ':rake1, :rake2 '
+                 'FROM netmag n, origin o, event e '
+                 'LEFT OUTER JOIN mec m ON e.prefmec = m.mecid '
+                 'WHERE e.evid = :evid '
+                 'AND e.selectflag = 1 '
+                 'AND o.orid = e.prefor '
+                 'AND n.magid = e.prefmag; ')
+
+PLACE_CALL = ('Wheres.Town(:lat, :lon, 0.0, :dist, :az, :elev, :place); '
+              ':dir := Wheres.Compass_PT(:az); ')
+
+EQINFO_QUERY = 'BEGIN ' + ORIGIN_SELECT + PLACE_CALL + 'END;'
+
+# The event query without the place lookup, for when place names come
+# from the local geocoder (see shakemap_aqms.geocoder)
+EQINFO_ORIGIN_QUERY = 'BEGIN ' + ORIGIN_SELECT + 'END;'
+
+PLACE_QUERY = 'BEGIN ' + PLACE_CALL + 'END;'
+
+# The output variables of EQINFO_ORIGIN_QUERY and PLACE_QUERY
+ORIGIN_VARS = ('lat', 'lon', 'mag', 'depth', 'datetime', 'rake1', 'rake2')
+PLACE_VARS = ('dist', 'az', 'elev', 'place', 'dir')
+
+# The output variables of EQINFO_QUERY
+EQINFO_VARS = ORIGIN_VARS + PLACE_VARS
+
+#
+# The set-based form of EQINFO_QUERY used by get_eqinfo_bulk(): the
+# origins are selected by evid or by time window, and the places are
+# then looked up for all of them in one batch of PL/SQL calls
+#
+BULK_ORIGIN_QUERY = ('SELECT e.evid, o.lat, o.lon, n.magnitude, o.depth, '
+                     'TrueTime.getStringf(o.datetime), m.rake1, m.rake2 '
+                     'FROM netmag n, origin o, event e '
+                     'LEFT OUTER JOIN mec m ON e.prefmec = m.mecid '
+                     'WHERE e.selectflag = 1 '
+                     'AND o.orid = e.prefor '
+                     'AND n.magid = e.prefmag ')
+
+# The columns of BULK_ORIGIN_QUERY (after the evid) are ORIGIN_VARS
+
+# Maximum number of bind variables in an IN list
+MAX_BINDS = 1000
+
+# AQMS origin times are "true" (leap second) epoch times, so time windows
+# are padded by this much (s) and refined with the string form of the time
+TIME_PAD = 60
+
+DATETIME_FMT = '%Y/%m/%d %H:%M:%S.%f'
+
+# The number of recent lookup times kept for each database to set the
+# hedging delay
+LATENCY_SAMPLES = 100
+
+
+class HedgeStats(object):
+    """Keep the recent lookup times of each database, and counts of
+    the hedged lookups, of the databases that answered them, and of the
+    queries that raised an error.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.lookups = 0
+        self.hedged = 0
+        self.wins = {}
+        self.errors = {}
+
+    def add_latency(self, dbname, latency):
+        """Record the time a successful lookup took.
+        """
+        with self._lock:
+            if dbname not in self.latencies:
+                self.latencies[dbname] = deque(maxlen=LATENCY_SAMPLES)
+            self.latencies[dbname].append(latency)
+
+    def delay(self, dbname, config):
+        """Return how long to wait for a database before hedging.
+
+        The delay is the configured percentile of the recent lookup
+        times of the database, but no less than hedge_min_delay;
+        hedge_default_delay is used until there is some history.
+
+        Args:
+            dbname (str): The name of the database.
+            config (dict): The AQMS configuration dictionary.
+
+        Returns:
+            float: The delay in seconds.
+        """
+        with self._lock:
+            samples = list(self.latencies.get(dbname, []))
+        if not samples:
+            return config['hedge_default_delay']
+        return max(np.percentile(samples, config['hedge_percentile']),
+                   config['hedge_min_delay'])
+
+    def add_lookup(self, winner, hedged):
+        """Record the outcome of a lookup.
+        """
+        with self._lock:
+            self.lookups += 1
+            if hedged:
+                self.hedged += 1
+            if winner is not None:
+                self.wins[winner] = self.wins.get(winner, 0) + 1
+
+    def add_error(self, dbname):
+        """Record a query that raised an error.
+        """
+        with self._lock:
+            self.errors[dbname] = self.errors.get(dbname, 0) + 1
+
+    def summary(self):
+        """Return the counts as a dictionary.
+        """
+        with self._lock:
+            return {'lookups': self.lookups, 'hedged': self.hedged,
+                    'hedge_rate': (self.hedged / self.lookups
+                                   if self.lookups else 0.0),
+                    'wins': dict(self.wins), 'errors': dict(self.errors)}
+
+
+# The process-wide hedging statistics
+hedge_stats = HedgeStats()
+
+
+def get_eqinfo(eventid, config, logger, connector=None):
+    """Get a dictionary of event information for the given eventid.
+
+    Args:
+        eventid (str): The event ID.
+        config (dict): The AQMS configuration dictionary.
+        logger (logger): The logger for this process.
+        connector (Connector): The database connector; if None, a new
+            one is made from config.
+
+    Returns:
+        dict: A dictionary containing the following keys:
+
+            - 'id' (str, "9108645")
+            - 'netid' (str, 'ci')
+            - 'network' (str, 'Southern California Seismic Network'')
+            - lat (float)
+            - lon (float)
+            - depth (float)
+            - mag (float)
+            - time (datetime object)
+            - locstring (str)
+            - mech (str)
+    """
+    if connector is None:
+        connector = Connector(config, logger)
+    geocoder = get_geocoder(config, logger)
+    places = geocoder is None
+    dbnames = connector.dbnames()
+    if config['hedge'] and len(dbnames) > 1:
+        result = hedged_query_eqinfo(connector, dbnames, eventid, config,
+                                     logger, places)
+    else:
+        result = None
+        for dbname in dbnames:
+            result = timed_query_eqinfo(connector, dbname, eventid, logger,
+                                        places)
+            if result is not None:
+                break
+    if result is None:
+        logger.warning('Could not retrieve event from database(s)')
+        return None
+    if geocoder is not None:
+        result.update(geocoder.place_info(result['lat'], result['lon']))
+    return make_event(eventid, result, config)
+
+
+def get_eqinfo_bulk(config, logger, evids=None, start=None, end=None,
+                    connector=None):
+    """Get the event information for many events, with a few set-based
+    queries rather than one query per event.
+
+    Args:
+        config (dict): The AQMS configuration dictionary.
+        logger (logger): The logger for this process.
+        evids (list): The event IDs; if given, start and end are ignored.
+        start (datetime): The start of the time window.
+        end (datetime): The end of the time window.
+        connector (Connector): The database connector; if None, a new
+            one is made from config.
+
+    Returns:
+        dict: The event dictionaries (the same as those returned by
+        get_eqinfo()) keyed by event ID. Events that aren't found are
+        left out.
+
+    Raises:
+        ValueError: If neither evids nor start and end are given.
+    """
+    if evids is None and (start is None or end is None):
+        raise ValueError('Either evids or start and end must be given')
+    if connector is None:
+        connector = Connector(config, logger)
+    geocoder = get_geocoder(config, logger)
+    if evids is not None:
+        evids = [str(evid) for evid in evids]
+        remaining = set(evids)
+    events = {}
+    for dbname in connector.dbnames():
+        if evids is not None:
+            ask = [evid for evid in evids if evid in remaining]
+            if not ask:
+                break
+        else:
+            ask = None
+        results = query_eqinfo_bulk(connector, dbname, logger, evids=ask,
+                                    start=start, end=end,
+                                    places=geocoder is None)
+        if results is None:
+            continue
+        if geocoder is not None and results:
+            dist, az, place = geocoder.nearest_many(
+                [r['lat'] for r in results.values()],
+                [r['lon'] for r in results.values()])
+            direction = compass_point(az)
+            for ix, result in enumerate(results.values()):
+                result.update({'dist': float(dist[ix]),
+                               'az': float(az[ix]),
+                               'place': str(place[ix]),
+                               'dir': str(direction[ix])})
+        mechs = classify_mechs(
+            [np.nan if r['rake1'] is None else r['rake1']
+             for r in results.values()],
+            [np.nan if r['rake2'] is None else r['rake2']
+             for r in results.values()])
+        for (eventid, result), mech in zip(results.items(), mechs):
+            event = make_event(eventid, result, config, mech=str(mech))
+            if evids is None and not start <= event['time'] <= end:
+                continue
+            events[eventid] = event
+        if evids is None:
+            break
+        remaining.difference_update(results.keys())
+    if evids is not None and remaining:
+        logger.warning('Could not retrieve %d of %d events from '
+                       'database(s)' % (len(remaining), len(evids)))
+    return events
+
+
+def query_eqinfo_bulk(connector, dbname, logger, evids=None, start=None,
+                      end=None, places=True):
+    """Get the raw event information for many events from one database.
+
+    Args:
+        connector (Connector): The database connector.
+        dbname (str): The name of the database.
+        logger (logger): The logger for this process.
+        evids (list): The event IDs; if None, the events in the time
+            window are selected.
+        start (datetime): The start of the time window.
+        end (datetime): The end of the time window.
+        places (bool): If False, the places are not looked up.
+
+    Returns:
+        dict: For each event ID found, the values of the variables of
+        EQINFO_QUERY (see query_eqinfo()); None if the query failed.
+    """
+    # stations (and pandas) aren't needed by the single-event lookups
+    # of aqms_queue
+    from shakemap_aqms.stations import to_timestamp
+
+    queries = []
+    if evids is not None:
+        for ix in range(0, len(evids), MAX_BINDS):
+            chunk = [int(evid) for evid in evids[ix:ix + MAX_BINDS]]
+            binds = ', '.join([':%d' % (i + 1) for i in range(len(chunk))])
+            queries.append((BULK_ORIGIN_QUERY +
+                            'AND e.evid IN (%s)' % binds, chunk))
+    else:
+        queries.append((BULK_ORIGIN_QUERY +
+                        'AND o.datetime BETWEEN :tstart AND :tend',
+                        {'tstart': to_timestamp(start) - TIME_PAD,
+                         'tend': to_timestamp(end) + TIME_PAD}))
+    with connector.connect(dbname) as con:
+        if con is None:
+            return None
+        cursor = con.cursor()
+        cursor.arraysize = 1000
+        try:
+            rows = []
+            for query, params in queries:
+                cursor.execute(query, params)
+                rows.extend(cursor.fetchall())
+            results = {}
+            for row in rows:
+                results[str(row[0])] = dict(zip(ORIGIN_VARS, row[1:]))
+            if not results or not places:
+                return results
+            #
+            # The places of all of the events, in a few batches
+            #
+            values = lookup_places(
+                cursor, [result['lat'] for result in results.values()],
+                [result['lon'] for result in results.values()])
+        except cx_Oracle.DatabaseError as err:
+            logger.warn('Error: %s' % err)
+            connector.failed(dbname, err)
+            return None
+        finally:
+            cursor.close()
+    for name, column in values.items():
+        for result, value in zip(results.values(), column):
+            result[name] = value
+    return results
+
+
+def timed_query_eqinfo(connector, dbname, eventid, logger, places=True):
+    """Run query_eqinfo(), recording how long successful lookups take.
+    """
+    t1 = time.time()
+    result = query_eqinfo(connector, dbname, eventid, logger, places)
+    if result is not None:
+        hedge_stats.add_latency(dbname, time.time() - t1)
+    return result
+
+
+def hedged_query_eqinfo(connector, dbnames, eventid, config, logger,
+                        places=True):
+    """Get the raw event information, hedging against slow databases.
+
+    The first database is queried, and if it hasn't answered within
+    its hedging delay (see HedgeStats.delay()) the same query is sent
+    to the next database, and so on. A database that fails (or whose
+    query raises an error) is replaced by the next one immediately.
+    The first successful answer is returned and any queries still
+    running are ignored.
+
+    Args:
+        connector (Connector): The database connector.
+        dbnames (list): The databases in the order to try them.
+        eventid (str): The event ID.
+        config (dict): The AQMS configuration dictionary.
+        logger (logger): The logger for this process.
+        places (bool): See query_eqinfo().
+
+    Returns:
+        dict: The values returned by query_eqinfo(), or None if no
+        database answered.
+    """
+    t1 = time.time()
+    executor = ThreadPoolExecutor(max_workers=len(dbnames))
+    pending = {}
+    queue = list(dbnames)
+    hedged = False
+    result = None
+    winner = None
+
+    def submit():
+        dbname = queue.pop(0)
+        future = executor.submit(timed_query_eqinfo, connector, dbname,
+                                 eventid, logger, places)
+        pending[future] = dbname
+        return dbname
+
+    current = submit()
+    try:
+        while pending:
+            delay = hedge_stats.delay(current, config) if queue else None
+            done, _ = wait(list(pending.keys()), timeout=delay,
+                           return_when=FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                current = submit()
+                logger.info('No answer for event %s after %.2f s; hedging '
+                            'with database %s' % (eventid, delay, current))
+                continue
+            for future in done:
+                dbname = pending.pop(future)
+                try:
+                    answer = future.result()
+                except Exception as err:
+                    logger.error('Lookup of event %s in database %s '
+                                 'failed: %s' % (eventid, dbname, err))
+                    hedge_stats.add_error(dbname)
+                    continue
+                if answer is not None:
+                    result = answer
+                    winner = dbname
+                    break
+            if result is not None:
+                break
+            if queue:
+                current = submit()
+    finally:
+        # Don't wait for the losers
+        executor.shutdown(wait=False)
+    hedge_stats.add_lookup(winner, hedged)
+    stats = hedge_stats.summary()
+    logger.info('Event %s answered by database %s in %.2f s (hedged: %s; '
+                'hedge rate %d/%d)' %
+                (eventid, winner, time.time() - t1, hedged,
+                 stats['hedged'], stats['lookups']))
+    return result
+
+
+def query_eqinfo(connector, dbname, eventid, logger, places=True):
+    """Get the raw event information from one database.
+
+    Args:
+        connector (Connector): The database connector.
+        dbname (str): The name of the database.
+        eventid (str): The event ID.
+        logger (logger): The logger for this process.
+        places (bool): If False, the place (dist, az, elev, place, dir)
+            is not looked up.
+
+    Returns:
+        dict: The values of the query's output variables (lat, lon, mag,
+        depth, datetime, rake1, rake2, and, with places, dist, az, elev,
+        place, dir), or None if the query failed.
+    """
+    if places:
+        query, names = EQINFO_QUERY, EQINFO_VARS
+    else:
+        query, names = EQINFO_ORIGIN_QUERY, ORIGIN_VARS
+    with connector.connect(dbname) as con:
+        if con is None:
+            return None
+        cursor = con.cursor()
+        variables = {}
+        for name in names:
+            if name in ('datetime', 'place', 'dir'):
+                variables[name] = cursor.var(cx_Oracle.STRING)
+            else:
+                variables[name] = cursor.var(cx_Oracle.NUMBER)
+        params = dict(variables)
+        params['evid'] = eventid
+        try:
+            cursor.execute(query, params)
+        except cx_Oracle.DatabaseError as err:
+            logger.warn('Error: %s' % err)
+            connector.failed(dbname, err)
+            return None
+        finally:
+            cursor.close()
+    return dict((name, var.getvalue()) for name, var in variables.items())
+
+
+def make_locstring(result):
+    """Make the location string of an event, e.g., "12.3 km (7.6 mi) NNE
+    of Town".
+
+    Args:
+        result (dict): The place variables returned by query_eqinfo()
+            ('dist', 'place', and 'dir').
+
+    Returns:
+        str: The location string.
+    """
+    distmi = result['dist'] * 0.62137
+    direction = result['dir'].replace(' ', '')
+    return '%.1f km (%.1f mi) %s of %s' % \
+        (result['dist'], distmi, direction, result['place'])
+
+
+def make_event(eventid, result, config, mech=None):
+    """Make the event dictionary returned by get_eqinfo() from the
+    raw event information.
+
+    Args:
+        eventid (str): The event ID.
+        result (dict): The values returned by query_eqinfo().
+        config (dict): The AQMS configuration dictionary.
+        mech (str): The mechanism, if it has already been classified
+            (see shakemap_aqms.mech); otherwise it is classified from
+            the rakes in result.
+
+    Returns:
+        dict: The event dictionary (see get_eqinfo()).
+    """
+#    try:
+#        dt = datetime.strptime(result['datetime'], constants.TIMEFMT)
+#    except ValueError:
+#        try:
+#            dt = datetime.strptime(result['datetime'], constants.ALT_TIMEFMT)
+#        except ValueError:
+#            logger.error("Can't parse input time %s" % event['time'])
+#            return
+
+    dt = datetime.strptime(result['datetime'], DATETIME_FMT)
+    date = dt.strftime(constants.TIMEFMT) # changed source of TIMEFMT to proper local library - GG
+    dt = datetime.strptime(date, constants.TIMEFMT)
+
+    if mech is None:
+        mech = classify_mech(result['rake1'], result['rake2'])
+
+    loc = make_locstring(result)
+
+    event = {'id': eventid,
+             'netid': config['netid'],
+             'network': config['network'],
+             'lat': result['lat'],
+             'lon': result['lon'],
+             'depth': result['depth'],
+             'mag': round(result['mag'], 1),
+             'time': dt,
+             'locstring': loc,
+             'mech': mech,
+             'alt_eventids': "NONE"}  # ADDED alt_eventids key because sm_queue is expecting and attempts to access this dict value - GG
+    return event
@@ -0,0 +1,298 @@
+"""
+A local replacement for the Wheres.Town and Wheres.Compass_PT database
+procedures that make the location string of an event ("12.3 km (7.6 mi)
+NNE of Town"): the towns of the database's gazetteer are exported once
+to a file (see aqms_gazetteer), and the nearest town to an event is
+found with a KD-tree of the towns' positions on the unit sphere.
+"""
+
+# stdlib imports
+import os
+import os.path
+import threading
+
+# Third party imports
+import numpy as np
+
+GAZETTEER_FILE = 'gazetteer.npz'
+
+EARTH_RADIUS = 6371.0
+
+# The 16 points of the compass returned by Wheres.Compass_PT
+COMPASS_POINTS = ('N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE',
+                  'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW')
+
+
+def unit_vectors(lats, lons):
+    """Return the positions on the unit sphere of points given in
+    degrees.
+    """
+    lats = np.radians(np.asarray(lats, dtype=float))
+    lons = np.radians(np.asarray(lons, dtype=float))
+    coslat = np.cos(lats)
+    return np.column_stack((coslat * np.cos(lons), coslat * np.sin(lons),
+                            np.sin(lats)))
+
+
+def distance_azimuth(lat1, lon1, lat2, lon2):
+    """Return the great circle distance (km) and the azimuth (degrees
+    clockwise from north) from the first points to the second.
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(x, dtype=float))
+                              for x in (lat1, lon1, lat2, lon2)]
+    dlon = lon2 - lon1
+    a = np.sin((lat2 - lat1) / 2)**2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    dist = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    az = np.degrees(np.arctan2(
+        np.sin(dlon) * np.cos(lat2),
+        np.cos(lat1) * np.sin(lat2) -
+        np.sin(lat1) * np.cos(lat2) * np.cos(dlon))) % 360
+    return dist, az
+
+
+def compass_point(az):
+    """Return the point of the 16-point compass nearest an azimuth.
+
+    Args:
+        az (float or array): The azimuth(s) in degrees.
+
+    Returns:
+        str or ndarray: The compass point(s), e.g., 'NNE'.
+    """
+    ix = np.floor((np.asarray(az, dtype=float) % 360 + 11.25) / 22.5)
+    points = np.array(COMPASS_POINTS)[ix.astype(int) % 16]
+    return str(points) if points.ndim == 0 else points
+
+
+class Geocoder(object):
+    """Find the nearest town to a point, and the distance and direction
+    of the point from it.
+    """
+
+    def __init__(self, lats, lons, places):
+        """Args:
+            lats (array): The latitudes of the towns.
+            lons (array): The longitudes of the towns.
+            places (array): The names of the towns, as Wheres.Town
+                returns them.
+        """
+        from scipy.spatial import cKDTree
+
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.places = np.asarray(places, dtype=str)
+        self._tree = cKDTree(unit_vectors(self.lats, self.lons))
+
+    def __len__(self):
+        return len(self.places)
+
+    def save(self, path):
+        """Write the gazetteer to a (compressed numpy) file.
+        """
+        np.savez_compressed(path, lats=self.lats, lons=self.lons,
+                            places=self.places)
+
+    @classmethod
+    def load(cls, path):
+        """Read a gazetteer written by save().
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['lats'], data['lons'], data['places'])
+
+    def nearest_many(self, lats, lons):
+        """Find the nearest towns to many points.
+
+        Args:
+            lats (array): The latitudes of the points.
+            lons (array): The longitudes of the points.
+
+        Returns:
+            tuple: Arrays of the distances (km) from the towns to the
+            points, the azimuths (degrees) of the points from the towns,
+            and the names of the towns.
+        """
+        _, ix = self._tree.query(unit_vectors(lats, lons))
+        dist, az = distance_azimuth(self.lats[ix], self.lons[ix], lats, lons)
+        return dist, az, self.places[ix]
+
+    def nearest(self, lat, lon):
+        """Find the nearest town to a point.
+
+        Returns:
+            tuple: (dist, az, place); see nearest_many().
+        """
+        dist, az, places = self.nearest_many([lat], [lon])
+        return float(dist[0]), float(az[0]), str(places[0])
+
+    def place_info(self, lat, lon):
+        """Return the values of the place variables of the event query
+        (see shakemap_aqms.eqinfo) for a point.
+
+        Returns:
+            dict: 'dist', 'az', 'place', and 'dir'.
+        """
+        dist, az, place = self.nearest(lat, lon)
+        return {'dist': dist, 'az': az, 'place': place,
+                'dir': compass_point(az)}
+
+
+#
+# The points of the gazetteer; each is offered to Wheres.Town, and those
+# that are towns (i.e., that Wheres.Town puts at no distance from
+# themselves) are kept, with the place names just as Wheres.Town makes
+# them
+#
+GAZETTEER_QUERY = 'SELECT DISTINCT lat, lon FROM gazetteerpt'
+
+# A point is taken to be the town Wheres.Town returns if it is within
+# this distance (km) of it
+TOWN_TOLERANCE = 0.5
+
+# The number of places looked up per round trip
+PLACE_BATCH = 5000
+
+
+def lookup_places(cursor, lats, lons):
+    """Look up the places of many points in the database with
+    Wheres.Town and Wheres.Compass_PT.
+
+    Args:
+        cursor (Cursor): A database cursor.
+        lats (list): The latitudes of the points.
+        lons (list): The longitudes of the points.
+
+    Returns:
+        dict: Lists of the values of the place variables ('dist', 'az',
+        'elev', 'place', 'dir'), one per point.
+    """
+    import cx_Oracle
+    from shakemap_aqms.eqinfo import PLACE_QUERY, PLACE_VARS
+
+    values = {name: [] for name in PLACE_VARS}
+    for ix in range(0, len(lats), PLACE_BATCH):
+        rows = [{'lat': float(lat), 'lon': float(lon)} for lat, lon in
+                zip(lats[ix:ix + PLACE_BATCH], lons[ix:ix + PLACE_BATCH])]
+        variables = {name: cursor.var(cx_Oracle.STRING
+                                      if name in ('place', 'dir')
+                                      else cx_Oracle.NUMBER,
+                                      arraysize=len(rows))
+                     for name in PLACE_VARS}
+        cursor.setinputsizes(**variables)
+        cursor.executemany(PLACE_QUERY, rows)
+        for name, var in variables.items():
+            values[name].extend(var.values)
+    return values
+
+
+def export_gazetteer(cursor, query=GAZETTEER_QUERY):
+    """Make a geocoder from the gazetteer of a database.
+
+    Args:
+        cursor (Cursor): A database cursor.
+        query (str): The query returning the latitudes and longitudes
+            of the candidate points.
+
+    Returns:
+        Geocoder: The geocoder.
+    """
+    cursor.arraysize = 10000
+    cursor.execute(query)
+    rows = [row for row in cursor.fetchall()
+            if row[0] is not None and row[1] is not None]
+    lats = [row[0] for row in rows]
+    lons = [row[1] for row in rows]
+    values = lookup_places(cursor, lats, lons)
+    towns = {}
+    for lat, lon, dist, place in zip(lats, lons, values['dist'],
+                                     values['place']):
+        if place is None or dist is None or dist > TOWN_TOLERANCE:
+            continue
+        towns[(round(lat, 5), round(lon, 5), place)] = (lat, lon, place)
+    towns = list(towns.values())
+    return Geocoder([town[0] for town in towns], [town[1] for town in towns],
+                    [town[2] for town in towns])
+
+
+def check_geocoder(cursor, geocoder, lats, lons):
+    """Compare the location strings made by a geocoder with those made
+    by the database.
+
+    Args:
+        cursor (Cursor): A database cursor.
+        geocoder (Geocoder): The geocoder.
+        lats (array): The latitudes of the test points.
+        lons (array): The longitudes of the test points.
+
+    Returns:
+        list: (lat, lon, database string, local string) for the points
+        where they differ.
+    """
+    from shakemap_aqms.eqinfo import make_locstring
+
+    values = lookup_places(cursor, lats, lons)
+    dist, az, place = geocoder.nearest_many(lats, lons)
+    direction = compass_point(az)
+    mismatches = []
+    for ix in range(len(lats)):
+        if values['place'][ix] is None:
+            continue
+        remote = make_locstring({name: values[name][ix]
+                                 for name in ('dist', 'place', 'dir')})
+        local = make_locstring({'dist': dist[ix], 'place': place[ix],
+                                'dir': direction[ix]})
+        if remote != local:
+            mismatches.append((lats[ix], lons[ix], remote, local))
+    return mismatches
+
+
+_geocoders = {}
+_geocoder_lock = threading.Lock()
+
+
+def get_gazetteer_file(install_path, config):
+    """Return the path of the gazetteer: "gazetteer" in aqms.conf, or
+    <install_path>/data/gazetteer.npz.
+    """
+    if config['gazetteer']:
+        return config['gazetteer']
+    return os.path.join(install_path, 'data', GAZETTEER_FILE)
+
+
+def get_geocoder(config, logger):
+    """Return the local geocoder if "geocoder" in aqms.conf is 'local'.
+    The gazetteer is loaded once (and again if the file changes).
+
+    Args:
+        config (dict): The AQMS configuration dictionary.
+        logger (logger): The logger for this process.
+
+    Returns:
+        Geocoder: The geocoder, or None if the database should be used
+        (because it is configured, or because the gazetteer can't be
+        loaded).
+    """
+    if config['geocoder'] != 'local':
+        return None
+    from shakemap.utils.config import get_config_paths
+
+    install_path, _ = get_config_paths()
+    path = get_gazetteer_file(install_path, config)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        logger.warning('No gazetteer at %s; using the database for place '
+                       'names' % path)
+        return None
+    with _geocoder_lock:
+        cached = _geocoders.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            geocoder = Geocoder.load(path)
+        except Exception as err:
+            logger.warning("Couldn't load the gazetteer %s (%s); using the "
+                           "database for place names" % (path, err))
+            return None
+        _geocoders[path] = (mtime, geocoder)
+        return geocoder
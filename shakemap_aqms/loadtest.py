@@ -0,0 +1,546 @@
+"""
+The pieces of aqms_loadtest: a generator of alarm streams (steady
+background seismicity plus an optional mainshock and its aftershocks),
+an in-process copy of the aqms_queue daemon (with the scheduler or with
+the shared work queue and its workers) that looks events up in a fake
+database, and a stub sm_queue that records when each message comes
+through, so that both the latency and the order of the messages can be
+checked.
+"""
+
+# stdlib imports
+import json
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# Third party imports
+import numpy as np
+
+# Local imports
+from shakemap_aqms.client import MAX_SIZE, parse_message, send_message
+from shakemap_aqms.workqueue import get_work_queue, worker_name
+
+# Background events are placed at random in this region
+# (south, north, west, east)
+REGION = (32.0, 42.0, -125.0, -114.0)
+
+# Gutenberg-Richter parameters of the magnitudes
+MMIN = 2.0
+MMAX = 7.5
+B_VALUE = 1.0
+
+# Aftershocks are scattered about the mainshock with this standard
+# deviation (degrees)
+AFTERSHOCK_SPREAD = 0.1
+
+EVENT_ID_BASE = 90000000
+NETID = 'lt'
+
+# How long after its origin an event is cancelled (s)
+CANCEL_DELAY = (1.0, 10.0)
+
+PERCENTILES = (50, 90, 99)
+
+
+def gr_magnitudes(rng, n, mmax=MMAX):
+    """Draw magnitudes from a truncated Gutenberg-Richter distribution.
+    """
+    beta = B_VALUE * np.log(10)
+    span = 1 - np.exp(-beta * (mmax - MMIN))
+    return MMIN - np.log(1 - rng.random(n) * span) / beta
+
+
+def omori_times(rng, n, length, c=1.0, p=1.1):
+    """Draw times (s after the mainshock, within length) from the
+    modified Omori law, rate ~ 1 / (t + c)**p.
+    """
+    u = rng.random(n)
+    if p == 1:
+        return c * ((length + c) / c)**u - c
+    q = 1 - p
+    lo = c**q
+    hi = (length + c)**q
+    return (lo + u * (hi - lo))**(1 / q) - c
+
+
+def make_stream(rate, duration, mainshock=None, mainshock_time=None,
+                aftershocks=0, omori_c=1.0, omori_p=1.1, cancel_fraction=0.0,
+                seed=None):
+    """Make a stream of alarms and cancels.
+
+    Args:
+        rate (float): The rate (per s) of background alarms.
+        duration (float): The length (s) of the stream.
+        mainshock (float): The magnitude of a mainshock; None for no
+            mainshock.
+        mainshock_time (float): When (s) the mainshock happens; the
+            default is a tenth of the way into the stream.
+        aftershocks (int): The number of aftershocks of the mainshock.
+        omori_c (float): The c parameter (s) of the Omori law.
+        omori_p (float): The p parameter of the Omori law.
+        cancel_fraction (float): The fraction of the events that are
+            later cancelled.
+        seed (int): The seed of the random numbers.
+
+    Returns:
+        tuple: (messages, events), where messages is a time-ordered list
+        of (time, action, eventid) with time in s from the start of the
+        stream and action 'shake_alarm' or 'shake_cancel', and events
+        is a dict of the events (as returned by get_eqinfo) keyed by
+        event ID.
+    """
+    rng = np.random.default_rng(seed)
+    south, north, west, east = REGION
+    nbg = rng.poisson(rate * duration)
+    times = [rng.uniform(0, duration, nbg)]
+    mags = [gr_magnitudes(rng, nbg)]
+    lats = [rng.uniform(south, north, nbg)]
+    lons = [rng.uniform(west, east, nbg)]
+    if mainshock is not None:
+        if mainshock_time is None:
+            mainshock_time = duration / 10
+        mlat = (south + north) / 2
+        mlon = (west + east) / 2
+        times.append(np.array([mainshock_time]))
+        mags.append(np.array([mainshock]))
+        lats.append(np.array([mlat]))
+        lons.append(np.array([mlon]))
+        if aftershocks > 0:
+            times.append(mainshock_time +
+                         omori_times(rng, aftershocks,
+                                     duration - mainshock_time,
+                                     omori_c, omori_p))
+            mags.append(gr_magnitudes(rng, aftershocks,
+                                      max(MMIN, mainshock - 1.0)))
+            lats.append(rng.normal(mlat, AFTERSHOCK_SPREAD, aftershocks))
+            lons.append(rng.normal(mlon, AFTERSHOCK_SPREAD, aftershocks))
+    times = np.concatenate(times)
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    mags = np.concatenate(mags)[order]
+    lats = np.concatenate(lats)[order]
+    lons = np.concatenate(lons)[order]
+
+    origin_time = datetime.utcnow().replace(microsecond=0)
+    messages = []
+    events = {}
+    for ix in range(len(times)):
+        eventid = str(EVENT_ID_BASE + ix)
+        events[eventid] = {
+            'id': eventid,
+            'netid': NETID,
+            'network': 'Load test',
+            'lat': round(float(lats[ix]), 4),
+            'lon': round(float(lons[ix]), 4),
+            'depth': 8.0,
+            'mag': round(float(mags[ix]), 2),
+            'time': origin_time,
+            'locstring': 'Load test event %s' % eventid,
+            'mech': 'ALL',
+        }
+        messages.append((float(times[ix]), 'shake_alarm', eventid))
+        if cancel_fraction > 0 and rng.random() < cancel_fraction:
+            messages.append((float(times[ix] + rng.uniform(*CANCEL_DELAY)),
+                             'shake_cancel', eventid))
+    messages.sort(key=lambda message: message[0])
+    return messages, events
+
+
+class FakeEqinfo(object):
+    """Stands in for get_eqinfo: returns the events of a stream after a
+    delay like that of a database query.
+    """
+
+    def __init__(self, events, delay=0.05, jitter=0.0):
+        """Args:
+            events (dict): The events, keyed by event ID.
+            delay (float): The time (s) a lookup takes.
+            jitter (float): The lookups take up to this much longer (s),
+                at random.
+        """
+        self.events = events
+        self.delay = delay
+        self.jitter = jitter
+
+    def __call__(self, eventid, config, logger):
+        time.sleep(self.delay + random.uniform(0, self.jitter))
+        event = self.events.get(eventid)
+        return None if event is None else dict(event)
+
+
+class StubSmQueue(object):
+    """Stands in for sm_queue: accepts the messages that aqms_queue sends
+    and records when each arrives.
+    """
+
+    def __init__(self):
+        # The first and the last arrival of each (action, eventid)
+        self.received = {}
+        self.last = {}
+        self._lock = threading.Lock()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(('localhost', 0))
+        self._socket.listen(128)
+        self.port = self._socket.getsockname()[1]
+        self._stopped = False
+
+    def send(self, action, data):
+        """Send a message to the stub the way aqms_queue sends to
+        sm_queue.
+        """
+        message = json.dumps({'type': action, 'data': data})
+        with socket.create_connection(('localhost', self.port),
+                                      timeout=10) as csocket:
+            csocket.sendall(message.encode('utf-8'))
+
+    def count(self):
+        with self._lock:
+            return len(self.received)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._stopped = True
+        self._socket.close()
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                clientsocket, _ = self._socket.accept()
+            except OSError:
+                return
+            chunks = []
+            with clientsocket:
+                while True:
+                    chunk = clientsocket.recv(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            now = time.time()
+            message = json.loads(b''.join(chunks).decode('utf-8'))
+            action = 'shake_cancel' if message['type'] == 'cancel' \
+                else 'shake_alarm'
+            key = (action, str(message['data']['id']))
+            with self._lock:
+                self.received.setdefault(key, now)
+                self.last[key] = now
+
+
+class LoadTestDaemon(object):
+    """The front end of aqms_queue: accepts connections one at a time on
+    a small backlog, decodes the messages, and hands them on with
+    shakemap_aqms.alarms.dispatch(), as the daemon's main loop does.
+    """
+
+    def __init__(self, processor, work_queue=None, backlog=5):
+        self.processor = processor
+        self.work_queue = work_queue
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.bind(('localhost', 0))
+        self._socket.listen(backlog)
+        self.port = self._socket.getsockname()[1]
+        self._stopped = False
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._stopped = True
+        self._socket.close()
+
+    def _run(self):
+        from shakemap_aqms.alarms import dispatch
+
+        while not self._stopped:
+            try:
+                clientsocket, address = self._socket.accept()
+            except OSError:
+                return
+            # aqms_queue looks up the name of every client to check it
+            # against its servers; the lookup is part of the cost
+            try:
+                socket.gethostbyaddr(address[0])
+            except OSError:
+                pass
+            try:
+                clientsocket.settimeout(10)
+                data = clientsocket.recv(MAX_SIZE)
+            except socket.timeout:
+                continue
+            finally:
+                clientsocket.close()
+            try:
+                action, eventid, _ = parse_message(data)
+            except ValueError:
+                continue
+            if action in ('shake_alarm', 'shake_cancel'):
+                dispatch(action, eventid, self.processor, self.work_queue)
+
+
+class LoadTestWorkers(object):
+    """The workers of aqms_queue with the shared work queue (see
+    "work_queue" in aqms_queue.conf), as threads of this process; each
+    has its own AlarmProcessor and leases jobs as "aqms_queue --worker"
+    does.
+    """
+
+    def __init__(self, processors, poll):
+        self.processors = processors
+        self.poll = poll
+        self._stopped = threading.Event()
+
+    def start(self):
+        for ix, processor in enumerate(self.processors):
+            threading.Thread(target=self._run,
+                             args=(processor, '%s/%d' % (worker_name(), ix)),
+                             daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self, processor, owner):
+        while not self._stopped.is_set():
+            if processor.work(owner) is None:
+                self._stopped.wait(self.poll)
+
+
+def run_loadtest(messages, events, install_path, queue_conf, logger,
+                 lookup_delay=0.05, lookup_jitter=0.0, senders=16,
+                 timeout=10, drain=30, workers=0):
+    """Play a stream of alarms against an in-process aqms_queue.
+
+    Args:
+        messages (list): The messages (see make_stream()).
+        events (dict): The events (see make_stream()).
+        install_path (str): The install path for the daemon's files
+            (e.g., the aftershock database); use a scratch directory.
+        queue_conf (dict): The aqms_queue configuration.
+        logger (logger): The logger for the daemon.
+        lookup_delay (float): The time (s) an event lookup takes.
+        lookup_jitter (float): The extra random time of a lookup (s).
+        senders (int): The number of client threads.
+        timeout (float): The clients' connection timeout (s).
+        drain (float): How long (s) to wait, after the last message is
+            sent, for more messages to reach sm_queue before giving up
+            on the rest.
+        workers (int): If greater than 0, the daemon uses a shared work
+            queue (in install_path) with this many workers; otherwise
+            it uses the scheduler.
+
+    Returns:
+        tuple: (records, stats), where records is a list of dicts, one
+        per message, with the keys 'action', 'eventid', 'scheduled',
+        'sent', 'status' ('ok', 'refused', 'timeout', or 'error'),
+        'delivered' (the time the message first reached sm_queue, or
+        None), and 'last_delivered' (the time it last did), and stats
+        are the statistics of the daemon's scheduler or the counts of
+        the jobs in each state in its work queue.
+    """
+    from shakemap_aqms.alarms import AlarmProcessor
+    from shakemap_aqms.scheduler import AlarmScheduler
+
+    stub = StubSmQueue()
+    get_eqinfo = FakeEqinfo(events, lookup_delay, lookup_jitter)
+    if workers > 0:
+        scheduler = None
+        work_queue = get_work_queue(install_path, queue_conf)
+        processors = [AlarmProcessor(install_path, None, logger,
+                                     get_eqinfo=get_eqinfo, send=stub.send,
+                                     prefetch=lambda event: None,
+                                     work_queue=work_queue)
+                      for _ in range(workers)]
+        backend = LoadTestWorkers(processors, queue_conf['worker_poll'])
+        daemon = LoadTestDaemon(None, work_queue)
+    else:
+        work_queue = None
+        scheduler = AlarmScheduler(logger=logger)
+        scheduler.configure(queue_conf['queue_size'],
+                            queue_conf['shed_depth'],
+                            queue_conf['shed_magnitude'],
+                            queue_conf['shed_policy'])
+        backend = AlarmProcessor(
+            install_path, scheduler, logger, get_eqinfo=get_eqinfo,
+            send=stub.send, lookup_workers=queue_conf['lookup_workers'],
+            prefetch=lambda event: None)
+        daemon = LoadTestDaemon(backend)
+    stub.start()
+    backend.start()
+    daemon.start()
+
+    records = []
+
+    def send(record):
+        record['sent'] = time.time()
+        try:
+            send_message(record['action'], record['eventid'],
+                         port=daemon.port, timeout=timeout)
+        except ConnectionRefusedError:
+            record['status'] = 'refused'
+        except socket.timeout:
+            record['status'] = 'timeout'
+        except OSError:
+            record['status'] = 'error'
+        else:
+            record['status'] = 'ok'
+
+    start = time.time() + 0.1
+    with ThreadPoolExecutor(max_workers=senders) as pool:
+        for offset, action, eventid in messages:
+            record = {'action': action, 'eventid': eventid,
+                      'scheduled': start + offset, 'sent': None,
+                      'status': None, 'delivered': None}
+            records.append(record)
+            delay = record['scheduled'] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, record)
+    #
+    # Wait for the backlog to clear; some messages never get through
+    # (shed or suppressed), so give up when nothing has come through
+    # for the drain time
+    #
+    expected = len([record for record in records
+                    if record['status'] == 'ok'])
+    last = -1
+    idle_since = time.time()
+    while True:
+        count = stub.count()
+        if count >= expected:
+            break
+        if count != last:
+            last = count
+            idle_since = time.time()
+        elif time.time() - idle_since > drain:
+            break
+        time.sleep(0.1)
+    daemon.stop()
+    if workers > 0:
+        backend.stop()
+    stub.stop()
+    for record in records:
+        key = (record['action'], record['eventid'])
+        record['delivered'] = stub.received.get(key)
+        record['last_delivered'] = stub.last.get(key)
+    if scheduler is not None:
+        return records, scheduler.stats()
+    return records, work_queue.counts()
+
+
+def out_of_order(records):
+    """Find the events that reached sm_queue after they were cancelled:
+    those with an origin delivered after the cancel that followed it.
+
+    Args:
+        records (list): The records from run_loadtest().
+
+    Returns:
+        list: The event IDs.
+    """
+    alarms = {}
+    late = []
+    for record in sorted(records, key=lambda record: record['scheduled']):
+        if record['action'] == 'shake_alarm':
+            alarms[record['eventid']] = record
+            continue
+        alarm = alarms.get(record['eventid'])
+        if alarm is None or record['delivered'] is None or \
+                alarm['last_delivered'] is None:
+            continue
+        if alarm['last_delivered'] > record['delivered']:
+            late.append(record['eventid'])
+    return late
+
+
+def summarize(records, stats):
+    """Summarize the results of a load test.
+
+    Args:
+        records (list): The records from run_loadtest().
+        stats (dict): The queue statistics from run_loadtest().
+
+    Returns:
+        dict: The summary.
+    """
+    summary = {'offered': len(records)}
+    for status in ('ok', 'refused', 'timeout', 'error'):
+        summary[status] = len([record for record in records
+                               if record['status'] == status])
+    delivered = [record for record in records
+                 if record['delivered'] is not None]
+    summary['delivered'] = len(delivered)
+    summary['undelivered'] = summary['ok'] - len(delivered)
+    sent = [record['sent'] for record in records
+            if record['sent'] is not None]
+    if sent:
+        span = max(sent) - min(sent)
+        summary['offered_rate'] = len(sent) / span if span > 0 else 0.0
+        summary['send_lag_max'] = max(record['sent'] - record['scheduled']
+                                      for record in records
+                                      if record['sent'] is not None)
+    if delivered:
+        span = max(record['delivered'] for record in delivered) - min(sent)
+        summary['throughput'] = len(delivered) / span if span > 0 else 0.0
+    for action in ('shake_alarm', 'shake_cancel'):
+        latencies = np.array([record['delivered'] - record['sent']
+                              for record in delivered
+                              if record['action'] == action])
+        if len(latencies) == 0:
+            continue
+        latency = {'p%d' % pct: float(np.percentile(latencies, pct))
+                   for pct in PERCENTILES}
+        latency['max'] = float(latencies.max())
+        summary['latency_' + action] = latency
+    summary['out_of_order'] = len(out_of_order(records))
+    for key in ('shed', 'deferred', 'superseded', 'max_depth'):
+        summary[key] = stats.get(key)
+    return summary
+
+
+def format_report(summary):
+    """Format a summary for printing.
+
+    Args:
+        summary (dict): The summary from summarize().
+
+    Returns:
+        str: The report.
+    """
+    lines = [
+        'Messages offered:      %d (%.1f/s)' %
+        (summary['offered'], summary.get('offered_rate', 0.0)),
+        'Connections accepted:  %d' % summary['ok'],
+        'Connections refused:   %d' % summary['refused'],
+        'Connections timed out: %d' % summary['timeout'],
+        'Other send errors:     %d' % summary['error'],
+        'Delivered to sm_queue: %d (%.1f/s)' %
+        (summary['delivered'], summary.get('throughput', 0.0)),
+    ]
+    if summary['max_depth'] is None:
+        lines.append('Not delivered:         %d (superseded by cancels, '
+                     'suppressed, or failed)' % summary['undelivered'])
+    else:
+        lines += [
+            'Not delivered:         %d (shed %d, deferred %d, superseded '
+            'by cancels %d; the rest suppressed or failed)' %
+            (summary['undelivered'], summary['shed'], summary['deferred'],
+             summary['superseded']),
+            'Maximum queue depth:   %d' % summary['max_depth']]
+    lines += [
+        'Sent after a cancel:   %d' % summary['out_of_order'],
+        'Maximum send lag:      %.3f s' % summary.get('send_lag_max', 0.0),
+    ]
+    for action in ('shake_alarm', 'shake_cancel'):
+        latency = summary.get('latency_' + action)
+        if latency is None:
+            continue
+        lines.append('%s to send latency (s): %s' % (
+            action, ', '.join('%s %.3f' % (key, latency[key])
+                              for key in ['p%d' % pct
+                                          for pct in PERCENTILES] +
+                              ['max'])))
+    return '\n'.join(lines)
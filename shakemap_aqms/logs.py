@@ -0,0 +1,151 @@
+# stdlib imports
+import atexit
+import logging
+import queue
+import threading
+from logging.handlers import (QueueHandler, QueueListener,
+                              TimedRotatingFileHandler)
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def kv(**fields):
+    """Make the 'extra' argument of a logging call that attaches
+    key-value fields to the record.
+
+    Example:
+
+        logger.info('Sent event to sm_queue', extra=kv(event=eventid))
+
+    Returns:
+        dict: The 'extra' dictionary.
+    """
+    return {'kv': fields}
+
+
+class KeyValueFormatter(logging.Formatter):
+    """A formatter that appends any key-value fields attached to the
+    record (see kv()) to the message as 'key=value' pairs.
+    """
+
+    def __init__(self, fmt=LOG_FORMAT, datefmt=DATE_FORMAT):
+        super(KeyValueFormatter, self).__init__(fmt=fmt, datefmt=datefmt)
+
+    def format(self, record):
+        text = super(KeyValueFormatter, self).format(record)
+        fields = getattr(record, 'kv', None)
+        if fields:
+            text += ' ' + ' '.join('%s=%s' % (key, fields[key])
+                                   for key in sorted(fields))
+        return text
+
+
+class AsyncLogging(object):
+    """Send log records through in-memory queues to handlers that run
+    in background threads, so that slow disks don't hold up the
+    threads doing the logging.
+
+    The message of each record (including its %-style arguments) is
+    still formatted in the calling thread, by QueueHandler.prepare();
+    only the handler's own formatting and its I/O move to the
+    background thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = {}
+        atexit.register(self.stop)
+
+    def add_handler(self, name, handler, level=logging.INFO):
+        """Send the records of a logger to a handler through a queue.
+
+        This does nothing if the logger already has a queued handler.
+
+        Args:
+            name (str): The name of the logger.
+            handler (Handler): The handler that does the work.
+            level (int): The level of the logger.
+
+        Returns:
+            logging.Logger: The logger.
+        """
+        logger = logging.getLogger(name)
+        with self._lock:
+            if name in self._listeners:
+                return logger
+            handler.setFormatter(KeyValueFormatter())
+            log_queue = queue.Queue(-1)
+            listener = QueueListener(log_queue, handler,
+                                     respect_handler_level=True)
+            listener.start()
+            queue_handler = QueueHandler(log_queue)
+            self._listeners[name] = (listener, queue_handler)
+            logger.addHandler(queue_handler)
+            logger.setLevel(level)
+            logger.propagate = False
+        return logger
+
+    def add_file(self, name, logfile, when='midnight', interval=1,
+                 backup_count=60, level=logging.INFO):
+        """Send the records of a logger to a rotating log file through
+        a queue.
+
+        Args:
+            name (str): The name of the logger.
+            logfile (str): The path to the log file.
+            when (str): When to rotate (see TimedRotatingFileHandler).
+            interval (int): The rotation interval.
+            backup_count (int): The number of old logs to keep.
+            level (int): The level of the logger.
+
+        Returns:
+            logging.Logger: The logger.
+        """
+        if name in self._listeners:
+            return logging.getLogger(name)
+        handler = TimedRotatingFileHandler(logfile, when=when,
+                                           interval=interval,
+                                           backupCount=backup_count)
+        return self.add_handler(name, handler, level)
+
+    def set_levels(self, default, levels):
+        """Set the levels of the loggers.
+
+        Args:
+            default (str): The level (e.g., 'INFO') of the loggers that
+                are not in levels.
+            levels (dict): Levels keyed by logger name.
+        """
+        with self._lock:
+            names = set(self._listeners.keys()) | set(levels.keys())
+        for name in names:
+            level = levels.get(name, default)
+            logging.getLogger(name).setLevel(getattr(logging, level))
+
+    def stop(self):
+        """Flush the queues, stop the background threads, and detach
+        the queued handlers from their loggers.
+        """
+        with self._lock:
+            for name, (listener, queue_handler) in self._listeners.items():
+                logging.getLogger(name).removeHandler(queue_handler)
+                listener.stop()
+            self._listeners = {}
+
+
+_async_logging = None
+_async_lock = threading.Lock()
+
+
+def get_async_logging():
+    """Return the process-wide AsyncLogging instance.
+
+    Returns:
+        AsyncLogging: The instance.
+    """
+    global _async_logging
+    with _async_lock:
+        if _async_logging is None:
+            _async_logging = AsyncLogging()
+        return _async_logging
@@ -0,0 +1,87 @@
+# Third party imports
+import numpy as np
+
+# The mechanism of events without a focal mechanism
+DEFAULT_MECH = 'ALL'
+
+
+def _wrap(rake):
+    if rake > 180:
+        rake -= 360
+    if rake < -180:
+        rake += 360
+    return rake
+
+
+def classify_mech(rake1, rake2):
+    """Classify the mechanism of an event from the rakes of its two
+    nodal planes.
+
+    Args:
+        rake1 (float): The rake of the first plane (degrees), or None.
+        rake2 (float): The rake of the second plane (degrees), or None.
+
+    Returns:
+        str: 'NM' (normal or oblique normal), 'RS' (reverse or oblique
+        reverse), 'SS' (strike-slip), or 'ALL' (unknown).
+    """
+    # RAKE VALUES ARE NOT ALWAYS PRESENT FOR EVENTS, DEFAULTING TO-> mech = 'ALL' - GG
+    if rake1 is None or rake2 is None:
+        return DEFAULT_MECH
+    rake1 = _wrap(rake1)
+    rake2 = _wrap(rake2)
+
+    if rake1 >= -135 and rake1 <= -45 and rake2 >= -135 and rake2 <= -45:
+        return 'NM'  # Normal
+    elif (rake1 >= -135 and rake1 <= -45) or (rake2 >= -135 and rake2 <= -45):
+        return 'NM'  # Oblique Normal
+    elif rake1 >= 45 and rake1 <= 135 and rake2 >= 45 and rake2 <= 135:
+        return 'RS'  # Reverse
+    elif (rake1 >= 45 and rake1 <= 135) or (rake2 >= 45 and rake2 <= 135):
+        return 'RS'  # Oblique Reverse
+    elif rake1 >= -45 and rake1 <= 45 and \
+        ((rake2 >= 135 and rake2 <= 225) or
+            (rake2 >= -225 and rake2 <= -135)):
+        return 'SS'
+    elif rake2 >= -45 and rake2 <= 45 and \
+        ((rake1 >= 135 and rake1 <= 225) or
+            (rake1 >= -225 and rake1 <= -135)):
+        return 'SS'
+    return DEFAULT_MECH
+
+
+def classify_mechs(rake1, rake2):
+    """Classify the mechanisms of many events at once; the result is the
+    same as that of classify_mech() applied to each event.
+
+    Args:
+        rake1 (array-like): The rakes of the first planes (degrees);
+            None or NaN where unknown.
+        rake2 (array-like): The rakes of the second planes.
+
+    Returns:
+        ndarray: The mechanisms (see classify_mech()).
+    """
+    rake1 = np.array(rake1, dtype=float)
+    rake2 = np.array(rake2, dtype=float)
+    known = ~(np.isnan(rake1) | np.isnan(rake2))
+    rakes = []
+    for rake in (rake1, rake2):
+        rake = np.where(rake > 180, rake - 360, rake)
+        rakes.append(np.where(rake < -180, rake + 360, rake))
+    rake1, rake2 = rakes
+
+    def between(rake, lo, hi):
+        return (rake >= lo) & (rake <= hi)
+
+    # Either plane normal (the "both" cases of the scalar version are
+    # covered by "either")
+    normal = between(rake1, -135, -45) | between(rake2, -135, -45)
+    reverse = between(rake1, 45, 135) | between(rake2, 45, 135)
+    strike1 = between(rake1, -45, 45) & (between(rake2, 135, 225) |
+                                         between(rake2, -225, -135))
+    strike2 = between(rake2, -45, 45) & (between(rake1, 135, 225) |
+                                         between(rake1, -225, -135))
+    return np.select([known & normal, known & reverse,
+                      known & (strike1 | strike2)],
+                     ['NM', 'RS', 'SS'], DEFAULT_MECH)
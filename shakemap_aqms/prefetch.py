@@ -0,0 +1,193 @@
+"""
+Fetch the station metadata and amps of an event as soon as aqms_queue
+accepts its alarm, so that the database work overlaps with the time
+the event waits for sm_queue and shake. The results are kept in a
+directory per event (<install_path>/data/prefetch/<eventid>), which
+aqms_db2xml reads instead of querying the database if it is recent
+enough (see "prefetch_max_age" in aqms.conf).
+"""
+
+# stdlib imports
+import os
+import os.path
+import json
+import pickle
+import shutil
+import time
+
+PREFETCH_DIR = 'prefetch'
+
+# The stations and amps are pickled together; the manifest is written
+# last, so a directory without one is incomplete
+DATA_FILE = 'prefetch.pkl'
+MANIFEST_FILE = 'manifest.json'
+
+# Event directories older than this (seconds) are removed
+KEEP_TIME = 86400
+
+
+def get_prefetch_dir(install_path, eventid=None):
+    """Return the directory holding the prefetched data, or that of one
+    event.
+
+    Args:
+        install_path (str): The ShakeMap install path.
+        eventid (str): The event ID.
+
+    Returns:
+        str: The directory.
+    """
+    path = os.path.join(install_path, 'data', PREFETCH_DIR)
+    if eventid is None:
+        return path
+    return os.path.join(path, eventid)
+
+
+def write_prefetch(install_path, eventid, stadict, ampsets):
+    """Write the prefetched data of an event, replacing any that is
+    there already.
+
+    Args:
+        install_path (str): The ShakeMap install path.
+        eventid (str): The event ID.
+        stadict (dict): The station dictionary.
+        ampsets (list): (dbname, DataFrame) tuples as returned by
+            shakemap_aqms.amps.get_amps().
+
+    Returns:
+        str: The event's prefetch directory.
+    """
+    prefetch_dir = get_prefetch_dir(install_path)
+    if not os.path.isdir(prefetch_dir):
+        os.makedirs(prefetch_dir, exist_ok=True)
+    tmpdir = os.path.join(prefetch_dir, '.%s.%d' %
+                          (eventid, int(time.time() * 1000)))
+    os.makedirs(tmpdir)
+    with open(os.path.join(tmpdir, DATA_FILE), 'wb') as f:
+        pickle.dump({'stations': stadict, 'ampsets': ampsets}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    manifest = {'created': time.time(), 'nstations': len(stadict),
+                'ampsets': dict((dbname, len(df))
+                                for dbname, df in ampsets)}
+    with open(os.path.join(tmpdir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+    final = get_prefetch_dir(install_path, eventid)
+    if os.path.isdir(final):
+        shutil.rmtree(final, ignore_errors=True)
+    os.rename(tmpdir, final)
+    return final
+
+
+def read_prefetch(install_path, eventid, max_age, logger):
+    """Read the prefetched data of an event if it is recent enough.
+
+    Args:
+        install_path (str): The ShakeMap install path.
+        eventid (str): The event ID.
+        max_age (float): The maximum age of the data in seconds.
+        logger (logger): The logger for this process.
+
+    Returns:
+        tuple: (stadict, ampsets), or None if there is no usable data.
+    """
+    event_dir = get_prefetch_dir(install_path, eventid)
+    try:
+        with open(os.path.join(event_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        age = time.time() - manifest['created']
+        if age > max_age:
+            logger.info('Prefetched data for event %s is %.0f s old; not '
+                        'using it' % (eventid, age))
+            return None
+        with open(os.path.join(event_dir, DATA_FILE), 'rb') as f:
+            data = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, pickle.UnpicklingError) as err:
+        logger.warn('Could not read prefetched data for event %s: %s' %
+                    (eventid, err))
+        return None
+    logger.info('Using data prefetched for event %s %.0f s ago' %
+                (eventid, age))
+    return data['stations'], data['ampsets']
+
+
+def discard_prefetch(install_path, eventid):
+    """Remove the prefetched data of an event (e.g., because its amps
+    have changed since it was fetched).
+
+    Returns:
+        bool: True if there was data to remove.
+    """
+    event_dir = get_prefetch_dir(install_path, eventid)
+    if not os.path.isdir(event_dir):
+        return False
+    shutil.rmtree(event_dir, ignore_errors=True)
+    return True
+
+
+def prune_prefetch(install_path, keep_time=KEEP_TIME):
+    """Remove the event directories (and any left over from failed
+    writes) that are older than keep_time seconds.
+
+    Returns:
+        int: The number of directories removed.
+    """
+    prefetch_dir = get_prefetch_dir(install_path)
+    if not os.path.isdir(prefetch_dir):
+        return 0
+    cutoff = time.time() - keep_time
+    removed = 0
+    for name in os.listdir(prefetch_dir):
+        path = os.path.join(prefetch_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+
+def prefetch_event(install_path, event, config, logger, connector=None):
+    """Fetch and save the station metadata and amps of an event, the
+    way aqms_db2xml would.
+
+    Args:
+        install_path (str): The ShakeMap install path.
+        event (dict): The event, as returned by get_eqinfo().
+        config (dict): The AQMS configuration dictionary.
+        logger (logger): The logger for this process.
+        connector (Connector): The database connector; if None, a new
+            one is made from config.
+
+    Returns:
+        str: The event's prefetch directory.
+    """
+    from shakemap_aqms.db import Connector, get_db_health
+    from shakemap_aqms.stations import get_station_dict
+    from shakemap_aqms.amps import get_amps
+    from shakemap_aqms.snapshot import load_snapshot
+
+    eventid = event['id']
+    t1 = time.time()
+    if connector is None:
+        connector = Connector(config, logger, get_db_health(install_path))
+    snapshot = None
+    if config['station_snapshot'] > 0:
+        snapshot = load_snapshot(install_path, config['station_snapshot'],
+                                 logger)
+    if snapshot is not None:
+        stadict = snapshot.stations_at(event['time'])
+    else:
+        stadict = get_station_dict(connector,
+                                   event['time'].strftime('%Y/%m/%d %H%M%S'),
+                                   config, logger)
+    ampsets = get_amps(connector, eventid, stadict, config, logger)
+    path = write_prefetch(install_path, eventid, stadict, ampsets)
+    logger.info('Prefetched %d stations and %d amps for event %s in '
+                '%.2f s' % (len(stadict),
+                            sum(len(df) for _, df in ampsets), eventid,
+                            time.time() - t1))
+    prune_prefetch(install_path)
+    return path
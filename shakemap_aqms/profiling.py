@@ -0,0 +1,99 @@
+"""
+Optional profiling of the coremods. When "profile" in aqms.conf (or the
+AQMS_PROFILE environment variable, which takes precedence) is on, a
+coremod's execute() method decorated with profiled() is run under
+cProfile and tracemalloc, and the profile and a summary of the wall
+time, CPU time, and peak memory are written to the event's current
+directory.
+"""
+
+# stdlib imports
+import functools
+import json
+import os
+import os.path
+import time
+
+# Local imports
+from shakemap_aqms.util import get_aqms_config
+
+PROFILE_ENV = 'AQMS_PROFILE'
+
+
+def profiling_enabled():
+    """Decide whether the coremods should be profiled: the AQMS_PROFILE
+    environment variable ('1', 'true', 'yes', or 'on' to profile,
+    anything else not to), if it is set, otherwise "profile" in
+    aqms.conf.
+
+    Returns:
+        bool: True if profiling is on.
+    """
+    value = os.environ.get(PROFILE_ENV)
+    if value is not None:
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    try:
+        return bool(get_aqms_config()['profile'])
+    except Exception:
+        return False
+
+
+def profiled(execute):
+    """Decorate the execute() method of a coremod so that, when profiling
+    is on (see profiling_enabled()), it is run under cProfile and
+    tracemalloc.
+
+    Two files are written to the event's current directory:
+    <command_name>.prof, which can be loaded with pstats, snakeviz,
+    gprof2dot, etc., and <command_name>_profile.json, with the wall
+    time, the CPU time, and the peak memory allocated by Python.
+    """
+    @functools.wraps(execute)
+    def wrapper(self, *args, **kwargs):
+        if not profiling_enabled():
+            return execute(self, *args, **kwargs)
+
+        import cProfile
+        import tracemalloc
+        from shakemap.utils.config import get_config_paths
+
+        _, data_path = get_config_paths()
+        datadir = os.path.join(data_path, self._eventid, 'current')
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        wall = time.time()
+        cpu = time.process_time()
+        try:
+            return profiler.runcall(execute, self, *args, **kwargs)
+        finally:
+            cpu = time.process_time() - cpu
+            wall = time.time() - wall
+            _, peak = tracemalloc.get_traced_memory()
+            if not tracing:
+                tracemalloc.stop()
+            if os.path.isdir(datadir):
+                base = os.path.join(datadir, self.command_name)
+                summary = {'command': self.command_name,
+                           'eventid': self._eventid,
+                           'start': time.time() - wall,
+                           'wall_time': wall,
+                           'cpu_time': cpu,
+                           'peak_memory': peak}
+                try:
+                    profiler.dump_stats(base + '.prof')
+                    with open(base + '_profile.json', 'w') as f:
+                        json.dump(summary, f, indent=2)
+                except OSError as err:
+                    self.logger.warning("Couldn't write the profile of %s "
+                                        "to %s: %s" %
+                                        (self.command_name, datadir, err))
+                else:
+                    self.logger.info('Wrote profile of %s to %s.prof '
+                                     '(wall %.2f s, cpu %.2f s, '
+                                     'peak %.1f MB)' %
+                                     (self.command_name, base, wall, cpu,
+                                      peak / 1e6))
+    return wrapper
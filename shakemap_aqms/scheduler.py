@@ -0,0 +1,259 @@
+# stdlib imports
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Priority classes; lower is served first
+CANCEL = 0
+ORIGIN = 1
+DEFERRED = 2
+
+# The number of recent waits kept for the statistics
+WAIT_SAMPLES = 200
+
+# The number of recent cancels remembered, so that origins whose lookups
+# finish after their events are cancelled are dropped
+CANCEL_SAMPLES = 1000
+
+
+class WorkItem(object):
+    """A message waiting to be processed.
+    """
+
+    def __init__(self, action, eventid, event=None, received=None):
+        """Create a work item.
+
+        Args:
+            action (str): 'cancel', 'origin', or 'rerun' (an origin that
+                is sent again because its amps have changed).
+            eventid (str): The event ID.
+            event (dict): The event information (from get_eqinfo) of an
+                origin or rerun.
+            received (float): The time the message was received;
+                defaults to now.
+        """
+        self.action = action
+        self.eventid = eventid
+        self.event = event
+        self.received = time.time() if received is None else received
+        # The time of the alarm the item follows from; origins that
+        # follow from alarms received before a cancel of their event are
+        # dropped
+        self.alarmed = self.received
+        self.queued = None
+        self.dequeued = None
+        self.wait = None
+        self.trace_id = None
+
+    @property
+    def mag(self):
+        """float: The magnitude of the event, or None if unknown.
+        """
+        if self.event is None:
+            return None
+        return self.event.get('mag')
+
+
+class AlarmScheduler(object):
+    """A bounded priority queue of the messages aqms_queue has received
+    but not yet processed.
+
+    Cancels are served first, then origins in order of decreasing
+    magnitude (ties in order of arrival). A cancel supersedes the origins
+    of its event that were alarmed before it: those waiting in the queue
+    are dropped when it arrives, and those still being looked up are
+    dropped when they are put on the queue, so that a cancelled event is
+    not sent on after its cancel. When the queue is deeper than
+    shed_depth, origins smaller than shed_magnitude are either dropped
+    ('shed') or deferred until the queue is no longer backed up
+    ('defer'). When the queue is full, the lowest-priority origin is
+    dropped to make room for a higher-priority one; cancels are always
+    accepted.
+    """
+
+    def __init__(self, maxsize=100, shed_depth=0, shed_magnitude=3.0,
+                 policy='defer', logger=None):
+        """Create a scheduler.
+
+        Args:
+            maxsize (int): The maximum number of origins in the queue.
+            shed_depth (int): The depth beyond which small origins are
+                shed or deferred; 0 turns this off.
+            shed_magnitude (float): Origins below this magnitude are
+                shed or deferred when the queue is backed up.
+            policy (str): 'shed' or 'defer'.
+            logger (logger): The logger for this process.
+        """
+        self.configure(maxsize, shed_depth, shed_magnitude, policy)
+        self.logger = logger
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._cancelled = OrderedDict()
+        self.counts = {'queued': 0, 'processed': 0, 'shed': 0,
+                       'deferred': 0, 'superseded': 0}
+        self.max_depth = 0
+
+    def configure(self, maxsize, shed_depth, shed_magnitude, policy):
+        """Change the limits (e.g., after a config reload).
+        """
+        self.maxsize = maxsize
+        self.shed_depth = shed_depth
+        self.shed_magnitude = shed_magnitude
+        self.policy = policy
+
+    @property
+    def depth(self):
+        """int: The number of items waiting.
+        """
+        return len(self._heap)
+
+    def _priority(self, item, pclass):
+        if pclass == CANCEL:
+            return (CANCEL, 0.0, next(self._seq))
+        mag = item.mag if item.mag is not None else 0.0
+        return (pclass, -mag, next(self._seq))
+
+    def _shed(self, item, reason):
+        self.counts['shed'] += 1
+        if self.logger is not None:
+            self.logger.warning('Dropped event %s (M%s): %s',
+                                item.eventid, item.mag, reason)
+
+    def _supersede(self, item):
+        self.counts['superseded'] += 1
+        if self.logger is not None:
+            self.logger.info('Dropped %s of event %s: the event has been '
+                             'cancelled', item.action, item.eventid)
+
+    def cancelled(self, eventid, since):
+        """Check whether an event has been cancelled.
+
+        Args:
+            eventid (str): The event ID.
+            since (float): The time of the event's alarm.
+
+        Returns:
+            bool: True if a cancel of the event was received at or after
+            since.
+        """
+        with self._cond:
+            cancel = self._cancelled.get(eventid)
+        return cancel is not None and cancel >= since
+
+    def put(self, item):
+        """Queue a work item.
+
+        Args:
+            item (WorkItem): The item.
+
+        Returns:
+            bool: True if the item was queued, False if it was shed or
+            its event has been cancelled.
+        """
+        item.queued = time.time()
+        with self._cond:
+            if item.action == 'cancel':
+                pclass = CANCEL
+                cancel = max(item.received,
+                             self._cancelled.pop(item.eventid, item.received))
+                self._cancelled[item.eventid] = cancel
+                if len(self._cancelled) > CANCEL_SAMPLES:
+                    self._cancelled.popitem(last=False)
+                superseded = [entry for entry in self._heap
+                              if entry[1].eventid == item.eventid and
+                              entry[0][0] != CANCEL and
+                              entry[1].alarmed <= cancel]
+                if superseded:
+                    for entry in superseded:
+                        self._heap.remove(entry)
+                        self._supersede(entry[1])
+                    heapq.heapify(self._heap)
+            else:
+                cancel = self._cancelled.get(item.eventid)
+                if cancel is not None and item.alarmed <= cancel:
+                    self._supersede(item)
+                    return False
+                pclass = ORIGIN
+                small = item.mag is None or item.mag < self.shed_magnitude
+                if self.shed_depth > 0 and small and \
+                        self.depth >= self.shed_depth:
+                    if self.policy == 'shed':
+                        self._shed(item, 'queue depth %d' % self.depth)
+                        return False
+                    pclass = DEFERRED
+                    self.counts['deferred'] += 1
+                    if self.logger is not None:
+                        self.logger.info('Deferred event %s (M%s): queue '
+                                         'depth %d', item.eventid, item.mag,
+                                         self.depth)
+                norigins = len([entry for entry in self._heap
+                                if entry[0][0] != CANCEL])
+                if norigins >= self.maxsize:
+                    #
+                    # Make room by dropping the lowest-priority origin,
+                    # unless that is the new one
+                    #
+                    priority = self._priority(item, pclass)
+                    worst = max([entry for entry in self._heap
+                                 if entry[0][0] != CANCEL],
+                                key=lambda entry: entry[0])
+                    if worst[0] < priority:
+                        self._shed(item, 'queue full')
+                        return False
+                    self._heap.remove(worst)
+                    heapq.heapify(self._heap)
+                    self._shed(worst[1], 'queue full')
+                    heapq.heappush(self._heap, (priority, item))
+                    self.counts['queued'] += 1
+                    self.max_depth = max(self.max_depth, self.depth)
+                    self._cond.notify()
+                    return True
+            heapq.heappush(self._heap, (self._priority(item, pclass), item))
+            self.counts['queued'] += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            self._cond.notify()
+            return True
+
+    def get(self, timeout=None):
+        """Take the highest-priority item off the queue.
+
+        Args:
+            timeout (float): The maximum time to wait for an item; None
+                waits forever.
+
+        Returns:
+            WorkItem: The item (with its wait time set), or None if the
+            timeout expired.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: len(self._heap) > 0,
+                                       timeout=timeout):
+                return None
+            _, item = heapq.heappop(self._heap)
+            item.dequeued = time.time()
+            item.wait = item.dequeued - item.received
+            self._waits.append(item.wait)
+            self.counts['processed'] += 1
+            return item
+
+    def stats(self):
+        """Return the queue statistics.
+
+        Returns:
+            dict: The current and maximum depth, the counts of items
+            queued, processed, shed, deferred, and superseded by
+            cancels, and the median and maximum of the recent wait
+            times (s).
+        """
+        with self._cond:
+            waits = sorted(self._waits)
+            stats = dict(self.counts)
+            stats['depth'] = self.depth
+            stats['max_depth'] = self.max_depth
+        stats['wait_median'] = waits[len(waits) // 2] if waits else 0.0
+        stats['wait_max'] = waits[-1] if waits else 0.0
+        return stats
@@ -0,0 +1,347 @@
+# stdlib imports
+import os
+import os.path
+import json
+import shutil
+import threading
+import time
+
+# Third party imports
+import numpy as np
+
+# Local imports
+from shakemap_aqms.db import Connector
+from shakemap_aqms.epochs import EpochIndex
+from shakemap_aqms.stations import (add_channel, get_channel_epochs,
+                                    stations_at_times, to_timestamp)
+
+SNAPSHOT_DIR = 'station_snapshot'
+
+# Columns of the snapshot; strings are stored as fixed-width unicode
+# arrays so that every column can be memory-mapped
+STRING_COLUMNS = ('netsta', 'loc', 'chan', 'netdesc', 'net', 'sta',
+                  'staname', 'staloc')
+FLOAT_COLUMNS = ('lat', 'lon', 'elev', 't6', 'ondate', 'offdate')
+BOOL_COLUMNS = ('adhoc',)
+
+# The number of old snapshots to keep around for readers that may
+# still be using them
+KEEP_VERSIONS = 2
+
+
+def get_snapshot_dir(install_path):
+    """Return the directory holding the station snapshots.
+
+    Args:
+        install_path (str): The ShakeMap install path.
+
+    Returns:
+        str: The snapshot directory.
+    """
+    return os.path.join(install_path, 'data', SNAPSHOT_DIR)
+
+
+def _float(value):
+    if value is None:
+        return np.nan
+    return float(value)
+
+
+def write_snapshot(epochs, snapshot_dir):
+    """Write the channel epochs as a set of memory-mappable column files.
+
+    Each snapshot is written to a new version directory and then made
+    current by atomically replacing the 'current' symlink, so readers
+    never see a partial snapshot.
+
+    Args:
+        epochs (ChannelEpochs): The channel epochs.
+        snapshot_dir (str): The snapshot directory.
+
+    Returns:
+        str: The path of the new snapshot version.
+    """
+    cols = dict((name, []) for name in
+                STRING_COLUMNS + FLOAT_COLUMNS + BOOL_COLUMNS)
+    entries = [(key, cdict, on, off, False) for key, cdict, on, off in
+               zip(epochs.keys, epochs.cdicts, epochs.ondates,
+                   epochs.offdates)]
+    entries += [(key, cdict, -np.inf, np.inf, True) for key, cdict in
+                epochs.adhoc.items()]
+    for key, cdict, on, off, adhoc in entries:
+        cols['netsta'].append(key[0])
+        cols['loc'].append(key[1])
+        cols['chan'].append(key[2])
+        for name in ('netdesc', 'net', 'sta', 'staname', 'staloc'):
+            cols[name].append(str(cdict[name]))
+        for name in ('lat', 'lon', 'elev', 't6'):
+            cols[name].append(_float(cdict.get(name)))
+        cols['ondate'].append(on)
+        cols['offdate'].append(off)
+        cols['adhoc'].append(adhoc)
+
+    if not os.path.isdir(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    version = '%d' % int(time.time() * 1000)
+    tmpdir = os.path.join(snapshot_dir, '.' + version)
+    os.makedirs(tmpdir)
+    for name in STRING_COLUMNS:
+        np.save(os.path.join(tmpdir, name + '.npy'),
+                np.array(cols[name], dtype=np.str_))
+    for name in FLOAT_COLUMNS:
+        np.save(os.path.join(tmpdir, name + '.npy'),
+                np.array(cols[name], dtype=np.float64))
+    for name in BOOL_COLUMNS:
+        np.save(os.path.join(tmpdir, name + '.npy'),
+                np.array(cols[name], dtype=np.bool_))
+    # The database epochs come first, so the index's epoch numbers are
+    # also rows of the snapshot
+    epochs.index.save(tmpdir)
+    manifest = {'created': time.time(), 'nrows': len(entries)}
+    with open(os.path.join(tmpdir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    final = os.path.join(snapshot_dir, version)
+    os.rename(tmpdir, final)
+
+    link = os.path.join(snapshot_dir, 'current')
+    tmplink = os.path.join(snapshot_dir, '.current')
+    if os.path.lexists(tmplink):
+        os.remove(tmplink)
+    os.symlink(version, tmplink)
+    os.replace(tmplink, link)
+
+    #
+    # Remove old versions; processes that still have them mapped can
+    # keep using them
+    #
+    versions = sorted([v for v in os.listdir(snapshot_dir) if v.isdigit()],
+                      key=int)
+    for old in versions[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(snapshot_dir, old), ignore_errors=True)
+    return final
+
+
+class StationSnapshot(object):
+    """A read-only, memory-mapped snapshot of the station metadata.
+
+    The column files are mapped rather than read, so concurrent
+    processes share the same pages of memory.
+    """
+
+    def __init__(self, snapshot_dir):
+        """Open the current snapshot.
+
+        Args:
+            snapshot_dir (str): The snapshot directory.
+
+        Raises:
+            FileNotFoundError: If there is no snapshot.
+        """
+        link = os.path.join(snapshot_dir, 'current')
+        if not os.path.lexists(link):
+            raise FileNotFoundError('No station snapshot in %s' %
+                                    snapshot_dir)
+        self.path = os.path.realpath(link)
+        with open(os.path.join(self.path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.columns = {}
+        for name in STRING_COLUMNS + FLOAT_COLUMNS + BOOL_COLUMNS:
+            self.columns[name] = np.load(os.path.join(self.path,
+                                                      name + '.npy'),
+                                         mmap_mode='r')
+        #
+        # The interval index of the database epochs is saved with the
+        # snapshot (and mapped like the columns); older snapshots
+        # don't have one, so it is built the first time it is needed
+        #
+        try:
+            self._index = EpochIndex.load(self.path)
+        except FileNotFoundError:
+            self._index = None
+
+    @property
+    def index(self):
+        """EpochIndex: The interval index of the database epochs.
+        """
+        if self._index is None:
+            cols = self.columns
+            rows = np.nonzero(~cols['adhoc'])[0]
+            keys = list(zip(cols['netsta'][rows], cols['loc'][rows],
+                            cols['chan'][rows]))
+            index = EpochIndex(keys, cols['ondate'][rows],
+                               cols['offdate'][rows])
+            # Report rows of the snapshot rather than of the subset
+            index.order = rows[index.order]
+            self._index = index
+        return self._index
+
+    @property
+    def age(self):
+        """float: The age of the snapshot in seconds.
+        """
+        return time.time() - self.manifest['created']
+
+    def _cdict(self, ix):
+        cols = self.columns
+        cdict = {'netdesc': str(cols['netdesc'][ix]),
+                 'net': str(cols['net'][ix]),
+                 'sta': str(cols['sta'][ix]),
+                 'lon': float(cols['lon'][ix]),
+                 'lat': float(cols['lat'][ix]),
+                 'elev': float(cols['elev'][ix]),
+                 'staname': str(cols['staname'][ix]),
+                 'staloc': str(cols['staloc'][ix])}
+        if not np.isnan(cols['t6'][ix]):
+            cdict['t6'] = float(cols['t6'][ix])
+        return cdict
+
+    def _add(self, stadict, indices):
+        cols = self.columns
+        for ix in indices:
+            add_channel(stadict, str(cols['netsta'][ix]),
+                        str(cols['loc'][ix]), str(cols['chan'][ix]),
+                        self._cdict(ix))
+
+    def active(self, evtime):
+        """Return the indices of the database epochs active at a
+        given time.
+
+        Args:
+            evtime (datetime): The time.
+
+        Returns:
+            array: The indices of the active epochs.
+        """
+        return self.index.active(to_timestamp(evtime))
+
+    def _stadict(self, indices):
+        stadict = {}
+        self._add(stadict, indices)
+        cols = self.columns
+        adhoc = [ix for ix in np.nonzero(cols['adhoc'])[0]
+                 if str(cols['chan'][ix]) not in
+                 stadict.get(str(cols['netsta'][ix]), {}).get(
+                     str(cols['loc'][ix]), {})]
+        self._add(stadict, adhoc)
+        return stadict
+
+    def stations_at(self, evtime):
+        """Return the station dictionary for a given time.
+
+        Args:
+            evtime (datetime): The time.
+
+        Returns:
+            dict: The station dictionary, keyed by 'NET.STA', then
+            location code, then channel.
+        """
+        return self._stadict(self.active(evtime))
+
+    def stations_at_times(self, evtimes):
+        """Return the station dictionaries for many times at once.
+
+        Args:
+            evtimes (list): The times.
+
+        Returns:
+            list: The station dictionary for each time; times at which
+            the same epochs are active share a dictionary.
+        """
+        return stations_at_times(self, evtimes)
+
+
+def load_snapshot(install_path, max_age, logger):
+    """Open the current station snapshot if it is recent enough.
+
+    Args:
+        install_path (str): The ShakeMap install path.
+        max_age (float): The maximum age of the snapshot in hours.
+        logger (logger): The logger for this process.
+
+    Returns:
+        StationSnapshot: The snapshot, or None if there is no usable
+        snapshot.
+    """
+    try:
+        snapshot = StationSnapshot(get_snapshot_dir(install_path))
+    except (FileNotFoundError, OSError, ValueError) as err:
+        logger.warn('Could not open station snapshot: %s' % err)
+        return None
+    if snapshot.age > max_age * 3600:
+        logger.warn('Station snapshot is %.1f hours old; not using it' %
+                    (snapshot.age / 3600))
+        return None
+    return snapshot
+
+
+def refresh_snapshot(connector, config, install_path, logger):
+    """Retrieve the channel epochs from the database(s) and write a
+    new snapshot.
+
+    Args:
+        connector (Connector): The database connector.
+        config (dict): The AQMS configuration dictionary.
+        install_path (str): The ShakeMap install path.
+        logger (logger): The logger for this process.
+
+    Returns:
+        str: The path of the new snapshot version.
+    """
+    t1 = time.time()
+    epochs = get_channel_epochs(connector, config, logger)
+    path = write_snapshot(epochs, get_snapshot_dir(install_path))
+    logger.info('Wrote station snapshot %s (%d epochs) in %.1f s' %
+                (path, len(epochs.keys), time.time() - t1))
+    return path
+
+
+class SnapshotRefresher(object):
+    """Refresh the station snapshot periodically in a background thread,
+    for use by long-running processes like aqms_queue.
+    """
+
+    def __init__(self, install_path, logger):
+        """Create a refresher.
+
+        Args:
+            install_path (str): The ShakeMap install path.
+            logger (logger): The logger for this process.
+        """
+        self.install_path = install_path
+        self.logger = logger
+        self._thread = None
+        try:
+            snapshot = StationSnapshot(get_snapshot_dir(install_path))
+            self._last = snapshot.manifest['created']
+        except (FileNotFoundError, OSError, ValueError):
+            self._last = 0
+
+    def _refresh(self, config):
+        try:
+            refresh_snapshot(Connector(config, self.logger), config,
+                             self.install_path, self.logger)
+        except Exception as err:
+            self.logger.error('Station snapshot refresh failed: %s' % err)
+
+    def check(self, interval, config):
+        """Start a refresh if one is due and none is running.
+
+        Args:
+            interval (float): The refresh interval in hours; if 0, the
+                snapshot is not refreshed.
+            config (dict): The AQMS configuration dictionary.
+
+        Returns:
+            bool: True if a refresh was started.
+        """
+        if interval <= 0:
+            return False
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        if time.time() - self._last < interval * 3600:
+            return False
+        self._last = time.time()
+        self._thread = threading.Thread(target=self._refresh,
+                                        args=(config,), daemon=True)
+        self._thread.start()
+        return True
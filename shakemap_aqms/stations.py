@@ -0,0 +1,517 @@
+# stdlib imports
+import os.path
+from datetime import datetime, timezone
+
+# Third party imports
+import cx_Oracle
+import numpy as np
+import pandas as pd
+
+# Local imports
+from shakemap_aqms.epochs import EpochIndex
+
+#
+# The station metadata active at a particular time
+#
+STATION_QUERY = ("SELECT d.description, c.net, c.sta, c.seedchan, "
+                 "c.location, c.lat, c.lon, c.elev, s.staname "
+                 "FROM channel_data c, station_data s, "
+                 "d_abbreviation d "
+                 "WHERE TO_DATE(:evtime, 'YYYY/MM/DD HH24MISS') BETWEEN "
+                 "c.ondate AND c.offdate "
+                 "AND c.net = s.net AND c.sta = s.sta "
+                 "AND s.net_id = d.id")
+
+#
+# Every channel epoch
+#
+EPOCH_QUERY = ("SELECT d.description, c.net, c.sta, c.seedchan, "
+               "c.location, c.lat, c.lon, c.elev, s.staname, "
+               "c.ondate, c.offdate "
+               "FROM channel_data c, station_data s, "
+               "d_abbreviation d "
+               "WHERE c.net = s.net AND c.sta = s.sta "
+               "AND s.net_id = d.id")
+
+ADHOC_WIDTHS = [6, 3, 4, 3, 4, 10, 11, 6, 60]
+ADHOC_COLUMNS = ['sta', 'net', 'chan', 'loc', 't6', 'lat', 'lon',
+                 'elev', 'name']
+
+
+def add_channel(stadict, netsta, loc, chan, cdict):
+    """Add a channel's metadata to a station dictionary.
+
+    Args:
+        stadict (dict): The station dictionary, keyed by 'NET.STA', then
+            location code, then channel.
+        netsta (str): The 'NET.STA' code.
+        loc (str): The location code.
+        chan (str): The channel code.
+        cdict (dict): The channel metadata.
+    """
+    if netsta not in stadict:
+        stadict[netsta] = {loc: {chan: cdict}}
+    elif loc not in stadict[netsta]:
+        stadict[netsta][loc] = {chan: cdict}
+    else:
+        stadict[netsta][loc][chan] = cdict
+
+
+def make_channel_dict(desc, net, sta, lat, lon, elev, staname, logger):
+    """Make the metadata dictionary for one channel from a row of the
+    station query.
+
+    Returns:
+        dict: The channel metadata, or None if the station has no name.
+    """
+    if staname is None:
+        logger.warn("staname for %s.%s is empty - skipping" % (net, sta))
+        return None
+    if ' - ' in staname:
+        staname, staloc = staname.split(' - ', maxsplit=1)
+    else:
+        staloc = ''
+    return {'netdesc': desc, 'net': net, 'sta': sta,
+            'lon': lon, 'lat': lat, 'elev': elev,
+            'staname': staname, 'staloc': staloc}
+
+
+def query_stations(cursor, evtime, logger):
+    """Get the metadata of the channels active at a given time.
+
+    Args:
+        cursor (Cursor): A database cursor.
+        evtime (str): The time in the format 'YYYY/MM/DD HHMMSS'.
+        logger (logger): The logger for this process.
+
+    Returns:
+        tuple: The station dictionary and the number of rows returned
+        by the query.
+
+    Raises:
+        cx_Oracle.DatabaseError: If the query fails.
+    """
+    cursor.execute(STATION_QUERY, {'evtime': evtime})
+    stadict = {}
+    nlines = 0
+    for line in cursor:
+        nlines += 1
+        desc, net, sta, chan, loc, lat, lon, elev, staname = line
+        loc = loc.replace(' ', '-')
+        cdict = make_channel_dict(desc, net, sta, lat, lon, elev,
+                                  staname, logger)
+        if cdict is None:
+            continue
+        add_channel(stadict, net + '.' + sta, loc, chan, cdict)
+    return stadict, nlines
+
+
+def query_stamapping(cursor, logger):
+    """Get the station location descriptions from the stamapping table.
+
+    The stamapping table may not exist on some databases, so errors are
+    logged and ignored.
+
+    Args:
+        cursor (Cursor): A database cursor.
+        logger (logger): The logger for this process.
+
+    Returns:
+        dict: The location descriptions keyed by network, then station.
+    """
+    stalocdescr = {}
+    try:
+        cursor.execute('select sta, net, locdescr from stamapping')
+    except cx_Oracle.DatabaseError as err:
+        logger.warn('Warning: couldnt retrieve stamapping: %s' % err)
+    else:
+        for line in cursor:
+            sta, net, locdescr = line
+            if net not in stalocdescr:
+                stalocdescr[net] = {sta: locdescr}
+                continue
+            stalocdescr[net][sta] = locdescr
+    return stalocdescr
+
+
+def read_adhoc(adhoc_file):
+    """Read the adhoc file.
+
+    Args:
+        adhoc_file (str): The path to the adhoc file.
+
+    Returns:
+        list: A list of (sta, net, chan, loc, t6, lat, lon, elev, name)
+        tuples.
+    """
+    df = pd.read_fwf(adhoc_file, widths=ADHOC_WIDTHS,
+                     names=ADHOC_COLUMNS)
+    rows = []
+    for row in df.itertuples():
+        _, sta, net, chan, loc, t6, lat, lon, elev, name = row
+        net = str(net)  # cast to string
+        loc = str(loc)  # cast to string
+        loc = loc.replace(' ', '-')
+        name = str(name)  # cast to string
+        rows.append((sta, net, chan, loc, t6, lat, lon, elev, name))
+    return rows
+
+
+def get_netdesc(cursor, net, netcode, logger):
+    """Get the description of a network, caching the result.
+
+    Args:
+        cursor (Cursor): A database cursor.
+        net (str): The network code.
+        netcode (dict): A cache of the network descriptions.
+        logger (logger): The logger for this process.
+
+    Returns:
+        str: The description of the network.
+    """
+    if net in netcode:
+        return netcode[net]
+    try:
+        cursor.execute('select d.description '
+                       'from d_abbreviation d, station_data s '
+                       'where s.net = :net '
+                       'and s.net_id = d.id', {'net': net})
+    except cx_Oracle.DatabaseError as err:
+        logger.warn('Error retrieving net description: %s' % err)
+        netdesc = ['Unknown']
+    else:
+        netdesc = cursor.fetchone()
+        if not netdesc:
+            netdesc = ['Unknown']
+    netcode[net] = netdesc[0]
+    return netcode[net]
+
+
+def adhoc_channel_dict(row, netdesc):
+    """Make the metadata dictionary of a channel that is only found
+    in the adhoc file.
+
+    Args:
+        row (tuple): A row returned by read_adhoc().
+        netdesc (str): The description of the channel's network.
+
+    Returns:
+        dict: The channel metadata.
+    """
+    sta, net, chan, loc, t6, lat, lon, elev, name = row
+    if ' - ' in name:
+        nn, desc = name.split(' - ', maxsplit=1)
+    else:
+        nn = name
+        desc = ''
+    return {'staloc': desc, 'net': net, 'sta': sta,
+            'lon': lon, 'lat': lat, 'elev': elev,
+            'staname': nn, 't6': t6, 'netdesc': netdesc}
+
+
+def apply_adhoc(stadict, adhoc_rows, cursor, netcode, logger):
+    """Add the "table 6" values from the adhoc file to the stations
+    in stadict, and add any stations that are only in the adhoc file.
+
+    Args:
+        stadict (dict): The station dictionary.
+        adhoc_rows (list): The rows returned by read_adhoc().
+        cursor (Cursor): A database cursor (for network descriptions).
+        netcode (dict): A cache of network descriptions.
+        logger (logger): The logger for this process.
+    """
+    for row in adhoc_rows:
+        sta, net, chan, loc, t6 = row[:5]
+        netsta = "%s.%s" % (net, sta)  # modified concatenation style - GG
+        try:
+            stadict[netsta][loc][chan]['t6'] = t6
+            continue
+        except KeyError:
+            pass
+        netdesc = get_netdesc(cursor, net, netcode, logger)
+        add_channel(stadict, netsta, loc, chan,
+                    adhoc_channel_dict(row, netdesc))
+
+
+def apply_stamapping(stadict, stalocdescr):
+    """Get the station location strings if possible; if it is just
+    a (possibly truncated) copy of the station name, leave it blank.
+
+    Args:
+        stadict (dict): The station dictionary.
+        stalocdescr (dict): The location descriptions returned by
+            query_stamapping().
+    """
+    for netsta in stadict.keys():
+        for loc in stadict[netsta].keys():
+            for chan in stadict[netsta][loc].keys():
+                set_staloc(stadict[netsta][loc][chan], netsta, stalocdescr)
+
+
+def set_staloc(cdict, netsta, stalocdescr):
+    """Set the location string of a channel from the stamapping, unless
+    it already has one.
+
+    Args:
+        cdict (dict): The channel metadata.
+        netsta (str): The 'NET.STA' code of the channel.
+        stalocdescr (dict): The location descriptions returned by
+            query_stamapping().
+    """
+    if cdict['staloc']:
+        return
+    net, sta = netsta.split('.', maxsplit=1)
+    try:
+        staloc = stalocdescr[net][sta]
+    except KeyError:
+        return
+    if staloc and staloc not in cdict['staname']:
+        cdict['staloc'] = staloc
+
+
+def get_station_dict(connector, evtime, config, logger):
+    """Get the metadata of the stations active at a given time, with
+    the adhoc file and stamapping applied.
+
+    The databases are tried in order until one returns stations.
+
+    Args:
+        connector (Connector): The database connector.
+        evtime (str): The time in the format 'YYYY/MM/DD HHMMSS'.
+        config (dict): The AQMS configuration dictionary.
+        logger (logger): The logger for this process.
+
+    Returns:
+        dict: The station dictionary, keyed by 'NET.STA', then location
+        code, then channel.
+
+    Raises:
+        RuntimeError: If no database returns any stations.
+    """
+    for dbname in connector.dbnames():
+        with connector.connect(dbname) as con:
+            if con is None:
+                continue
+            cursor = con.cursor()
+            try:
+                stadict, nlines = query_stations(cursor, evtime, logger)
+            except cx_Oracle.DatabaseError as err:
+                logger.warn('Error: %s' % err)
+                connector.failed(dbname, err)
+                cursor.close()
+                continue
+            if nlines == 0:
+                cursor.close()
+                continue
+            #
+            # This database has the station information, so we use it
+            # for the rest of the metadata as well
+            #
+            stalocdescr = query_stamapping(cursor, logger)
+            if config['adhoc_file'] and \
+                    os.path.isfile(config['adhoc_file']):
+                apply_adhoc(stadict, read_adhoc(config['adhoc_file']),
+                            cursor, {}, logger)
+            elif config['adhoc_file']:
+                logger.warn('Warning: adhoc_file %s does not exist' %
+                            config['adhoc_file'])
+            apply_stamapping(stadict, stalocdescr)
+            cursor.close()
+            return stadict
+    raise RuntimeError('Could not retrieve stations from database(s)')
+
+
+def to_timestamp(dt):
+    """Convert a datetime to seconds since the epoch; naive datetimes
+    are taken to be UTC.
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+
+def stations_at_times(epochs, evtimes):
+    """Return the station dictionaries of a set of epochs (ChannelEpochs
+    or StationSnapshot) for many times, with one index lookup for all
+    of the times and one dictionary for each distinct set of active
+    epochs.
+    """
+    sets, which = epochs.index.active_sets([to_timestamp(evtime)
+                                            for evtime in evtimes])
+    stadicts = [epochs._stadict(indices) for indices in sets]
+    return [stadicts[ix] for ix in which]
+
+
+class ChannelEpochs(object):
+    """The metadata of every channel epoch, from which the stations
+    active at any time can be looked up without a database query.
+
+    The adhoc file and stamapping are applied to each epoch once, when
+    the object is created. The channel dictionaries returned by
+    stations_at() are shared and must not be modified.
+    """
+
+    def __init__(self, rows, stalocdescr, adhoc_rows, netdesc_func,
+                 logger):
+        """Build the epochs.
+
+        Args:
+            rows (list): Rows of EPOCH_QUERY: (desc, net, sta, chan, loc,
+                lat, lon, elev, staname, ondate, offdate).
+            stalocdescr (dict): The location descriptions returned by
+                query_stamapping().
+            adhoc_rows (list): The rows returned by read_adhoc(), or None
+                if there is no adhoc file.
+            netdesc_func (function): A function returning the description
+                of a network code (for stations only in the adhoc file).
+            logger (logger): The logger for this process.
+        """
+        self.keys = []
+        self.cdicts = []
+        ondates = []
+        offdates = []
+        t6 = {}
+        if adhoc_rows:
+            for row in adhoc_rows:
+                sta, net, chan, loc, tt6 = row[:5]
+                t6[("%s.%s" % (net, sta), loc, chan)] = tt6
+        for row in rows:
+            desc, net, sta, chan, loc, lat, lon, elev, staname, on, off = row
+            loc = loc.replace(' ', '-')
+            cdict = make_channel_dict(desc, net, sta, lat, lon, elev,
+                                      staname, logger)
+            if cdict is None:
+                continue
+            key = (net + '.' + sta, loc, chan)
+            if key in t6:
+                cdict['t6'] = t6[key]
+            self.keys.append(key)
+            self.cdicts.append(cdict)
+            ondates.append(to_timestamp(on))
+            offdates.append(to_timestamp(off))
+        self.ondates = np.array(ondates, dtype=np.float64)
+        self.offdates = np.array(offdates, dtype=np.float64)
+        self._index = None
+        #
+        # Stations that are only in the adhoc file don't have epochs;
+        # they are used whenever the database has no active epoch for
+        # that channel
+        #
+        self.adhoc = {}
+        if adhoc_rows:
+            for row in adhoc_rows:
+                sta, net, chan, loc = row[:4]
+                key = ("%s.%s" % (net, sta), loc, chan)
+                self.adhoc[key] = adhoc_channel_dict(row, netdesc_func(net))
+        #
+        # Apply the stamapping to everything
+        #
+        for key, cdict in zip(self.keys, self.cdicts):
+            set_staloc(cdict, key[0], stalocdescr)
+        for key, cdict in self.adhoc.items():
+            set_staloc(cdict, key[0], stalocdescr)
+
+    @property
+    def index(self):
+        """EpochIndex: The interval index of the epochs, built the
+        first time it is needed.
+        """
+        if self._index is None:
+            self._index = EpochIndex(self.keys, self.ondates, self.offdates)
+        return self._index
+
+    def active(self, evtime):
+        """Return the indices of the epochs active at a given time.
+
+        Args:
+            evtime (datetime): The (UTC) time.
+
+        Returns:
+            array: The indices into self.keys and self.cdicts.
+        """
+        return self.index.active(to_timestamp(evtime))
+
+    def _stadict(self, indices):
+        stadict = {}
+        for ix in indices:
+            key = self.keys[ix]
+            add_channel(stadict, key[0], key[1], key[2], self.cdicts[ix])
+        for key, cdict in self.adhoc.items():
+            try:
+                stadict[key[0]][key[1]][key[2]]
+            except KeyError:
+                add_channel(stadict, key[0], key[1], key[2], cdict)
+        return stadict
+
+    def stations_at(self, evtime):
+        """Return the station dictionary for a given time.
+
+        Args:
+            evtime (datetime): The (UTC) time.
+
+        Returns:
+            dict: The station dictionary, keyed by 'NET.STA', then
+            location code, then channel.
+        """
+        return self._stadict(self.active(evtime))
+
+    def stations_at_times(self, evtimes):
+        """Return the station dictionaries for many times at once.
+
+        Args:
+            evtimes (list): The (UTC) times.
+
+        Returns:
+            list: The station dictionary for each time; times at which
+            the same epochs are active share a dictionary.
+        """
+        return stations_at_times(self, evtimes)
+
+
+def get_channel_epochs(connector, config, logger):
+    """Get the metadata of every channel epoch from the first database
+    that has them.
+
+    Args:
+        connector (Connector): The database connector.
+        config (dict): The AQMS configuration dictionary.
+        logger (logger): The logger for this process.
+
+    Returns:
+        ChannelEpochs: The channel epochs.
+
+    Raises:
+        RuntimeError: If no database returns any stations.
+    """
+    adhoc_rows = None
+    if config['adhoc_file'] and os.path.isfile(config['adhoc_file']):
+        adhoc_rows = read_adhoc(config['adhoc_file'])
+    elif config['adhoc_file']:
+        logger.warn('Warning: adhoc_file %s does not exist' %
+                    config['adhoc_file'])
+    for dbname in connector.dbnames():
+        with connector.connect(dbname) as con:
+            if con is None:
+                continue
+            cursor = con.cursor()
+            cursor.arraysize = 5000
+            try:
+                cursor.execute(EPOCH_QUERY)
+                rows = cursor.fetchall()
+            except cx_Oracle.DatabaseError as err:
+                logger.warn('Error: %s' % err)
+                connector.failed(dbname, err)
+                cursor.close()
+                continue
+            if len(rows) == 0:
+                cursor.close()
+                continue
+            stalocdescr = query_stamapping(cursor, logger)
+            netcode = {}
+            epochs = ChannelEpochs(
+                rows, stalocdescr, adhoc_rows,
+                lambda net: get_netdesc(cursor, net, netcode, logger),
+                logger)
+            cursor.close()
+            return epochs
+    raise RuntimeError('Could not retrieve stations from database(s)')
@@ -0,0 +1,384 @@
+"""
+Resource telemetry for the long-running aqms_queue processes: the
+resident memory, the open file descriptors (and how many of them are
+sockets and SQLite files), the database connections in use, the counts
+of the hedged event lookups, and, optionally, the biggest growers among
+Python's allocations (with tracemalloc) and the memory allocated while
+each alarm was handled by a work queue worker (which handles one alarm
+at a time).
+
+Each process samples itself every "telemetry_interval" seconds, logs a
+warning when a threshold in aqms_queue.conf is crossed, and writes the
+latest sample to <install_path>/logs/<process name>.status.json, which
+is what the aqms_status program reads.
+"""
+
+# stdlib imports
+import os
+import os.path
+import json
+import resource
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+STATUS_SUFFIX = '.status.json'
+
+# The number of per-alarm allocation deltas kept
+ALARM_SAMPLES = 100
+
+# The samples of the resident memory kept to estimate its growth (at the
+# default interval of a minute, a day's worth)
+RSS_SAMPLES = 1440
+
+# The memory growth is only estimated after this long (s)
+MIN_GROWTH_SPAN = 3600
+
+MB = 1024 * 1024
+
+
+def rss_bytes():
+    """Return the resident memory of this process in bytes; where
+    /proc isn't available, the peak resident memory is returned.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def open_files():
+    """Count the open file descriptors of this process.
+
+    Returns:
+        dict: 'fds' (all of them), 'sockets', and 'sqlite' (database
+        and journal files whose names end in .db, .db-journal, or
+        .db-wal); None for each if /proc/self/fd can't be read.
+    """
+    counts = {'fds': None, 'sockets': None, 'sqlite': None}
+    fd_dir = '/proc/self/fd'
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return counts
+    counts = {'fds': len(fds), 'sockets': 0, 'sqlite': 0}
+    for fd in fds:
+        try:
+            target = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if target.startswith('socket:'):
+            counts['sockets'] += 1
+        elif target.endswith(('.db', '.db-journal', '.db-wal')):
+            counts['sqlite'] += 1
+    return counts
+
+
+def db_connections():
+    """Return the database connections in use and made so far (see
+    shakemap_aqms.db.connection_counts()), or zeros if the database
+    module hasn't been loaded.
+    """
+    db = sys.modules.get('shakemap_aqms.db')
+    if db is None:
+        return {'open': 0, 'total': 0}
+    return db.connection_counts()
+
+
+def hedging():
+    """Return the counts of the hedged event lookups (see
+    shakemap_aqms.eqinfo.HedgeStats.summary()), or None if the event
+    lookup module hasn't been loaded.
+    """
+    eqinfo = sys.modules.get('shakemap_aqms.eqinfo')
+    if eqinfo is None:
+        return None
+    return eqinfo.hedge_stats.summary()
+
+
+class Telemetry(object):
+    """Sample the resources of this process and publish them.
+    """
+
+    def __init__(self, install_path, name, logger):
+        """Args:
+            install_path (str): The ShakeMap install path.
+            name (str): The name of the process (e.g., 'aqms_queue').
+            logger (logger): The logger for this process.
+        """
+        self.name = name
+        self.logger = logger
+        self.status_file = os.path.join(install_path, 'logs',
+                                        name + STATUS_SUFFIX)
+        self.started = time.time()
+        self.last_sample = None
+        self._rss = deque(maxlen=RSS_SAMPLES)
+        self._alarms = deque(maxlen=ALARM_SAMPLES)
+        self._nalarms = 0
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._frames = 0
+
+    def configure(self, queue_conf):
+        """Start or stop tracemalloc as "telemetry_tracemalloc" in
+        aqms_queue.conf says.
+        """
+        import tracemalloc
+
+        frames = queue_conf['telemetry_tracemalloc']
+        if frames == self._frames:
+            return
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._snapshot = None
+        if frames > 0:
+            tracemalloc.start(frames)
+        self._frames = frames
+
+    @contextmanager
+    def measure(self, eventid):
+        """Record the memory allocated by Python (if tracemalloc is
+        running) while the block runs, as the cost of an alarm. Other
+        threads allocate at the same time, so this is approximate.
+        """
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            yield
+            return
+        before = tracemalloc.get_traced_memory()[0]
+        t1 = time.time()
+        try:
+            yield
+        finally:
+            delta = tracemalloc.get_traced_memory()[0] - before
+            with self._lock:
+                self._alarms.append((eventid, delta, time.time() - t1))
+                self._nalarms += 1
+
+    def top_allocations(self, limit):
+        """Return the source lines that have allocated the most memory
+        since the last call (all of it, the first time).
+
+        Returns:
+            list: Dicts with 'where', 'size', and 'growth' (bytes), and
+            'count', biggest growth first; empty if tracemalloc isn't
+            running.
+        """
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>')])
+        if self._snapshot is None:
+            stats = snapshot.statistics('lineno')
+            top = [(stat.traceback[0], stat.size, stat.size, stat.count)
+                   for stat in stats[:limit]]
+        else:
+            stats = snapshot.compare_to(self._snapshot, 'lineno')
+            top = [(stat.traceback[0], stat.size, stat.size_diff,
+                    stat.count) for stat in stats[:limit]]
+        self._snapshot = snapshot
+        return [{'where': '%s:%d' % (frame.filename, frame.lineno),
+                 'size': size, 'growth': growth, 'count': count}
+                for frame, size, growth, count in top]
+
+    def growth_rate(self):
+        """Return the growth of the resident memory (bytes per hour)
+        over the kept samples, from a least squares fit, or None if they
+        don't span long enough.
+        """
+        if len(self._rss) < 3 or \
+                self._rss[-1][0] - self._rss[0][0] < MIN_GROWTH_SPAN:
+            return None
+        n = len(self._rss)
+        tmean = sum(t for t, _ in self._rss) / n
+        rmean = sum(r for _, r in self._rss) / n
+        num = sum((t - tmean) * (r - rmean) for t, r in self._rss)
+        den = sum((t - tmean) ** 2 for t, _ in self._rss)
+        if den == 0:
+            return None
+        return num / den * 3600
+
+    def sample(self, queue_conf, now=None):
+        """Take a sample of the resources of this process.
+
+        Returns:
+            dict: The sample.
+        """
+        if now is None:
+            now = time.time()
+        rss = rss_bytes()
+        self._rss.append((now, rss))
+        sample = {'name': self.name,
+                  'pid': os.getpid(),
+                  'time': now,
+                  'uptime': now - self.started,
+                  'rss': rss,
+                  'rss_growth': self.growth_rate(),
+                  'threads': threading.active_count(),
+                  'db_connections': db_connections(),
+                  'hedging': hedging()}
+        sample.update(open_files())
+        import tracemalloc
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            sample['traced'] = current
+            sample['traced_peak'] = peak
+            sample['top_allocations'] = self.top_allocations(
+                queue_conf['telemetry_top'])
+        with self._lock:
+            alarms = list(self._alarms)
+            sample['alarms'] = self._nalarms
+        if alarms:
+            deltas = [delta for _, delta, _ in alarms]
+            sample['alarm_allocations'] = {
+                'mean': sum(deltas) / len(deltas),
+                'max': max(deltas),
+                'last': [{'event': eventid, 'delta': delta,
+                          'seconds': seconds}
+                         for eventid, delta, seconds in alarms[-10:]]}
+        self.last_sample = now
+        return sample
+
+    def check(self, sample, queue_conf):
+        """Log a warning for each threshold in aqms_queue.conf that the
+        sample crosses.
+
+        Returns:
+            list: The warnings.
+        """
+        warnings = []
+        limit = queue_conf['telemetry_rss_warning']
+        if limit > 0 and sample['rss'] > limit * MB:
+            warnings.append('resident memory is %.1f MB (limit %.1f MB)' %
+                            (sample['rss'] / MB, limit))
+        limit = queue_conf['telemetry_growth_warning']
+        if limit > 0 and sample['rss_growth'] is not None and \
+                sample['rss_growth'] > limit * MB:
+            warnings.append('resident memory is growing by %.1f MB/hour '
+                            '(limit %.1f MB/hour)' %
+                            (sample['rss_growth'] / MB, limit))
+        limit = queue_conf['telemetry_fd_warning']
+        if limit > 0 and sample['fds'] is not None and \
+                sample['fds'] > limit:
+            warnings.append('%d open file descriptors (limit %d)' %
+                            (sample['fds'], limit))
+        limit = queue_conf['telemetry_alarm_warning']
+        if limit > 0 and 'alarm_allocations' in sample and \
+                sample['alarm_allocations']['mean'] > limit * MB:
+            warnings.append('alarms allocate %.2f MB each on average '
+                            '(limit %.2f MB)' %
+                            (sample['alarm_allocations']['mean'] / MB,
+                             limit))
+        for warning in warnings:
+            self.logger.warning('Telemetry: %s', warning)
+        sample['warnings'] = warnings
+        return warnings
+
+    def write_status(self, sample):
+        """Write a sample to the status file (atomically).
+        """
+        tmpfile = self.status_file + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(sample, f, indent=2)
+        os.replace(tmpfile, self.status_file)
+
+    def update(self, queue_conf, now=None):
+        """Sample, check, and publish, if a sample is due.
+
+        Returns:
+            dict: The sample, or None if none was due.
+        """
+        interval = queue_conf['telemetry_interval']
+        if interval <= 0:
+            return None
+        if now is None:
+            now = time.time()
+        if self.last_sample is not None and \
+                now - self.last_sample < interval:
+            return None
+        self.configure(queue_conf)
+        sample = self.sample(queue_conf, now)
+        self.check(sample, queue_conf)
+        try:
+            self.write_status(sample)
+        except OSError as err:
+            self.logger.warning("Couldn't write %s: %s", self.status_file,
+                                err)
+        return sample
+
+
+def read_status(install_path):
+    """Read the status files of all of the aqms_queue processes.
+
+    Returns:
+        list: The latest samples, in the order of the process names.
+    """
+    logdir = os.path.join(install_path, 'logs')
+    samples = []
+    if not os.path.isdir(logdir):
+        return samples
+    for filename in sorted(os.listdir(logdir)):
+        if not filename.endswith(STATUS_SUFFIX):
+            continue
+        try:
+            with open(os.path.join(logdir, filename)) as f:
+                samples.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return samples
+
+
+def format_status(sample, now=None):
+    """Make a human readable report of a sample.
+    """
+    if now is None:
+        now = time.time()
+    lines = ['%s (pid %d), sampled %.0f s ago, up %.1f hours' %
+             (sample['name'], sample['pid'], now - sample['time'],
+              sample['uptime'] / 3600)]
+    growth = sample.get('rss_growth')
+    lines.append('  resident memory: %.1f MB%s' %
+                 (sample['rss'] / MB, '' if growth is None else
+                  ' (%+.2f MB/hour)' % (growth / MB)))
+    if sample.get('fds') is not None:
+        lines.append('  open files: %d (%d sockets, %d SQLite)' %
+                     (sample['fds'], sample['sockets'], sample['sqlite']))
+    lines.append('  threads: %d' % sample['threads'])
+    lines.append('  database connections: %d open, %d made' %
+                 (sample['db_connections']['open'],
+                  sample['db_connections']['total']))
+    if sample.get('hedging') and sample['hedging']['lookups']:
+        hedge = sample['hedging']
+        lines.append('  event lookups: %d, %d hedged; errors: %s' %
+                     (hedge['lookups'], hedge['hedged'],
+                      ', '.join('%s %d' % (dbname, hedge['errors'][dbname])
+                                for dbname in sorted(hedge['errors']))
+                      or 'none'))
+    if 'traced' in sample:
+        lines.append('  traced Python memory: %.1f MB (peak %.1f MB)' %
+                     (sample['traced'] / MB, sample['traced_peak'] / MB))
+    if 'alarm_allocations' in sample:
+        allocs = sample['alarm_allocations']
+        lines.append('  alarms: %d; allocated per alarm %.1f kB mean, '
+                     '%.1f kB max (recent alarms)' %
+                     (sample['alarms'], allocs['mean'] / 1024,
+                      allocs['max'] / 1024))
+    if sample.get('top_allocations'):
+        lines.append('  top allocations (growth since last sample):')
+        for alloc in sample['top_allocations']:
+            lines.append('    %+10.1f kB %10.1f kB %s' %
+                         (alloc['growth'] / 1024, alloc['size'] / 1024,
+                          alloc['where']))
+    for warning in sample.get('warnings', []):
+        lines.append('  WARNING: %s' % warning)
+    return '\n'.join(lines)
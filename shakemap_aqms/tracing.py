@@ -0,0 +1,274 @@
+# stdlib imports
+import os
+import os.path
+import sqlite3
+import time
+import uuid
+from contextlib import closing, contextmanager
+
+TRACE_DB = 'aqms_traces.db'
+
+TABLES = ("CREATE TABLE IF NOT EXISTS traces ("
+          "trace_id TEXT PRIMARY KEY, "
+          "eventid TEXT NOT NULL, "
+          "created REAL NOT NULL)",
+          "CREATE INDEX IF NOT EXISTS traces_eventid "
+          "ON traces (eventid, created)",
+          "CREATE INDEX IF NOT EXISTS traces_created ON traces (created)",
+          "CREATE TABLE IF NOT EXISTS spans ("
+          "trace_id TEXT NOT NULL, "
+          "name TEXT NOT NULL, "
+          "start REAL NOT NULL, "
+          "end REAL NOT NULL, "
+          "status TEXT NOT NULL, "
+          "detail TEXT)",
+          "CREATE INDEX IF NOT EXISTS spans_trace_id ON spans (trace_id)")
+
+
+class TraceStore(object):
+    """A local SQLite store of per-event traces: the spans (named stages
+    with start and end times) recorded for an event as it goes from the
+    alarm received by aqms_queue to the data files written by
+    aqms_db2xml.
+
+    A trace is created when aqms_queue receives an alarm; the coremods
+    add their spans to the most recent trace of the event. Tracing is
+    best-effort: errors writing to the store are logged and otherwise
+    ignored.
+    """
+
+    def __init__(self, path, keep_days=30, logger=None):
+        """Open (or create) a trace store.
+
+        Args:
+            path (str): The path to the SQLite file.
+            keep_days (float): Traces older than this are removed when
+                new traces are created.
+            logger (logger): A logger for errors writing to the store.
+        """
+        self.path = path
+        self.keep_days = keep_days
+        self.logger = logger
+        with closing(self._connect()) as con:
+            con.execute('PRAGMA journal_mode = WAL')
+            for sql in TABLES:
+                con.execute(sql)
+            con.commit()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _write(self, sql_params):
+        try:
+            with closing(self._connect()) as con:
+                with con:
+                    for sql, params in sql_params:
+                        con.execute(sql, params)
+        except sqlite3.Error as err:
+            if self.logger is not None:
+                self.logger.warning('Could not write trace: %s', err)
+            return False
+        return True
+
+    def new_trace(self, eventid, created=None):
+        """Start a new trace for an event.
+
+        Args:
+            eventid (str): The event ID.
+            created (float): The start of the trace; defaults to now.
+
+        Returns:
+            str: The trace ID.
+        """
+        trace_id = uuid.uuid4().hex
+        created = time.time() if created is None else created
+        cutoff = created - self.keep_days * 86400
+        self._write([
+            ('DELETE FROM spans WHERE trace_id IN (SELECT trace_id FROM '
+             'traces WHERE created < ?)', (cutoff,)),
+            ('DELETE FROM traces WHERE created < ?', (cutoff,)),
+            ('INSERT INTO traces (trace_id, eventid, created) '
+             'VALUES (?, ?, ?)', (trace_id, eventid, created))])
+        return trace_id
+
+    def find_trace(self, eventid):
+        """Return the most recent trace of an event.
+
+        Args:
+            eventid (str): The event ID.
+
+        Returns:
+            str: The trace ID, or None if the event has no trace.
+        """
+        with closing(self._connect()) as con:
+            row = con.execute('SELECT trace_id FROM traces WHERE eventid = ? '
+                              'ORDER BY created DESC LIMIT 1',
+                              (eventid,)).fetchone()
+        return None if row is None else row[0]
+
+    def event_trace(self, eventid):
+        """Return the most recent trace of an event, creating one if
+        there is none (e.g., when shake is run by hand).
+
+        Args:
+            eventid (str): The event ID.
+
+        Returns:
+            str: The trace ID.
+        """
+        try:
+            trace_id = self.find_trace(eventid)
+        except sqlite3.Error:
+            trace_id = None
+        if trace_id is None:
+            trace_id = self.new_trace(eventid)
+        return trace_id
+
+    def record(self, trace_id, name, start, end, status='ok', detail=''):
+        """Record a span.
+
+        Args:
+            trace_id (str): The trace ID.
+            name (str): The name of the stage.
+            start (float): The start time of the span.
+            end (float): The end time of the span.
+            status (str): 'ok' or 'error'.
+            detail (str): Any other information.
+
+        Returns:
+            bool: True if the span was recorded.
+        """
+        if trace_id is None:
+            return False
+        return self._write([
+            ('INSERT INTO spans (trace_id, name, start, end, status, detail) '
+             'VALUES (?, ?, ?, ?, ?, ?)',
+             (trace_id, name, start, end, status, detail))])
+
+    @contextmanager
+    def span(self, trace_id, name, detail=''):
+        """A context manager that records a span around a block of code;
+        the status is 'error' if the block raises an exception.
+
+        Args:
+            trace_id (str): The trace ID.
+            name (str): The name of the stage.
+            detail (str): Any other information.
+        """
+        start = time.time()
+        try:
+            yield
+        except BaseException as err:
+            self.record(trace_id, name, start, time.time(), 'error',
+                        detail or str(err))
+            raise
+        self.record(trace_id, name, start, time.time(), 'ok', detail)
+
+    def traces(self, eventid):
+        """Return the traces of an event.
+
+        Args:
+            eventid (str): The event ID.
+
+        Returns:
+            list: (trace_id, created) tuples, oldest first.
+        """
+        with closing(self._connect()) as con:
+            return con.execute('SELECT trace_id, created FROM traces '
+                               'WHERE eventid = ? ORDER BY created',
+                               (eventid,)).fetchall()
+
+    def timeline(self, trace_id):
+        """Return the spans of a trace.
+
+        Args:
+            trace_id (str): The trace ID.
+
+        Returns:
+            list: (name, start, end, status, detail) tuples in order of
+            their start times.
+        """
+        with closing(self._connect()) as con:
+            return con.execute('SELECT name, start, end, status, detail '
+                               'FROM spans WHERE trace_id = ? '
+                               'ORDER BY start, end', (trace_id,)).fetchall()
+
+    def slowest(self, since, limit=10):
+        """Return the traces that took the longest.
+
+        Args:
+            since (float): Only consider traces created after this time.
+            limit (int): The number of traces to return.
+
+        Returns:
+            list: (trace_id, eventid, created, total) tuples, where total
+            is the time from the start of the trace to the end of its
+            last span, slowest first.
+        """
+        with closing(self._connect()) as con:
+            return con.execute(
+                'SELECT t.trace_id, t.eventid, t.created, '
+                'MAX(s.end) - t.created AS total '
+                'FROM traces t JOIN spans s ON s.trace_id = t.trace_id '
+                'WHERE t.created >= ? '
+                'GROUP BY t.trace_id ORDER BY total DESC LIMIT ?',
+                (since, limit)).fetchall()
+
+
+class NullTraceStore(object):
+    """A stand-in for TraceStore when tracing is turned off.
+    """
+
+    def new_trace(self, eventid, created=None):
+        return None
+
+    def find_trace(self, eventid):
+        return None
+
+    def event_trace(self, eventid):
+        return None
+
+    def record(self, trace_id, name, start, end, status='ok', detail=''):
+        return False
+
+    @contextmanager
+    def span(self, trace_id, name, detail=''):
+        yield
+
+
+def get_trace_file(install_path):
+    """Return the path to the trace store.
+
+    Args:
+        install_path (str): The ShakeMap install path.
+
+    Returns:
+        str: The path.
+    """
+    return os.path.join(install_path, 'data', TRACE_DB)
+
+
+def get_trace_store(install_path, config, logger=None):
+    """Open the trace store if tracing is turned on in aqms.conf.
+
+    Args:
+        install_path (str): The ShakeMap install path.
+        config (dict): The AQMS configuration dictionary.
+        logger (logger): A logger for errors writing to the store.
+
+    Returns:
+        TraceStore: The trace store, or a NullTraceStore if tracing is
+        turned off or the store can't be opened.
+    """
+    if not config['tracing']:
+        return NullTraceStore()
+    datadir = os.path.join(install_path, 'data')
+    try:
+        if not os.path.isdir(datadir):
+            os.makedirs(datadir)
+        return TraceStore(get_trace_file(install_path),
+                          keep_days=config['trace_days'], logger=logger)
+    except (OSError, sqlite3.Error) as err:
+        if logger is not None:
+            logger.warning('Could not open trace store: %s', err)
+        return NullTraceStore()
@@ -0,0 +1,288 @@
+# stdlib imports
+import os
+import os.path
+import socket
+import sqlite3
+import time
+from contextlib import closing
+
+WORK_QUEUE_DB = 'aqms_workqueue.db'
+
+# How long finished jobs are kept (days)
+KEEP_DAYS = 7
+
+TABLES = ("CREATE TABLE IF NOT EXISTS jobs ("
+          "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+          "action TEXT NOT NULL, "
+          "eventid TEXT NOT NULL, "
+          "received REAL NOT NULL, "
+          "state TEXT NOT NULL DEFAULT 'pending', "
+          "owner TEXT, "
+          "leased REAL, "
+          "expires REAL, "
+          "attempts INTEGER NOT NULL DEFAULT 0, "
+          "finished REAL, "
+          "result TEXT)",
+          "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, expires)",
+          "CREATE INDEX IF NOT EXISTS jobs_event ON jobs (eventid, state)")
+
+# A job is waiting if it is pending or its lease has expired
+WAITING = "(%(t)s.state = 'pending' OR " \
+          "(%(t)s.state = 'leased' AND %(t)s.expires < :now))"
+
+# Only the oldest waiting job of an event may be leased, and only while
+# no other job of the event is leased, so that the jobs of an event are
+# done one at a time and in order; among events, cancels are leased
+# first, and otherwise jobs go in order of arrival
+LEASE_QUERY = ("SELECT id, attempts FROM jobs AS j WHERE " +
+               WAITING % {'t': 'j'} +
+               " AND NOT EXISTS (SELECT 1 FROM jobs AS k "
+               "WHERE k.eventid = j.eventid AND k.id != j.id "
+               "AND ((k.state = 'leased' AND k.expires >= :now) OR "
+               "(k.id < j.id AND " + WAITING % {'t': 'k'} + "))) "
+               "ORDER BY action != 'cancel', id LIMIT 1")
+
+# A cancel completes the waiting jobs of its event received before it
+SUPERSEDE_QUERY = ("UPDATE jobs SET state = 'done', finished = :now, "
+                   "result = 'superseded by cancel' "
+                   "WHERE eventid = :eventid AND action != 'cancel' "
+                   "AND received <= :received AND " +
+                   WAITING % {'t': 'jobs'})
+
+
+class Job(object):
+    """A leased job.
+    """
+
+    def __init__(self, row):
+        (self.id, self.action, self.eventid, self.received, self.leased,
+         self.attempts) = row
+
+
+def worker_name():
+    """Return a name for this worker process, unique across the
+    processes on this host.
+    """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """A work queue shared by the processes of aqms_queue, kept in a
+    local SQLite database in WAL mode.
+
+    The listeners put the messages they receive on the queue; workers
+    lease jobs one at a time, process them, and mark them done. Leasing
+    is a single write transaction, so a job is handed to one worker at a
+    time. The jobs of an event are leased one at a time, in the order
+    they were received, and a cancel supersedes the origins of its event
+    that are still waiting. A job whose worker dies (so that its lease
+    expires) is leased again, up to max_attempts times; a worker renews
+    its lease just before sending anything on, so a job is only sent
+    twice if its worker dies between sending it and marking it done.
+    """
+
+    def __init__(self, path, lease_time=300, max_attempts=3):
+        """Open (or create) the work queue.
+
+        Args:
+            path (str): The path to the SQLite file.
+            lease_time (float): How long (s) a worker may hold a job
+                before it is given to another worker.
+            max_attempts (int): The number of times a job is leased
+                before it is marked as failed.
+        """
+        self.path = path
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        with closing(self._connect()) as con:
+            con.execute('PRAGMA journal_mode = WAL')
+            for sql in TABLES:
+                con.execute(sql)
+            con.commit()
+
+    def _connect(self):
+        # Transactions are managed explicitly (BEGIN IMMEDIATE takes the
+        # write lock up front, so two workers can't lease the same job)
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def put(self, action, eventid, received=None, since=None):
+        """Add a job. A cancel supersedes the waiting jobs of its event
+        that were received before it: they are marked done without being
+        handed to a worker.
+
+        Args:
+            action (str): 'origin', 'rerun', or 'cancel'.
+            eventid (str): The event ID.
+            received (float): The time the message was received; defaults
+                to now.
+            since (float): For a rerun, the time of the event's alarm;
+                the rerun isn't queued if the event has been cancelled
+                since then.
+
+        Returns:
+            int: The job ID, or None if the rerun wasn't queued.
+        """
+        now = time.time()
+        received = now if received is None else received
+        with closing(self._connect()) as con:
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                if since is not None and \
+                        self._cancelled(con, eventid, since):
+                    con.execute('COMMIT')
+                    return None
+                cursor = con.execute('INSERT INTO jobs (action, eventid, '
+                                     'received) VALUES (?, ?, ?)',
+                                     (action, eventid, received))
+                job_id = cursor.lastrowid
+                if action == 'cancel':
+                    con.execute(SUPERSEDE_QUERY,
+                                {'now': now, 'eventid': eventid,
+                                 'received': received})
+                con.execute('COMMIT')
+            except BaseException:
+                con.execute('ROLLBACK')
+                raise
+            return job_id
+
+    def _cancelled(self, con, eventid, since):
+        return con.execute("SELECT 1 FROM jobs WHERE eventid = ? "
+                           "AND action = 'cancel' AND received >= ? "
+                           "LIMIT 1", (eventid, since)).fetchone() is not None
+
+    def cancelled(self, eventid, since):
+        """Check whether an event has been cancelled.
+
+        Args:
+            eventid (str): The event ID.
+            since (float): The time of the event's alarm.
+
+        Returns:
+            bool: True if a cancel of the event was received at or after
+            since.
+        """
+        with closing(self._connect()) as con:
+            return self._cancelled(con, eventid, since)
+
+    def lease(self, owner):
+        """Lease the next job.
+
+        Args:
+            owner (str): The name of the worker (see worker_name()).
+
+        Returns:
+            Job: The job, or None if there is nothing to do.
+        """
+        now = time.time()
+        with closing(self._connect()) as con:
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                while True:
+                    row = con.execute(LEASE_QUERY, {'now': now}).fetchone()
+                    if row is None:
+                        con.execute('COMMIT')
+                        return None
+                    job_id, attempts = row
+                    if attempts >= self.max_attempts:
+                        con.execute("UPDATE jobs SET state = 'failed', "
+                                    "finished = ?, result = ? WHERE id = ?",
+                                    (now, 'lease expired %d times' %
+                                     attempts, job_id))
+                        continue
+                    con.execute("UPDATE jobs SET state = 'leased', "
+                                "owner = ?, leased = ?, expires = ?, "
+                                "attempts = attempts + 1 WHERE id = ?",
+                                (owner, now, now + self.lease_time, job_id))
+                    row = con.execute('SELECT id, action, eventid, '
+                                      'received, leased, attempts '
+                                      'FROM jobs WHERE id = ?',
+                                      (job_id,)).fetchone()
+                    con.execute('COMMIT')
+                    return Job(row)
+            except BaseException:
+                con.execute('ROLLBACK')
+                raise
+
+    def renew(self, job, owner):
+        """Extend the lease on a job. A worker calls this just before it
+        does anything that can't be undone, so that a job whose lease
+        has expired and been given to another worker is not acted on
+        twice.
+
+        Args:
+            job (Job): The job.
+            owner (str): The name of the worker.
+
+        Returns:
+            bool: True if the job is still leased by this worker.
+        """
+        now = time.time()
+        with closing(self._connect()) as con:
+            cursor = con.execute("UPDATE jobs SET expires = ? WHERE id = ? "
+                                 "AND owner = ? AND state = 'leased' "
+                                 "AND expires >= ?",
+                                 (now + self.lease_time, job.id, owner, now))
+            return cursor.rowcount == 1
+
+    def complete(self, job, owner, result='done', failed=False):
+        """Mark a leased job as finished.
+
+        Args:
+            job (Job): The job.
+            owner (str): The name of the worker.
+            result (str): A note on the outcome.
+            failed (bool): True if the job failed and should not be
+                retried.
+
+        Returns:
+            bool: True if the job was still leased by this worker; False
+            if the lease had expired and been given to another worker.
+        """
+        state = 'failed' if failed else 'done'
+        with closing(self._connect()) as con:
+            cursor = con.execute("UPDATE jobs SET state = ?, finished = ?, "
+                                 "result = ? WHERE id = ? AND owner = ? "
+                                 "AND state = 'leased'",
+                                 (state, time.time(), result, job.id, owner))
+            return cursor.rowcount == 1
+
+    def counts(self):
+        """Return the number of jobs in each state.
+
+        Returns:
+            dict: Counts keyed by state.
+        """
+        with closing(self._connect()) as con:
+            return dict(con.execute('SELECT state, COUNT(*) FROM jobs '
+                                    'GROUP BY state').fetchall())
+
+    def prune(self, days=KEEP_DAYS):
+        """Remove finished jobs older than a number of days.
+
+        Returns:
+            int: The number of jobs removed.
+        """
+        cutoff = time.time() - days * 86400
+        with closing(self._connect()) as con:
+            cursor = con.execute("DELETE FROM jobs WHERE state IN "
+                                 "('done', 'failed') AND finished < ?",
+                                 (cutoff,))
+            return cursor.rowcount
+
+
+def get_work_queue(install_path, queue_conf):
+    """Open the work queue in the install path's data directory.
+
+    Args:
+        install_path (str): The ShakeMap install path.
+        queue_conf (dict): The aqms_queue configuration.
+
+    Returns:
+        WorkQueue: The work queue.
+    """
+    datadir = os.path.join(install_path, 'data')
+    if not os.path.isdir(datadir):
+        os.makedirs(datadir)
+    return WorkQueue(os.path.join(datadir, WORK_QUEUE_DB),
+                     lease_time=queue_conf['lease_time'],
+                     max_attempts=queue_conf['max_attempts'])
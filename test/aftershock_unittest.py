@@ -64,6 +64,31 @@ class TestAftershock(unittest.TestCase):
         self.__class__._connection.commit()
         self.assertTrue(self.DB.cleanupAftershockZones(2))
 
+    def testD_ZoneMirror(self):
+        """Tests that the zones in memory agree with the database"""
+        self.assertEqual(self.DB.defineAftershockZone(self.event), 0)
+        for lat in [35.0 + 0.05 * i for i in range(30)]:
+            for lon in [116.8 + 0.05 * i for i in range(30)]:
+                event = dict(self.insideRegionEvent, lat=lat, lon=lon)
+                self.assertEqual(self.DB.checkAftershockZone(event),
+                                 self.DB.checkAftershockZone(event,
+                                                             mirror=False))
+        # A change made by another process is seen
+        self.__class__._cursor.execute('DELETE FROM excludes;')
+        self.__class__._connection.commit()
+        self.assertEqual(
+            self.DB.checkAftershockZone(self.insideRegionEvent)[0], 0)
+
+    def testE_MirrorKept(self):
+        """Tests that the mirror is only reloaded when the zones change"""
+        self.assertEqual(self.DB.defineAftershockZone(self.event), 0)
+        self.DB.checkAftershockZone(self.insideRegionEvent)
+        version = self.DB._mirror.version
+        self.assertIsNotNone(version)
+        # Nothing has expired, so nothing is deleted
+        self.assertTrue(self.DB.cleanupAftershockZones(2))
+        self.assertEqual(self.DB._mirror.version, version)
+
 
 
     @classmethod
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""amps_unittest runs unit tests on merging the amps from several
+databases (query_mode 4), on the station distances, and on the columnar
+amp files"""
+
+import logging
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pandas as pd
+
+from shakemap_aqms.ampfiles import write_columnar, read_amps, load_amps
+from shakemap_aqms.amps import (COLUMNS, merge_amps, add_distances,
+                                get_max_distance, locate_amps,
+                                rank_databases, get_amps)
+
+T0 = datetime(2020, 1, 1)
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_row(sta, imt, value, lddate, location='--', lat=34.0):
+    return ('CI.' + sta, 'HNE', imt, value, lat, -118.0, 'CI', 0, sta,
+            'Somewhere', 'SCSN', location, lddate)
+
+
+class TestMergeAmps(unittest.TestCase):
+    """Checks the merge rules"""
+    def setUp(self):
+        self.logger = logging.getLogger('amps_unittest')
+        self.dba = pd.DataFrame.from_records(
+            [make_row('ABC', 'pga', 1.0, T0),
+             make_row('DEF', 'pga', 2.0, T0)], columns=COLUMNS)
+        self.dbb = pd.DataFrame.from_records(
+            [make_row('ABC', 'pga', 1.5, T0 + timedelta(days=1)),
+             make_row('DEF', 'pga', 2.5, T0),
+             make_row('DEF', 'pga', 2.7, T0, location='01'),
+             make_row('GHI', 'pgv', 3.0, None)], columns=COLUMNS)
+
+    def _merge(self, rule, priority=()):
+        config = {'merge_rule': rule, 'merge_priority': list(priority)}
+        df = merge_amps([('dbb', self.dbb), ('dba', self.dba)], config,
+                        self.logger)
+        return {(r.station, r.location): (r.value, r.provenance)
+                for r in df.itertuples()}
+
+    def testA_Lddate(self):
+        """Tests that the newest amp wins, with ties going by priority"""
+        merged = self._merge('lddate')
+        self.assertEqual(len(merged), 4)
+        self.assertEqual(merged[('CI.ABC', '--')], (1.5, 'dbb'))
+        self.assertEqual(merged[('CI.DEF', '--')], (2.0, 'dba'))
+        self.assertEqual(merged[('CI.DEF', '01')], (2.7, 'dbb'))
+        self.assertEqual(merged[('CI.GHI', '--')], (3.0, 'dbb'))
+
+    def testB_Priority(self):
+        """Tests that the database priority decides"""
+        merged = self._merge('priority', priority=['dbb'])
+        self.assertEqual(merged[('CI.ABC', '--')], (1.5, 'dbb'))
+        self.assertEqual(merged[('CI.DEF', '--')], (2.5, 'dbb'))
+        merged = self._merge('priority')
+        self.assertEqual(merged[('CI.ABC', '--')], (1.0, 'dba'))
+
+    def testC_Deterministic(self):
+        """Tests that the order of the inputs doesn't matter"""
+        config = {'merge_rule': 'lddate', 'merge_priority': []}
+        df1 = merge_amps([('dbb', self.dbb), ('dba', self.dba)], config,
+                         self.logger)
+        df2 = merge_amps([('dba', self.dba), ('dbb', self.dbb)], config,
+                         self.logger)
+        pd.testing.assert_frame_equal(df1, df2)
+
+
+class TestDistances(unittest.TestCase):
+    """Checks the station distances and the distance culling"""
+    def setUp(self):
+        self.logger = logging.getLogger('amps_unittest')
+        self.df = pd.DataFrame.from_records(
+            [make_row('ABC', 'pga', 1.0, T0, lat=34.0),
+             make_row('DEF', 'pga', 2.0, T0, lat=35.0),
+             make_row('GHI', 'pga', 3.0, T0, lat=38.0)], columns=COLUMNS)
+        self.config = {'max_distance_mags': [3.0, 5.0],
+                       'max_distance_radii': [100.0, 300.0]}
+
+    def testA_Distances(self):
+        """Tests the great circle distances"""
+        df = add_distances(self.df, 34.0, -118.0)
+        # One degree of latitude is about 111.2 km
+        self.assertAlmostEqual(df['distance'].iloc[0], 0.0)
+        self.assertAlmostEqual(df['distance'].iloc[1], 111.19, places=1)
+        self.assertAlmostEqual(df['distance'].iloc[2], 444.78, places=1)
+
+    def testB_MaxDistance(self):
+        """Tests the interpolation of the maximum distance"""
+        self.assertEqual(get_max_distance(2.0, self.config), 100.0)
+        self.assertEqual(get_max_distance(4.0, self.config), 200.0)
+        self.assertEqual(get_max_distance(6.0, self.config), 300.0)
+        self.assertIsNone(get_max_distance(
+            4.0, {'max_distance_mags': [], 'max_distance_radii': []}))
+        with self.assertRaises(ValueError):
+            get_max_distance(4.0, {'max_distance_mags': [3.0],
+                                   'max_distance_radii': []})
+
+    def testC_Cull(self):
+        """Tests that far-off stations are dropped"""
+        ampsets = locate_amps([('dba', self.df)], 34.0, -118.0, 4.0,
+                              self.config, self.logger)
+        self.assertEqual(list(ampsets[0][1]['station']),
+                         ['CI.ABC', 'CI.DEF'])
+        ampsets = locate_amps([('dba', self.df.iloc[2:])], 34.0, -118.0,
+                              4.0, self.config, self.logger)
+        self.assertEqual(ampsets, [])
+
+
+
+class TestColumnar(unittest.TestCase):
+    """Checks the Parquet and HDF5 amp files"""
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        df = pd.DataFrame.from_records(
+            [make_row('ABC', 'pga', 1.23456789, T0),
+             make_row('DEF', 'pgv', 2.0, T0 + timedelta(hours=1),
+                      location='01', lat=35.123456)], columns=COLUMNS)
+        self.df = add_distances(df, 34.0, -118.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testA_RoundTrip(self):
+        """Tests that both formats read back the same table"""
+        for fmt, ext in (('parquet', '.parquet'), ('hdf5', '.h5')):
+            path = write_columnar(self.df, self.tempdir, 'dba', fmt)
+            self.assertEqual(path, os.path.join(self.tempdir,
+                                                'dba_dat' + ext))
+            df = read_amps(path)
+            pd.testing.assert_frame_equal(df, self.df, check_dtype=False)
+
+    def testB_Load(self):
+        """Tests loading every amp set in a directory"""
+        write_columnar(self.df, self.tempdir, 'dbb', 'hdf5')
+        write_columnar(self.df.iloc[:1], self.tempdir, 'dba', 'parquet')
+        write_columnar(self.df.iloc[:1], self.tempdir, 'dba', 'hdf5')
+        ampsets = load_amps(self.tempdir)
+        self.assertEqual([name for name, _ in ampsets], ['dba', 'dbb'])
+        self.assertEqual(len(ampsets[0][1]), 1)
+        self.assertEqual(len(ampsets[1][1]), 2)
+
+    def testC_NoDatabaseClient(self):
+        """Tests that the files can be read without cx_Oracle"""
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [PACKAGE_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+        proc = subprocess.run(
+            [sys.executable, '-c', 'import sys, shakemap_aqms.ampfiles; '
+             'print("cx_Oracle" in sys.modules)'],
+            stdout=subprocess.PIPE, env=env, universal_newlines=True,
+            check=True)
+        self.assertEqual(proc.stdout.strip(), 'False')
+
+
+class FakeConnector(object):
+    def dbnames(self):
+        return ['dba', 'dbb', 'dbc']
+
+
+class TestChooseDatabase(unittest.TestCase):
+    """Checks the choice of database for query_modes 1 and 2"""
+    def setUp(self):
+        self.logger = logging.getLogger('amps_unittest')
+        self.dbnames = ['dba', 'dbb', 'dbc']
+        self.counts = {'dba': 3, 'dbb': 12, 'dbc': 12}
+        self.stations = {'dba': 3, 'dbb': 10, 'dbc': 12}
+
+    def _get_amps(self, config):
+        fetched = []
+
+        def query_amps(connector, dbname, eventid, stadict, config, logger):
+            fetched.append(dbname)
+            return pd.DataFrame.from_records(
+                [make_row('S%02d' % ix, 'pga', 1.0, T0)
+                 for ix in range(self.stations[dbname])], columns=COLUMNS)
+
+        with mock.patch('shakemap_aqms.amps.count_stations',
+                        return_value=self.counts), \
+                mock.patch('shakemap_aqms.amps.query_amps', query_amps):
+            ampsets = get_amps(FakeConnector(), 'ci1234', {}, config,
+                               self.logger)
+        return [dbname for dbname, _ in ampsets], fetched
+
+    def testA_Rank(self):
+        """Tests the order in which the databases are tried"""
+        config = {'query_mode': 2, 'query_min_stas': 1}
+        self.assertEqual(rank_databases(self.dbnames, self.counts, config),
+                         ['dbb', 'dbc', 'dba'])
+        config = {'query_mode': 1, 'query_min_stas': 5}
+        self.assertEqual(rank_databases(self.dbnames, self.counts, config),
+                         ['dbb', 'dbc', 'dba'])
+        config = {'query_mode': 1, 'query_min_stas': 1}
+        self.assertEqual(rank_databases(self.dbnames, self.counts, config),
+                         ['dba', 'dbb', 'dbc'])
+        counts = {'dba': 0, 'dbc': 4}
+        self.assertEqual(rank_databases(self.dbnames, counts, config),
+                         ['dbc'])
+
+    def testB_Fetch(self):
+        """Tests that only the chosen database's amps are fetched"""
+        # dbb has fewer usable stations than dbc's count, so dbc is
+        # fetched too, and has more
+        self.assertEqual(self._get_amps({'query_mode': 2,
+                                         'query_min_stas': 1}),
+                         (['dbc'], ['dbb', 'dbc']))
+        self.assertEqual(self._get_amps({'query_mode': 1,
+                                         'query_min_stas': 1}),
+                         (['dba'], ['dba']))
+        # dbb has fewer usable stations than its count
+        self.assertEqual(self._get_amps({'query_mode': 1,
+                                         'query_min_stas': 11}),
+                         (['dbc'], ['dbb', 'dbc']))
+        # No database has enough; the one with the most stations is used
+        self.assertEqual(self._get_amps({'query_mode': 1,
+                                         'query_min_stas': 20}),
+                         (['dbc'], ['dbb', 'dbc', 'dba']))
+        # No other database can have more usable stations than dbb
+        self.stations['dbb'] = 12
+        self.assertEqual(self._get_amps({'query_mode': 2,
+                                         'query_min_stas': 1}),
+                         (['dbb'], ['dbb']))
+
+
+if __name__ == '__main__':
+    unittest.main()
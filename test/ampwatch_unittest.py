@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""ampwatch_unittest runs unit tests on the watcher that reruns events
+when their amps change"""
+
+import logging
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from shakemap_aqms.alarms import AlarmProcessor
+from shakemap_aqms.ampwatch import AmpWatcher
+from shakemap_aqms.prefetch import get_prefetch_dir, write_prefetch
+from shakemap_aqms.scheduler import AlarmScheduler, WorkItem
+from shakemap_aqms.workqueue import WorkQueue
+
+T0 = datetime(2020, 1, 1)
+
+CONFIG = {'watch_schedule': [60, 120, 180], 'watch_new_stations': 3,
+          'watch_near_distance': 20, 'watch_high_pga': 10}
+
+EVENT = {'id': '1234', 'lat': 34.0, 'lon': -118.0, 'time': T0}
+
+
+class FakeWatcher(AmpWatcher):
+    """Serves the amps of an event from a list"""
+    def __init__(self, fired):
+        super().__init__('/nonexistent', self.record, logging.getLogger(
+            'ampwatch_unittest'))
+        self.amps = []
+        self.fired = fired
+        self.fetches = 0
+        # What fire() returns
+        self.accept = True
+
+    def record(self, eventid, reasons, since):
+        self.fired.append((eventid, reasons))
+        return self.accept
+
+    def add(self, netsta, amp, minutes, amptype='PGV'):
+        self.amps.append((netsta, amptype, amp,
+                          T0 + timedelta(minutes=minutes)))
+
+    def query_summary(self, eventids):
+        if not self.amps:
+            return {}
+        return {'1234': (len(set(amp[0] for amp in self.amps)),
+                         len(self.amps), max(amp[3] for amp in self.amps))}
+
+    def query_new(self, eventid, since):
+        self.fetches += 1
+        return [amp for amp in self.amps if amp[3] > since]
+
+    def get_coords(self, watched):
+        return {'CI.NEAR': (34.05, -118.0), 'CI.FAR1': (36.0, -118.0)}
+
+
+class TestAmpWatcher(unittest.TestCase):
+    """Checks when the events are run again"""
+    def setUp(self):
+        self.fired = []
+        self.watcher = FakeWatcher(self.fired)
+        self.watcher.add('CI.FAR1', 1.0, 1)
+        self.watcher.watch(EVENT, started=0)
+        # The baseline
+        self.assertEqual(self.watcher.poll(1, CONFIG), [])
+
+    def testA_NoChange(self):
+        """Tests that unchanged amps aren't fetched or run"""
+        self.assertEqual(self.watcher.poll(60, CONFIG), [])
+        self.assertEqual(self.watcher.fetches, 0)
+        # Not due yet
+        self.watcher.add('CI.NEAR', 1.0, 2)
+        self.assertEqual(self.watcher.poll(90, CONFIG), [])
+        self.assertEqual(self.watcher.fetches, 0)
+
+    def testB_Stations(self):
+        """Tests that enough new stations cause a rerun"""
+        self.watcher.add('CI.FAR2', 1.0, 2)
+        self.watcher.add('CI.FAR3', 1.0, 2)
+        self.assertEqual(self.watcher.poll(60, CONFIG), [])
+        self.watcher.add('CI.FAR4', 1.0, 3)
+        self.watcher.add('CI.FAR1', 2.0, 3)
+        self.assertEqual(self.watcher.poll(120, CONFIG), ['1234'])
+        self.assertEqual(self.fired, [('1234', ['3 new stations'])])
+        # The new stations are now part of the run
+        self.watcher.add('CI.FAR5', 1.0, 4)
+        self.assertEqual(self.watcher.poll(180, CONFIG), [])
+
+    def testC_NearAndHigh(self):
+        """Tests that a near station or a high PGA causes a rerun"""
+        self.watcher.add('CI.NEAR', 1.0, 2)
+        self.assertEqual(self.watcher.poll(60, CONFIG), ['1234'])
+        self.assertIn('new station CI.NEAR at 5.6 km', self.fired[0][1])
+        self.watcher.add('CI.FAR1', 25.0, 3, amptype='PGA')
+        self.assertEqual(self.watcher.poll(120, CONFIG), ['1234'])
+        self.assertEqual(self.fired[1][1], ['PGA 25.0 %g at CI.FAR1'])
+        # Only the first high PGA of a station counts
+        self.watcher.add('CI.FAR1', 30.0, 4, amptype='PGA')
+        self.assertEqual(self.watcher.poll(180, CONFIG), [])
+
+    def testD_Schedule(self):
+        """Tests that the event is forgotten after the schedule"""
+        for now in (60, 120, 180):
+            self.watcher.poll(now, CONFIG)
+        self.assertEqual(len(self.watcher), 1)
+        self.watcher.poll(240, CONFIG)
+        self.assertEqual(len(self.watcher), 0)
+
+    def testE_NotQueued(self):
+        """Tests that changes are looked at again if the rerun couldn't
+        be queued"""
+        self.watcher.accept = False
+        self.watcher.add('CI.FAR1', 25.0, 2, amptype='PGA')
+        self.assertEqual(self.watcher.poll(60, CONFIG), [])
+        self.watcher.accept = True
+        self.assertEqual(self.watcher.poll(120, CONFIG), ['1234'])
+        expected = ('1234', ['PGA 25.0 %g at CI.FAR1'])
+        self.assertEqual(self.fired, [expected, expected])
+
+    def testF_Restarted(self):
+        """Tests that a re-alarm during a poll restarts the event"""
+        query_new = self.watcher.query_new
+
+        def realarm(eventid, since):
+            self.watcher.watch(EVENT)
+            return query_new(eventid, since)
+
+        self.watcher.query_new = realarm
+        self.watcher.add('CI.NEAR', 1.0, 2)
+        self.assertEqual(self.watcher.poll(60, CONFIG), ['1234'])
+        self.watcher.query_new = query_new
+        # The poll's state was dropped; the next poll takes the amps
+        # now as those of the re-alarm's run
+        self.assertEqual(self.watcher.poll(61, CONFIG), [])
+        self.watcher.add('CI.FAR2', 1.0, 3)
+        self.assertEqual(self.watcher.poll(120, CONFIG), [])
+        self.assertEqual(self.watcher.fetches, 2)
+        self.assertEqual(len(self.fired), 1)
+
+
+class TestRerun(unittest.TestCase):
+    """Checks that the reruns go through the queues"""
+    def setUp(self):
+        self.install_path = tempfile.mkdtemp()
+        self.sent = []
+        patcher = mock.patch('shakemap_aqms.alarms.get_aqms_config',
+                             return_value={'prefetch_max_age': 120})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.install_path)
+
+    def processor(self, scheduler, work_queue=None):
+        return AlarmProcessor(
+            self.install_path, scheduler,
+            logging.getLogger('ampwatch_unittest'),
+            get_eqinfo=lambda eventid, config, logger: dict(EVENT,
+                                                            id=eventid),
+            send=lambda action, data: self.sent.append((action,
+                                                        data['id'])),
+            prefetch=lambda event: None, work_queue=work_queue)
+
+    def testA_Scheduler(self):
+        """Tests that a rerun is queued, and sent without the old
+        prefetched data, unless its event has been cancelled"""
+        scheduler = AlarmScheduler()
+        processor = self.processor(scheduler)
+        since = time.time() - 60
+        scheduler.put(WorkItem('cancel', '1234'))
+        scheduler.get(timeout=0)
+        self.assertFalse(processor.rerun('1234', ['3 new stations'], since))
+        self.assertTrue(processor.rerun('5678', ['3 new stations'], since))
+        write_prefetch(self.install_path, '5678', {}, [])
+        item = scheduler.get(timeout=0)
+        self.assertEqual((item.action, item.eventid), ('rerun', '5678'))
+        self.assertIsNone(scheduler.get(timeout=0))
+        self.assertTrue(processor.process(item))
+        self.assertEqual(self.sent, [('origin', '5678')])
+        self.assertFalse(os.path.isdir(get_prefetch_dir(self.install_path,
+                                                        '5678')))
+        # A cancel drops a queued rerun
+        self.assertTrue(processor.rerun('5678', ['3 new stations'], since))
+        scheduler.put(WorkItem('cancel', '5678'))
+        self.assertEqual(scheduler.get(timeout=0).action, 'cancel')
+        self.assertIsNone(scheduler.get(timeout=0))
+
+    def testB_WorkQueue(self):
+        """Tests that a rerun is put on the work queue unless its event
+        has been cancelled, even by another worker"""
+        work_queue = WorkQueue(os.path.join(self.install_path, 'wq.db'))
+        processor = self.processor(None, work_queue)
+        since = time.time() - 60
+        work_queue.put('cancel', '1234')
+        self.assertFalse(processor.rerun('1234', ['3 new stations'], since))
+        self.assertTrue(processor.rerun('5678', ['3 new stations'], since))
+        job = work_queue.lease('w')
+        self.assertEqual((job.action, job.eventid), ('cancel', '1234'))
+        job = work_queue.lease('w')
+        self.assertEqual((job.action, job.eventid), ('rerun', '5678'))
+        self.assertTrue(processor.handle(job))
+        self.assertEqual(self.sent, [('origin', '5678')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""batch_unittest runs unit tests on the selection and processing of
+events by aqms_batch"""
+
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import pandas as pd
+
+from shakemap_aqms.amps import COLUMNS
+from shakemap_aqms.batch import (MAX_BINDS, ORIGIN_QUERY, BatchProcessor,
+                                 select_events)
+from shakemap_aqms.db import Connector, DBHealth
+from shakemap_aqms.stations import ChannelEpochs
+
+CONFIG = {'dbs': {'dba': {}, 'dbb': {}, 'dbc': {}},
+          'db_failure_threshold': 2, 'db_retry_interval': 60,
+          'db_order': 'lexicographic', 'connect_timeout': 0,
+          'call_timeout': 0, 'adhoc_file': '', 'query_mode': 2,
+          'query_min_stas': 1, 'max_distance_mags': [],
+          'max_distance_radii': [], 'columnar_format': 'none'}
+
+# The events in the database: (evid, time, lat, lon, mag)
+EVENTS = [
+    (1001, '2020/01/01 00:00:30.000', 34.0, -118.0, 3.5),
+    (1002, '2020/01/02 12:00:00.500', 35.0, -117.0, 4.5),
+    (1003, '2019/12/31 23:59:30.000', 34.0, -118.0, 5.0),
+]
+
+EPOCHS = [('Caltech', 'CI', 'S%02d' % ix, 'HNE', '  ', 34.0, -118.0,
+           100.0, 'Station', datetime(2000, 1, 1), datetime(3000, 1, 1))
+          for ix in range(12)]
+
+
+class FakeCursor(object):
+    """Returns every event for any origin query; the query itself is
+    recorded"""
+    def __init__(self):
+        self.queries = []
+        self.arraysize = 1
+
+    def execute(self, sql, params):
+        assert sql.startswith(ORIGIN_QUERY)
+        self.queries.append((sql, params))
+        if isinstance(params, list):
+            self.rows = [row for row in EVENTS if row[0] in params]
+        else:
+            self.rows = list(EVENTS)
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+    def close(self):
+        pass
+
+
+class FakeConnector(Connector):
+    def __init__(self, config):
+        super().__init__(config, logging.getLogger('batch_unittest'),
+                         DBHealth())
+        self.cursor = FakeCursor()
+
+    def _open(self, dbname):
+        return FakeConnection(self.cursor)
+
+
+class TestSelectEvents(unittest.TestCase):
+    """Checks the selection of events by ID and by time window"""
+    def setUp(self):
+        self.logger = logging.getLogger('batch_unittest')
+        self.connector = FakeConnector(CONFIG)
+
+    def testA_Evids(self):
+        """Tests the selection by event ID"""
+        events = select_events(self.connector, self.logger,
+                               evids=['1002', '1001'])
+        self.assertEqual([ev[0] for ev in events], ['1001', '1002'])
+        self.assertEqual(events[1][1], datetime(2020, 1, 2, 12, 0, 0,
+                                                500000))
+        self.assertEqual(events[1][2:], (35.0, -117.0, 4.5))
+        # Long lists are split
+        self.connector.cursor.queries = []
+        evids = list(range(1001, 1001 + MAX_BINDS + 10))
+        events = select_events(self.connector, self.logger, evids=evids)
+        self.assertEqual([ev[0] for ev in events],
+                         ['1003', '1001', '1002'])
+        self.assertEqual([len(params) for _, params in
+                          self.connector.cursor.queries], [MAX_BINDS, 10])
+
+    def testB_Window(self):
+        """Tests the selection by time window, region and magnitude"""
+        start = datetime(2020, 1, 1)
+        end = datetime(2020, 1, 2)
+        events = select_events(self.connector, self.logger, start=start,
+                               end=end, region=[-119, -117, 33, 35],
+                               minmag=3.0)
+        # The padding of the window is removed
+        self.assertEqual([ev[0] for ev in events], ['1001'])
+        sql, params = self.connector.cursor.queries[0]
+        self.assertIn('o.lon BETWEEN :lonmin AND :lonmax', sql)
+        self.assertEqual((params['lonmin'], params['latmax'],
+                          params['minmag']), (-119, 35, 3.0))
+        self.assertLess(params['tstart'], params['tend'])
+
+    def testC_NoDatabase(self):
+        """Tests that an error is raised if no database answers"""
+        connector = FakeConnector(dict(CONFIG, dbs={}))
+        with self.assertRaises(RuntimeError):
+            select_events(connector, self.logger, evids=['1001'])
+
+
+class TestBatchProcessor(unittest.TestCase):
+    """Checks that the events' data files are written"""
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.logger = logging.getLogger('batch_unittest')
+        self.epochs = ChannelEpochs(EPOCHS, {}, None, None, self.logger)
+        self.counts = {'dba': 3, 'dbb': 12, 'dbc': 6}
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _run(self, config, events):
+        def query_amps(connector, dbname, eventid, stadict, config, logger):
+            return pd.DataFrame.from_records(
+                [('CI.' + sta, 'HNE', 'pga', 1.0, 34.0, -118.0, 'CI', 0,
+                  'Station', '', 'Caltech', '--', None)
+                 for sta in sorted(stadict)[:self.counts[dbname]]],
+                columns=COLUMNS)
+
+        processor = BatchProcessor(config, self.tempdir, self.logger,
+                                   workers=2, snapshot=self.epochs)
+        processor.connector = FakeConnector(config)
+        with mock.patch('shakemap_aqms.amps.count_stations',
+                        return_value=self.counts), \
+                mock.patch('shakemap_aqms.amps.query_amps', query_amps):
+            return processor.run(events)
+
+    def testA_QueryMode2(self):
+        """Tests that query_mode 2 writes the file of the database with
+        the most stations"""
+        events = [(evid, datetime(2020, 1, 1), 34.0, -118.0, 4.0)
+                  for evid in ('1001', '1002')]
+        self.assertEqual(self._run(CONFIG, events), {'1001': 1, '1002': 1})
+        for evid in ('1001', '1002'):
+            self.assertEqual(os.listdir(os.path.join(self.tempdir, evid,
+                                                     'current')),
+                             ['dbb_dat.xml'])
+
+    def testB_QueryMode0(self):
+        """Tests that query_mode 0 writes a file for every database"""
+        config = dict(CONFIG, query_mode=0)
+        events = [('1001', datetime(2020, 1, 1), 34.0, -118.0, 4.0)]
+        self.assertEqual(self._run(config, events), {'1001': 3})
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir, '1001',
+                                                        'current'))),
+                         ['dba_dat.xml', 'dbb_dat.xml', 'dbc_dat.xml'])
+
+
+if __name__ == '__main__':
+    unittest.main()
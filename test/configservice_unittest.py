@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""configservice_unittest runs unit tests on the cached config service"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from shakemap_aqms.configservice import ConfigService
+
+
+GOOD_CONF = """servers = host1.mydomain.xyz, host2.mydomain.xyz
+port = 2345
+aftershock = 0
+emaglimit = 2
+"""
+
+BAD_CONF = """servers = host1.mydomain.xyz
+port = not_a_port
+"""
+
+
+class TestConfigService(unittest.TestCase):
+    """Checks caching and reloading of configs"""
+    def setUp(self):
+        self.install_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.install_path, 'config'))
+        self.conf_file = os.path.join(self.install_path, 'config',
+                                      'aqms_queue.conf')
+        self._bump = 0
+        self._write(GOOD_CONF)
+        self.service = ConfigService(self.install_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.install_path)
+
+    def _write(self, text):
+        with open(self.conf_file, 'w') as f:
+            f.write(text)
+        # Make sure the mtime moves even on coarse-grained filesystems
+        mtime = time.time() + self._bump
+        self._bump += 10
+        os.utime(self.conf_file, (mtime, mtime))
+
+    def testA_Cached(self):
+        """Tests that an unchanged config is served from the cache"""
+        conf1 = self.service.get('aqms_queue')
+        conf2 = self.service.get('aqms_queue')
+        self.assertIs(conf1, conf2)
+        self.assertEqual(conf1['port'], 2345)
+
+    def testB_Reload(self):
+        """Tests that a changed config is picked up"""
+        conf1 = self.service.get('aqms_queue')
+        self._write(GOOD_CONF.replace('2345', '9001'))
+        self.assertEqual(self.service.check(), ['aqms_queue'])
+        conf2 = self.service.get('aqms_queue')
+        self.assertIsNot(conf1, conf2)
+        self.assertEqual(conf2['port'], 9001)
+
+    def testC_RejectBad(self):
+        """Tests that an invalid config is rejected"""
+        conf1 = self.service.get('aqms_queue')
+        self._write(BAD_CONF)
+        self.assertEqual(self.service.reload(), [])
+        self.assertIs(self.service.get('aqms_queue'), conf1)
+        # With no good config to fall back on, the error is raised
+        with self.assertRaises(RuntimeError):
+            ConfigService(self.install_path).get('aqms_queue')
+
+
+if __name__ == '__main__':
+    unittest.main()
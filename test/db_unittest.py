@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""db_unittest runs unit tests on the tracking of the health of the
+databases and the connectors"""
+
+import logging
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import cx_Oracle
+
+from shakemap_aqms.db import (DBHealth, Connector, PooledConnector,
+                              HealthProber, is_connection_error)
+
+CONFIG = {'dbs': {'dba': {}, 'dbb': {}, 'dbc': {}},
+          'db_failure_threshold': 2, 'db_retry_interval': 60,
+          'db_order': 'lexicographic', 'connect_timeout': 0,
+          'call_timeout': 0}
+
+
+class OracleError(object):
+    """Stands in for the error object of a cx_Oracle.DatabaseError"""
+    def __init__(self, code, message=''):
+        self.code = code
+        self.message = message
+
+
+class FakeConnection(object):
+    def __init__(self, fail_query=None):
+        self.fail_query = fail_query
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self.fail_query)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor(object):
+    def __init__(self, fail_query):
+        self.fail_query = fail_query
+
+    def execute(self, sql):
+        if self.fail_query is not None:
+            raise cx_Oracle.DatabaseError(OracleError(self.fail_query))
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnector(Connector):
+    """Connects to the databases that are up"""
+    def __init__(self, config, health, down=(), fail_query=None):
+        super().__init__(config, logging.getLogger('db_unittest'), health)
+        self.down = set(down)
+        self.fail_query = fail_query
+        self.connections = []
+
+    def _open(self, dbname):
+        if dbname in self.down:
+            raise cx_Oracle.DatabaseError(OracleError(12541))
+        con = FakeConnection(self.fail_query)
+        self.connections.append(con)
+        return con
+
+
+class TestDBHealth(unittest.TestCase):
+    """Checks the circuit breakers and the ordering of the databases"""
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tempdir, 'health.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testA_Threshold(self):
+        """Tests that a circuit opens after enough failures in a row"""
+        health = DBHealth()
+        self.assertFalse(health.record_failure('dba', 2, 60))
+        health.record_success('dba', 0.1)
+        self.assertFalse(health.record_failure('dba', 2, 60))
+        self.assertFalse(health.is_open('dba'))
+        self.assertTrue(health.record_failure('dba', 2, 60))
+        self.assertTrue(health.is_open('dba'))
+        self.assertEqual(health.open_circuits(), ['dba'])
+        self.assertEqual(health.order(['dba', 'dbb']), ['dbb'])
+        # A success closes the circuit
+        self.assertTrue(health.record_success('dba', 0.1))
+        self.assertFalse(health.is_open('dba'))
+        self.assertEqual(health.open_circuits(), [])
+
+    def testB_HalfOpen(self):
+        """Tests that one attempt is let through after the retry
+        interval, and that a failure opens the circuit again"""
+        health = DBHealth()
+        health.record_failure('dba', 1, 0.1)
+        self.assertTrue(health.is_open('dba'))
+        time.sleep(0.15)
+        self.assertEqual(health.order(['dba', 'dbb']), ['dba', 'dbb'])
+        self.assertTrue(health.is_open('dba'))
+        self.assertEqual(health.order(['dba', 'dbb']), ['dbb'])
+        self.assertTrue(health.record_failure('dba', 1, 0.1))
+        self.assertTrue(health.is_open('dba'))
+        time.sleep(0.15)
+        self.assertFalse(health.is_open('dba'))
+        health.record_success('dba', 0.1)
+        self.assertFalse(health.is_open('dba'))
+        self.assertFalse(health.is_open('dba'))
+
+    def testC_AllOpen(self):
+        """Tests that when all are down they are all tried, the one that
+        failed least recently first"""
+        health = DBHealth()
+        for dbname in ('dbb', 'dbc', 'dba'):
+            health.record_failure(dbname, 1, 60)
+            time.sleep(0.01)
+        self.assertEqual(health.order(['dba', 'dbb', 'dbc']),
+                         ['dbb', 'dbc', 'dba'])
+
+    def testD_Latency(self):
+        """Tests the ordering by latency"""
+        health = DBHealth()
+        health.record_success('dba', 0.5)
+        health.record_success('dbb', 0.1)
+        self.assertEqual(health.order(['dba', 'dbb', 'dbc']),
+                         ['dba', 'dbb', 'dbc'])
+        self.assertEqual(health.order(['dba', 'dbb', 'dbc'],
+                                      by_latency=True),
+                         ['dbc', 'dbb', 'dba'])
+        # The moving average
+        health.record_success('dbb', 1.1)
+        self.assertAlmostEqual(health.latency('dbb'), 0.4)
+        self.assertEqual(health.order(['dba', 'dbb'], by_latency=True),
+                         ['dbb', 'dba'])
+        health.record_success('dbb', 1.1)
+        self.assertEqual(health.order(['dba', 'dbb'], by_latency=True),
+                         ['dba', 'dbb'])
+
+    def testE_Shared(self):
+        """Tests that the state, including the latency, is shared"""
+        health1 = DBHealth(self.state_file)
+        health2 = DBHealth(self.state_file)
+        health1.record_failure('dba', 1, 60)
+        self.assertTrue(health2.is_open('dba'))
+        health2.record_success('dba', 0.2)
+        self.assertFalse(health1.is_open('dba'))
+        self.assertAlmostEqual(health1.latency('dba'), 0.2)
+        # A small change in the latency isn't written...
+        health2.record_success('dba', 0.25)
+        time.sleep(0.01)
+        health1.record_success('dbb', 1.0)
+        health1.is_open('dba')
+        self.assertAlmostEqual(health1.latency('dba'), 0.2)
+        # ...and survives the reading of the file by the other process
+        health2.is_open('dba')
+        self.assertAlmostEqual(health2.latency('dba'), 0.215)
+        self.assertAlmostEqual(health2.latency('dbb'), 1.0)
+        # A big one is
+        health2.record_success('dba', 2.0)
+        health1.is_open('dba')
+        self.assertAlmostEqual(health1.latency('dba'), 0.7505)
+        health3 = DBHealth(self.state_file)
+        self.assertEqual(health3.order(['dba', 'dbb'], by_latency=True),
+                         ['dba', 'dbb'])
+
+
+class TestConnector(unittest.TestCase):
+    """Checks that the connectors record the health of the databases"""
+    def testA_ConnectionErrors(self):
+        """Tests which errors mean that a database is down"""
+        self.assertTrue(is_connection_error(
+            cx_Oracle.DatabaseError(OracleError(3113))))
+        self.assertTrue(is_connection_error(cx_Oracle.DatabaseError(
+            OracleError(0, 'DPI-1080: connection was closed'))))
+        self.assertFalse(is_connection_error(
+            cx_Oracle.DatabaseError(OracleError(942))))
+
+    def testB_Connect(self):
+        """Tests that failed connections open the circuit"""
+        health = DBHealth()
+        connector = FakeConnector(CONFIG, health, down=['dba'])
+        for _ in range(2):
+            with connector.connect('dba') as con:
+                self.assertIsNone(con)
+        self.assertEqual(connector.dbnames(), ['dbb', 'dbc'])
+        with connector.connect('dbb') as con:
+            self.assertIsNotNone(con)
+        self.assertTrue(con.closed)
+        self.assertIsNotNone(health.latency('dbb'))
+
+    def testC_Failed(self):
+        """Tests that only connection errors from queries count"""
+        health = DBHealth()
+        connector = FakeConnector(CONFIG, health)
+        for code in (942, 942, 3113):
+            connector.failed('dba', cx_Oracle.DatabaseError(
+                OracleError(code)))
+        self.assertFalse(health.is_open('dba'))
+        connector.failed('dba', cx_Oracle.DatabaseError(OracleError(3114)))
+        self.assertTrue(health.is_open('dba'))
+
+    def testD_Pooled(self):
+        """Tests that pooled connections are returned to their pool"""
+        config = dict(CONFIG, dbs={'dba': {'host': 'h', 'port': 1521,
+                                           'sid': 's', 'user': 'u',
+                                           'password': 'p'}})
+        with mock.patch.object(cx_Oracle, 'SessionPool',
+                               create=True) as pool_class, \
+                mock.patch.object(cx_Oracle, 'SPOOL_ATTRVAL_WAIT',
+                                  create=True), \
+                mock.patch.object(cx_Oracle, 'makedsn', create=True):
+            connector = PooledConnector(config,
+                                        logging.getLogger('db_unittest'),
+                                        health=DBHealth())
+            for _ in range(2):
+                with connector.connect('dba') as con:
+                    self.assertIs(con, pool_class.return_value.acquire())
+            self.assertEqual(pool_class.call_count, 1)
+            self.assertEqual(pool_class.return_value.release.call_count, 2)
+            connector.close()
+            pool_class.return_value.close.assert_called_once_with()
+
+    def testE_Probe(self):
+        """Tests that a probe closes the circuit of a database that has
+        come back"""
+        health = DBHealth()
+        health.record_failure('dba', 1, 60)
+        prober = HealthProber(lambda: CONFIG,
+                              logging.getLogger('db_unittest'), health)
+        self.assertFalse(prober.probe(
+            FakeConnector(CONFIG, health, down=['dba']), 'dba'))
+        self.assertTrue(health.is_open('dba'))
+        self.assertFalse(prober.probe(
+            FakeConnector(CONFIG, health, fail_query=3113), 'dba'))
+        self.assertTrue(prober.probe(FakeConnector(CONFIG, health), 'dba'))
+        self.assertFalse(health.is_open('dba'))
+
+
+if __name__ == '__main__':
+    unittest.main()
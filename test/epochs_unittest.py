@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""epochs_unittest runs unit tests on the channel epoch interval index"""
+
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from shakemap_aqms.epochs import EpochIndex
+
+
+def brute_force(keys, ondates, offdates, ts):
+    return [ix for ix in range(len(keys))
+            if ondates[ix] <= ts <= offdates[ix]]
+
+
+class TestEpochIndex(unittest.TestCase):
+    """Checks the interval index against a brute-force search"""
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.keys = []
+        ondates = []
+        offdates = []
+        # Consecutive epochs for most channels, overlapping epochs for
+        # a few, and epochs with fractional start times
+        for chan in range(200):
+            key = ('CI.S%03d' % chan, '--', 'HNE')
+            t = rng.uniform(-1.0e9, 1.0e9)
+            for _ in range(rng.randint(1, 6)):
+                length = rng.uniform(1.0e6, 5.0e8)
+                self.keys.append(key)
+                ondates.append(t)
+                if chan % 20 == 0:
+                    offdates.append(t + 3 * length)
+                else:
+                    offdates.append(t + length)
+                t += length
+        # A channel with an open-ended epoch
+        self.keys.append(('CI.OPEN', '--', 'HNZ'))
+        ondates.append(-2.2e9)
+        offdates.append(np.inf)
+        # Shuffle so that the index has to sort
+        order = rng.permutation(len(self.keys))
+        self.keys = [self.keys[ix] for ix in order]
+        self.ondates = np.array(ondates)[order]
+        self.offdates = np.array(offdates)[order]
+        self.times = np.concatenate([rng.uniform(-1.5e9, 3.0e9, 300),
+                                     self.ondates[:50], self.offdates[:50]])
+        self.index = EpochIndex(self.keys, self.ondates, self.offdates)
+
+    def testA_Active(self):
+        """Tests single-time lookups"""
+        for ts in self.times:
+            expected = brute_force(self.keys, self.ondates, self.offdates,
+                                   ts)
+            self.assertEqual(list(self.index.active(ts)), expected)
+
+    def testB_ActiveMany(self):
+        """Tests vectorized lookups over many times"""
+        tix, eix = self.index.active_many(self.times)
+        for ix, ts in enumerate(self.times):
+            expected = brute_force(self.keys, self.ondates, self.offdates,
+                                   ts)
+            self.assertEqual(list(eix[tix == ix]), expected)
+
+    def testC_ActiveSets(self):
+        """Tests that times with the same active epochs share a set"""
+        times = [0.0, 1.0, 2.0, 2.5e9]
+        sets, which = self.index.active_sets(times)
+        self.assertEqual(len(which), 4)
+        self.assertEqual(which[0], which[1])
+        for ts, ix in zip(times, which):
+            self.assertEqual(list(sets[ix]),
+                             brute_force(self.keys, self.ondates,
+                                         self.offdates, ts))
+
+    def testD_SaveLoad(self):
+        """Tests that a saved index gives the same answers"""
+        path = tempfile.mkdtemp()
+        try:
+            self.index.save(path)
+            loaded = EpochIndex.load(path)
+            tix1, eix1 = self.index.active_many(self.times)
+            tix2, eix2 = loaded.active_many(self.times)
+            np.testing.assert_array_equal(tix1, tix2)
+            np.testing.assert_array_equal(eix1, eix2)
+            del loaded
+        finally:
+            shutil.rmtree(path)
+
+    def testE_Empty(self):
+        """Tests an empty index"""
+        index = EpochIndex([], [], [])
+        self.assertEqual(len(index.active(0.0)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
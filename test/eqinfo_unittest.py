@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""eqinfo_unittest runs unit tests on the hedged event lookups"""
+
+import logging
+import threading
+import time
+import unittest
+from unittest import mock
+
+from shakemap_aqms.eqinfo import HedgeStats, hedged_query_eqinfo
+
+CONFIG = {'hedge_percentile': 95, 'hedge_min_delay': 0.05,
+          'hedge_default_delay': 0.2}
+
+
+class FakeLookups(object):
+    """Stands in for timed_query_eqinfo: each database answers (or fails,
+    with None or an exception) after its own delay"""
+    def __init__(self, answers):
+        self.answers = answers
+        self.started = {}
+        self._lock = threading.Lock()
+        self.t0 = time.time()
+
+    def __call__(self, connector, dbname, eventid, logger, places=True):
+        with self._lock:
+            self.started[dbname] = time.time() - self.t0
+        delay, result = self.answers[dbname]
+        time.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class TestHedging(unittest.TestCase):
+    """Checks that slow and failed databases are hedged against"""
+    def setUp(self):
+        self.logger = logging.getLogger('eqinfo_unittest')
+        self.stats = HedgeStats()
+        patcher = mock.patch('shakemap_aqms.eqinfo.hedge_stats', self.stats)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def lookup(self, answers, config=CONFIG):
+        lookups = FakeLookups(answers)
+        with mock.patch('shakemap_aqms.eqinfo.timed_query_eqinfo', lookups):
+            t1 = time.time()
+            result = hedged_query_eqinfo(None, sorted(answers), '1234',
+                                         config, self.logger)
+            return result, time.time() - t1, lookups.started
+
+    def testA_SlowPrimary(self):
+        """Tests that a slow database is hedged and the hedge wins"""
+        result, elapsed, started = self.lookup(
+            {'dba': (2.0, {'db': 'dba'}), 'dbb': (0.05, {'db': 'dbb'}),
+             'dbc': (0.05, {'db': 'dbc'})})
+        self.assertEqual(result, {'db': 'dbb'})
+        self.assertLess(elapsed, 1.0)
+        self.assertGreaterEqual(started['dbb'], 0.15)
+        self.assertNotIn('dbc', started)
+        summary = self.stats.summary()
+        self.assertEqual((summary['lookups'], summary['hedged']), (1, 1))
+        self.assertEqual(summary['wins'], {'dbb': 1})
+
+    def testB_FailedPrimary(self):
+        """Tests that the next database is tried at once when one fails"""
+        result, elapsed, started = self.lookup(
+            {'dba': (0.01, None), 'dbb': (0.01, {'db': 'dbb'})},
+            dict(CONFIG, hedge_default_delay=5.0))
+        self.assertEqual(result, {'db': 'dbb'})
+        self.assertLess(elapsed, 1.0)
+        self.assertLess(started['dbb'], 1.0)
+        self.assertEqual(self.stats.summary()['hedged'], 0)
+
+    def testC_AllFail(self):
+        """Tests that None is returned when no database answers"""
+        result, _, started = self.lookup(
+            {'dba': (0.01, None), 'dbb': (0.3, None), 'dbc': (0.01, None)})
+        self.assertIsNone(result)
+        self.assertEqual(sorted(started), ['dba', 'dbb', 'dbc'])
+        summary = self.stats.summary()
+        self.assertEqual(summary['lookups'], 1)
+        self.assertEqual(summary['wins'], {})
+
+    def testD_Error(self):
+        """Tests that a query that raises an error counts as a failed
+        database"""
+        result, elapsed, _ = self.lookup(
+            {'dba': (0.01, RuntimeError('ORA-03113')),
+             'dbb': (0.01, {'db': 'dbb'})},
+            dict(CONFIG, hedge_default_delay=5.0))
+        self.assertEqual(result, {'db': 'dbb'})
+        self.assertLess(elapsed, 1.0)
+        summary = self.stats.summary()
+        self.assertEqual(summary['wins'], {'dbb': 1})
+        self.assertEqual(summary['errors'], {'dba': 1})
+
+    def testE_Delay(self):
+        """Tests the hedging delay"""
+        stats = HedgeStats()
+        self.assertEqual(stats.delay('dba', CONFIG), 0.2)
+        for ix in range(1, 11):
+            stats.add_latency('dba', ix / 10)
+        self.assertAlmostEqual(
+            stats.delay('dba', dict(CONFIG, hedge_percentile=50)), 0.55)
+        self.assertAlmostEqual(stats.delay('dba', CONFIG), 0.955)
+        # No less than the minimum
+        self.assertEqual(stats.delay('dba', dict(CONFIG, hedge_percentile=0,
+                                                 hedge_min_delay=0.5)),
+                         0.5)
+        self.assertEqual(stats.delay('dbb', CONFIG), 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""geocoder_unittest runs unit tests on the local place-name geocoder"""
+
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from shakemap_aqms.eqinfo import make_locstring
+from shakemap_aqms.geocoder import (Geocoder, compass_point,
+                                    distance_azimuth)
+
+TOWNS = [(34.0522, -118.2437, 'Los Angeles, CA'),
+         (32.7157, -117.1611, 'San Diego, CA'),
+         (33.5539, -116.6742, 'Anza, CA'),
+         (36.7783, -119.4179, 'Fresno, CA')]
+
+
+class TestGeocoder(unittest.TestCase):
+    """Checks the nearest towns, distances, and directions"""
+    @classmethod
+    def setUpClass(cls):
+        cls.geocoder = Geocoder([town[0] for town in TOWNS],
+                                [town[1] for town in TOWNS],
+                                [town[2] for town in TOWNS])
+
+    def testA_Compass(self):
+        """Tests the 16 points of the compass and their boundaries"""
+        self.assertEqual(compass_point(0), 'N')
+        self.assertEqual(compass_point(11.24), 'N')
+        self.assertEqual(compass_point(11.25), 'NNE')
+        self.assertEqual(compass_point(22.5), 'NNE')
+        self.assertEqual(compass_point(90), 'E')
+        self.assertEqual(compass_point(348.74), 'NNW')
+        self.assertEqual(compass_point(348.75), 'N')
+        self.assertEqual(compass_point(-90), 'W')
+        self.assertEqual(list(compass_point([45, 180, 225])),
+                         ['NE', 'S', 'SW'])
+
+    def testB_Distance(self):
+        """Tests distances and azimuths along simple paths"""
+        dist, az = distance_azimuth(0, 0, 1, 0)
+        self.assertAlmostEqual(dist, 111.195, places=2)
+        self.assertAlmostEqual(az, 0.0)
+        dist, az = distance_azimuth(0, 0, 0, -1)
+        self.assertAlmostEqual(az, 270.0)
+        dist, az = distance_azimuth(34, -118, 33, -118)
+        self.assertAlmostEqual(az, 180.0)
+
+    def testC_Nearest(self):
+        """Tests the nearest town against a brute force search"""
+        rng = np.random.default_rng(5)
+        lats = rng.uniform(32, 37, 500)
+        lons = rng.uniform(-120, -116, 500)
+        dist, az, places = self.geocoder.nearest_many(lats, lons)
+        tlats = np.array([town[0] for town in TOWNS])
+        tlons = np.array([town[1] for town in TOWNS])
+        for ix in range(len(lats)):
+            alldist, _ = distance_azimuth(tlats, tlons, lats[ix], lons[ix])
+            self.assertEqual(places[ix], TOWNS[np.argmin(alldist)][2])
+            self.assertAlmostEqual(dist[ix], alldist.min())
+
+    def testD_Locstring(self):
+        """Tests the location string of a point north-northeast of Anza"""
+        info = self.geocoder.place_info(33.65, -116.62)
+        self.assertEqual(info['place'], 'Anza, CA')
+        self.assertEqual(info['dir'], 'NNE')
+        self.assertEqual(make_locstring(info),
+                         '11.8 km (7.3 mi) NNE of Anza, CA')
+
+    def testE_SaveLoad(self):
+        """Tests that the gazetteer survives a round trip to a file"""
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'gazetteer.npz')
+            self.geocoder.save(path)
+            geocoder = Geocoder.load(path)
+            self.assertEqual(len(geocoder), len(TOWNS))
+            self.assertEqual(geocoder.nearest(34.1, -118.2),
+                             self.geocoder.nearest(34.1, -118.2))
+        finally:
+            shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
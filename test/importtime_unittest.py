@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""importtime_unittest tracks the import cost of the light-weight modules
+of shakemap-aqms using 'python -X importtime'"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+# Packages that must not be loaded just by importing the modules below
+HEAVY_MODULES = ('cx_Oracle', 'pandas', 'numpy', 'lxml', 'pkg_resources',
+                 'shakemap', 'shakelib')
+
+# Cumulative import time budgets (microseconds) for the modules that
+# the coremods, aqms_queue, and other tools import at startup
+BUDGETS = {
+    'shakemap_aqms.util': 50000,
+    'shakemap_aqms.aftershock': 100000,
+}
+
+# The budgets depend on the machine and its load, so they are only
+# checked when this variable is set (e.g., on a quiet benchmark host)
+BUDGET_ENV = 'SHAKEMAP_AQMS_IMPORT_BUDGET'
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module):
+    """Import a module in a fresh interpreter and parse the output of
+    -X importtime.
+
+    Args:
+        module (str): The module to import.
+
+    Returns:
+        dict: The cumulative import time (us) of every module imported,
+        keyed by module name.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [PACKAGE_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           'import %s' % module],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          env=env, universal_newlines=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            # The header line
+            continue
+        times[fields[2].strip()] = cumulative
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+    """Checks that importing the light-weight modules stays cheap"""
+    def testA_NoHeavyImports(self):
+        """Tests that no heavy dependencies are loaded at import time"""
+        for module in BUDGETS:
+            times = import_times(module)
+            self.assertIn(module, times)
+            for name in times:
+                top = name.split('.')[0]
+                self.assertNotIn(top, HEAVY_MODULES,
+                                 '%s imports %s' % (module, name))
+
+    @unittest.skipUnless(os.environ.get(BUDGET_ENV),
+                         'set %s to check the import time budgets' %
+                         BUDGET_ENV)
+    def testB_Budget(self):
+        """Tests the cumulative import time against the budgets"""
+        for module, budget in BUDGETS.items():
+            # Take the best of a few runs to smooth out noise
+            best = min(import_times(module)[module] for _ in range(3))
+            self.assertLess(best, budget,
+                            '%s took %d us to import (budget %d us)' %
+                            (module, best, budget))
+
+    def testC_LazyAttributes(self):
+        """Tests that the lazily imported functions are still
+        available from shakemap_aqms.util"""
+        import shakemap_aqms.util as util
+        self.assertIn('get_eqinfo', dir(util))
+        self.assertIn('dataframe_to_xml', dir(util))
+        with self.assertRaises(AttributeError):
+            util.no_such_function
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""loadtest_unittest runs unit tests on the alarm client and the load
+test streams"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import numpy as np
+
+from shakemap_aqms.client import format_message, parse_message
+from shakemap_aqms.loadtest import (MMIN, make_stream, omori_times,
+                                    run_loadtest, summarize)
+
+QUEUE_CONF = {'queue_size': 100, 'shed_depth': 0, 'shed_magnitude': 3.0,
+              'shed_policy': 'defer', 'lookup_workers': 4,
+              'lease_time': 300, 'max_attempts': 3, 'worker_poll': 0.05}
+
+CONFIG = {'prefetch_max_age': 0, 'aftershock': 0, 'watch_amps': False}
+
+
+class TestClient(unittest.TestCase):
+    """Checks the messages sent to aqms_queue"""
+    def testA_RoundTrip(self):
+        """Tests that a formatted message parses back"""
+        data = format_message('shake_alarm', '12345', 2)
+        self.assertEqual(data, b'shake_alarm 12345 2')
+        self.assertEqual(parse_message(data), ('shake_alarm', '12345', '2'))
+
+    def testB_NoUpdate(self):
+        """Tests that the update number is optional"""
+        self.assertEqual(parse_message(b'shake_cancel 12345'),
+                         ('shake_cancel', '12345', '0'))
+        with self.assertRaises(ValueError):
+            parse_message(b'shake_alarm')
+
+
+class TestStream(unittest.TestCase):
+    """Checks the generated alarm streams"""
+    def testA_Background(self):
+        """Tests the background alarms and the cancels"""
+        messages, events = make_stream(10, 100, cancel_fraction=0.2, seed=1)
+        times = [message[0] for message in messages]
+        self.assertEqual(times, sorted(times))
+        alarms = [message for message in messages
+                  if message[1] == 'shake_alarm']
+        cancels = [message for message in messages
+                   if message[1] == 'shake_cancel']
+        self.assertEqual(len(alarms), len(events))
+        self.assertTrue(800 < len(alarms) < 1200)
+        self.assertTrue(100 < len(cancels) < 300)
+        mags = np.array([event['mag'] for event in events.values()])
+        self.assertTrue(np.all(mags >= MMIN))
+        # b = 1: about a tenth of the events are a unit bigger than MMIN
+        frac = np.mean(mags >= MMIN + 1)
+        self.assertTrue(0.06 < frac < 0.14)
+        # Every cancel follows its alarm
+        sent = {message[2]: message[0] for message in alarms}
+        for when, _, eventid in cancels:
+            self.assertGreater(when, sent[eventid])
+
+    def testB_Aftershocks(self):
+        """Tests the mainshock and its aftershocks"""
+        messages, events = make_stream(0, 100, mainshock=7.0,
+                                       mainshock_time=10, aftershocks=500,
+                                       seed=2)
+        self.assertEqual(len(messages), 501)
+        first = events[messages[0][2]]
+        self.assertEqual(first['mag'], 7.0)
+        self.assertEqual(messages[0][0], 10)
+        others = [events[message[2]]['mag'] for message in messages[1:]]
+        self.assertTrue(max(others) <= 6.0)
+        # Most aftershocks come early
+        times = np.array([message[0] for message in messages[1:]]) - 10
+        self.assertGreater(np.mean(times < 10), 0.5)
+
+    def testC_Omori(self):
+        """Tests the Omori times against the expected distribution"""
+        rng = np.random.default_rng(3)
+        for p in (1.0, 1.2):
+            times = omori_times(rng, 20000, 100, c=1.0, p=p)
+            self.assertTrue(np.all((times >= 0) & (times <= 100)))
+            if p == 1.0:
+                expected = np.log(11) / np.log(101)
+            else:
+                q = 1 - p
+                expected = (1 - 11**q) / (1 - 101**q)
+            self.assertAlmostEqual(np.mean(times < 10), expected, delta=0.02)
+
+
+class TestOrder(unittest.TestCase):
+    """Checks that a cancel isn't overtaken by its event's origin"""
+    def setUp(self):
+        self.install_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.install_path, 'data'))
+        patcher = mock.patch('shakemap_aqms.alarms.get_aqms_config',
+                             return_value=CONFIG)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.install_path)
+
+    def run_order(self, workers):
+        # Each event is cancelled while it is still being looked up
+        events = {}
+        messages = []
+        for ix in range(4):
+            eventid = str(1000 + ix)
+            events[eventid] = {'id': eventid, 'netid': 'lt', 'mag': 4.0,
+                               'lat': 34.0, 'lon': -118.0,
+                               'time': datetime(2020, 1, 1)}
+            messages += [(0.05 * ix, 'shake_alarm', eventid),
+                         (0.05 * ix + 0.01, 'shake_cancel', eventid)]
+        messages.append((0.3, 'shake_alarm', '2000'))
+        events['2000'] = dict(events['1000'], id='2000')
+        records, stats = run_loadtest(
+            messages, events, self.install_path, QUEUE_CONF,
+            logging.getLogger('loadtest_unittest'), lookup_delay=0.2,
+            drain=1, workers=workers)
+        summary = summarize(records, stats)
+        self.assertEqual(summary['out_of_order'], 0)
+        delivered = set((record['action'], record['eventid'])
+                        for record in records
+                        if record['delivered'] is not None)
+        self.assertIn(('shake_alarm', '2000'), delivered)
+        for ix in range(4):
+            self.assertIn(('shake_cancel', str(1000 + ix)), delivered)
+        return delivered, summary
+
+    def testA_Scheduler(self):
+        """Tests the order through the scheduler"""
+        delivered, summary = self.run_order(0)
+        # The origins still being looked up are dropped
+        self.assertEqual(summary['superseded'], 4)
+        for ix in range(4):
+            self.assertNotIn(('shake_alarm', str(1000 + ix)), delivered)
+
+    def testB_WorkQueue(self):
+        """Tests the order through the work queue"""
+        # An origin already leased when its cancel arrives is sent, but
+        # before the cancel
+        self.run_order(2)
+
+    def testC_Summary(self):
+        """Tests that an origin sent after its cancel is counted"""
+        records = [{'action': 'shake_alarm', 'eventid': '1',
+                    'scheduled': 0, 'sent': 0, 'status': 'ok',
+                    'delivered': 1.0, 'last_delivered': 3.0},
+                   {'action': 'shake_cancel', 'eventid': '1',
+                    'scheduled': 0.5, 'sent': 0.5, 'status': 'ok',
+                    'delivered': 2.0, 'last_delivered': 2.0}]
+        summary = summarize(records, {'pending': 0})
+        self.assertEqual(summary['out_of_order'], 1)
+        self.assertIsNone(summary['max_depth'])
+
+
+if __name__ == '__main__':
+    unittest.main()
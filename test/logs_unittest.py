@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""logs_unittest runs unit tests on the queued logging setup"""
+
+import logging
+import time
+import unittest
+
+from shakemap_aqms.logs import AsyncLogging, KeyValueFormatter, kv
+
+
+class SlowHandler(logging.Handler):
+    """A handler that simulates a slow disk"""
+    def __init__(self, delay):
+        super(SlowHandler, self).__init__()
+        self.delay = delay
+        self.lines = []
+
+    def emit(self, record):
+        time.sleep(self.delay)
+        self.lines.append(self.format(record))
+
+
+class TestLogs(unittest.TestCase):
+    """Checks the formatting and the queueing of log records"""
+    def setUp(self):
+        self.async_logging = AsyncLogging()
+
+    def tearDown(self):
+        self.async_logging.stop()
+
+    def testA_Format(self):
+        """Tests that key-value fields are appended to the message"""
+        record = logging.LogRecord('test', logging.INFO, __file__, 1,
+                                   'Sent event %s', ('ci1234',), None)
+        record.kv = kv(event='ci1234', action='shake_alarm')['kv']
+        text = KeyValueFormatter().format(record)
+        self.assertTrue(text.endswith(
+            'INFO - Sent event ci1234 action=shake_alarm event=ci1234'))
+
+    def testB_NonBlocking(self):
+        """Tests that a slow handler does not delay the caller"""
+        handler = SlowHandler(0.05)
+        logger = self.async_logging.add_handler('logs_test_slow', handler)
+        t1 = time.time()
+        for ix in range(10):
+            logger.info('Line %d', ix, extra=kv(ix=ix))
+        self.assertLess(time.time() - t1, 0.25)
+        self.async_logging.stop()
+        self.assertEqual(len(handler.lines), 10)
+        self.assertTrue(handler.lines[-1].endswith('Line 9 ix=9'))
+
+    def testC_Levels(self):
+        """Tests the per-logger levels"""
+        handler = SlowHandler(0)
+        logger = self.async_logging.add_handler('logs_test_levels', handler)
+        self.async_logging.set_levels('WARNING',
+                                      {'logs_test_other': 'DEBUG'})
+        logger.info('Dropped')
+        logger.warning('Kept')
+        self.assertEqual(logging.getLogger('logs_test_other').level,
+                         logging.DEBUG)
+        self.async_logging.stop()
+        self.assertEqual(len(handler.lines), 1)
+        self.assertTrue(handler.lines[0].endswith('Kept'))
+
+
+if __name__ == '__main__':
+    unittest.main()
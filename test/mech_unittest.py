@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+"""mech_unittest runs unit tests on the classification of focal
+mechanisms"""
+
+import itertools
+import unittest
+
+import numpy as np
+
+from shakemap_aqms.mech import classify_mech, classify_mechs
+
+
+class TestMech(unittest.TestCase):
+    """Checks the vectorized classification against the scalar one"""
+    def testA_Known(self):
+        """Tests some textbook mechanisms"""
+        self.assertEqual(classify_mech(-90, -90), 'NM')
+        self.assertEqual(classify_mech(90, 80), 'RS')
+        self.assertEqual(classify_mech(0, 180), 'SS')
+        self.assertEqual(classify_mech(170, -10), 'SS')
+        self.assertEqual(classify_mech(30, 30), 'ALL')
+        self.assertEqual(classify_mech(None, 90), 'ALL')
+
+    def testB_Grid(self):
+        """Tests every pair of rakes on a grid, with the boundaries and
+        angles that need wrapping"""
+        rakes = list(range(-400, 401, 5)) + [-135, -45, 45, 135, 225, -225,
+                                             180.5, -180.5, 359.9]
+        pairs = list(itertools.product(rakes, rakes))
+        rake1 = [pair[0] for pair in pairs]
+        rake2 = [pair[1] for pair in pairs]
+        expected = [classify_mech(r1, r2) for r1, r2 in pairs]
+        self.assertEqual(list(classify_mechs(rake1, rake2)), expected)
+
+    def testC_Random(self):
+        """Tests random rakes, some of them missing"""
+        rng = np.random.default_rng(4)
+        rake1 = rng.uniform(-360, 360, 5000)
+        rake2 = rng.uniform(-360, 360, 5000)
+        rake1[rng.random(5000) < 0.1] = np.nan
+        rake2[rng.random(5000) < 0.1] = np.nan
+        expected = [classify_mech(None if np.isnan(r1) else r1,
+                                  None if np.isnan(r2) else r2)
+                    for r1, r2 in zip(rake1, rake2)]
+        self.assertEqual(list(classify_mechs(rake1, rake2)), expected)
+        self.assertEqual(len(classify_mechs([], [])), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
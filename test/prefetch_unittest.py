@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""prefetch_unittest runs unit tests on the per-event cache of the
+station metadata and amps fetched by aqms_queue"""
+
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+import pandas as pd
+
+from shakemap_aqms.prefetch import (get_prefetch_dir, write_prefetch,
+                                    read_prefetch, prune_prefetch,
+                                    discard_prefetch)
+
+STADICT = {'CI.ABC': {'--': {'HNE': {'lat': 34.0, 'lon': -118.0,
+                                     'staname': 'ABC'}}}}
+
+
+class TestPrefetch(unittest.TestCase):
+    """Checks writing, reading, and removing the prefetched data"""
+    def setUp(self):
+        self.logger = logging.getLogger('prefetch_unittest')
+        self.install_path = tempfile.mkdtemp()
+        self.ampsets = [('dba', pd.DataFrame({'station': ['CI.ABC'],
+                                              'value': [1.5]}))]
+
+    def tearDown(self):
+        shutil.rmtree(self.install_path)
+
+    def testA_RoundTrip(self):
+        """Tests that the data reads back, and replaces older data"""
+        write_prefetch(self.install_path, 'ci1234', {}, [])
+        write_prefetch(self.install_path, 'ci1234', STADICT, self.ampsets)
+        stadict, ampsets = read_prefetch(self.install_path, 'ci1234', 60,
+                                         self.logger)
+        self.assertEqual(stadict, STADICT)
+        self.assertEqual(ampsets[0][0], 'dba')
+        pd.testing.assert_frame_equal(ampsets[0][1], self.ampsets[0][1])
+        self.assertEqual(os.listdir(get_prefetch_dir(self.install_path)),
+                         ['ci1234'])
+
+    def testB_Stale(self):
+        """Tests that old or missing data isn't used"""
+        self.assertIsNone(read_prefetch(self.install_path, 'ci1234', 60,
+                                        self.logger))
+        write_prefetch(self.install_path, 'ci1234', STADICT, self.ampsets)
+        time.sleep(0.1)
+        self.assertIsNone(read_prefetch(self.install_path, 'ci1234', 0.05,
+                                        self.logger))
+
+    def testC_Discard(self):
+        """Tests that an event's data can be thrown away"""
+        write_prefetch(self.install_path, 'ci1234', STADICT, self.ampsets)
+        self.assertTrue(discard_prefetch(self.install_path, 'ci1234'))
+        self.assertFalse(discard_prefetch(self.install_path, 'ci1234'))
+        self.assertIsNone(read_prefetch(self.install_path, 'ci1234', 60,
+                                        self.logger))
+
+    def testD_Prune(self):
+        """Tests that old event directories are removed"""
+        write_prefetch(self.install_path, 'ci1234', STADICT, self.ampsets)
+        write_prefetch(self.install_path, 'ci5678', STADICT, self.ampsets)
+        old = time.time() - 2 * 86400
+        os.utime(get_prefetch_dir(self.install_path, 'ci1234'), (old, old))
+        self.assertEqual(prune_prefetch(self.install_path), 1)
+        self.assertEqual(os.listdir(get_prefetch_dir(self.install_path)),
+                         ['ci5678'])
+
+
+if __name__ == '__main__':
+    unittest.main()
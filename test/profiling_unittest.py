@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""profiling_unittest runs unit tests on the profiling of the coremods"""
+
+import json
+import logging
+import os
+import os.path
+import pstats
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from shakemap_aqms.profiling import PROFILE_ENV, profiled, profiling_enabled
+
+
+class FakeModule(object):
+    """Stands in for a coremod"""
+    command_name = 'fake_module'
+
+    def __init__(self, eventid):
+        self._eventid = eventid
+        self.logger = logging.getLogger('profiling_unittest')
+
+    @profiled
+    def execute(self, value, fail=False):
+        if fail:
+            raise ValueError('failed')
+        return sum(range(value))
+
+
+class TestProfilingEnabled(unittest.TestCase):
+    """Checks the choice of whether to profile"""
+    def enabled(self, env, profile):
+        environ = dict(os.environ)
+        environ.pop(PROFILE_ENV, None)
+        if env is not None:
+            environ[PROFILE_ENV] = env
+        with mock.patch.dict(os.environ, environ, clear=True), \
+                mock.patch('shakemap_aqms.profiling.get_aqms_config',
+                           return_value={'profile': profile}):
+            return profiling_enabled()
+
+    def testA_Config(self):
+        """Tests that aqms.conf decides when the variable isn't set"""
+        self.assertTrue(self.enabled(None, True))
+        self.assertFalse(self.enabled(None, False))
+        with mock.patch.dict(os.environ, {}, clear=True), \
+                mock.patch('shakemap_aqms.profiling.get_aqms_config',
+                           side_effect=OSError('no aqms.conf')):
+            self.assertFalse(profiling_enabled())
+
+    def testB_Environment(self):
+        """Tests that the environment variable overrides aqms.conf"""
+        for value in ('1', 'true', 'Yes', ' on '):
+            self.assertTrue(self.enabled(value, False), value)
+        for value in ('0', 'false', 'no', ''):
+            self.assertFalse(self.enabled(value, True), value)
+
+
+class TestProfiled(unittest.TestCase):
+    """Checks the files written for a profiled coremod"""
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.tempdir, 'data')
+        self.datadir = os.path.join(self.data_path, 'ci1234', 'current')
+        os.makedirs(self.datadir)
+        patcher = mock.patch('shakemap.utils.config.get_config_paths',
+                             return_value=(self.tempdir, self.data_path))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def run_module(self, enabled, eventid='ci1234', **kwargs):
+        with mock.patch('shakemap_aqms.profiling.profiling_enabled',
+                        return_value=enabled):
+            return FakeModule(eventid).execute(1000, **kwargs)
+
+    def testA_Disabled(self):
+        """Tests that nothing is written when profiling is off"""
+        self.assertEqual(self.run_module(False), 499500)
+        self.assertEqual(os.listdir(self.datadir), [])
+
+    def testB_Enabled(self):
+        """Tests the profile and the summary"""
+        self.assertEqual(self.run_module(True), 499500)
+        self.assertEqual(sorted(os.listdir(self.datadir)),
+                         ['fake_module.prof', 'fake_module_profile.json'])
+        stats = pstats.Stats(os.path.join(self.datadir, 'fake_module.prof'))
+        self.assertIn('execute', [func[2] for func in stats.stats])
+        with open(os.path.join(self.datadir,
+                               'fake_module_profile.json')) as f:
+            summary = json.load(f)
+        self.assertEqual((summary['command'], summary['eventid']),
+                         ('fake_module', 'ci1234'))
+        self.assertGreaterEqual(summary['wall_time'], 0)
+        self.assertGreaterEqual(summary['cpu_time'], 0)
+        self.assertGreater(summary['peak_memory'], 0)
+
+    def testC_Failed(self):
+        """Tests that a failed run is still profiled, and that nothing is
+        written if the event has no directory"""
+        with self.assertRaises(ValueError):
+            self.run_module(True, fail=True)
+        self.assertIn('fake_module.prof', os.listdir(self.datadir))
+        self.assertEqual(self.run_module(True, eventid='ci5678'), 499500)
+        self.assertFalse(os.path.exists(os.path.join(self.data_path,
+                                                     'ci5678')))
+
+    def testD_WriteFailed(self):
+        """Tests that a profile that can't be written doesn't fail the
+        run, or hide its error"""
+        with mock.patch('cProfile.Profile.dump_stats',
+                        side_effect=OSError('No space left on device')):
+            self.assertEqual(self.run_module(True), 499500)
+            with self.assertRaises(ValueError):
+                self.run_module(True, fail=True)
+        self.assertEqual(os.listdir(self.datadir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
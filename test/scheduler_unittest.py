@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""scheduler_unittest runs unit tests on the aqms_queue scheduler"""
+
+import threading
+import time
+import unittest
+
+from shakemap_aqms.scheduler import AlarmScheduler, WorkItem
+
+
+def origin(eventid, mag):
+    return WorkItem('origin', eventid, event={'id': eventid, 'mag': mag})
+
+
+class TestScheduler(unittest.TestCase):
+    """Checks the priorities and the load shedding"""
+    def drain(self, scheduler):
+        items = []
+        while True:
+            item = scheduler.get(timeout=0)
+            if item is None:
+                return items
+            items.append(item.eventid)
+
+    def testA_Priority(self):
+        """Tests that cancels come first and then the biggest events"""
+        scheduler = AlarmScheduler()
+        scheduler.put(origin('small', 2.1))
+        scheduler.put(origin('big', 6.4))
+        scheduler.put(WorkItem('cancel', 'cancelled'))
+        scheduler.put(origin('medium', 4.0))
+        scheduler.put(origin('medium2', 4.0))
+        self.assertEqual(self.drain(scheduler),
+                         ['cancelled', 'big', 'medium', 'medium2', 'small'])
+
+    def testB_Shed(self):
+        """Tests that small events are dropped when backed up"""
+        scheduler = AlarmScheduler(shed_depth=2, shed_magnitude=3.0,
+                                   policy='shed')
+        self.assertTrue(scheduler.put(origin('a', 2.0)))
+        self.assertTrue(scheduler.put(origin('b', 2.0)))
+        self.assertFalse(scheduler.put(origin('c', 2.0)))
+        self.assertTrue(scheduler.put(origin('d', 5.0)))
+        self.assertTrue(scheduler.put(WorkItem('cancel', 'e')))
+        self.assertEqual(scheduler.stats()['shed'], 1)
+        self.assertEqual(self.drain(scheduler), ['e', 'd', 'a', 'b'])
+
+    def testC_Defer(self):
+        """Tests that small events are deferred when backed up"""
+        scheduler = AlarmScheduler(shed_depth=2, shed_magnitude=3.0,
+                                   policy='defer')
+        scheduler.put(origin('a', 2.0))
+        scheduler.put(origin('b', 2.0))
+        scheduler.put(origin('c', 2.9))
+        scheduler.put(origin('d', 2.5))
+        self.assertEqual(scheduler.stats()['deferred'], 2)
+        # Deferred events come after everything else, even smaller ones
+        self.assertEqual(self.drain(scheduler), ['a', 'b', 'c', 'd'])
+
+    def testD_Full(self):
+        """Tests that a full queue drops the lowest priority origin"""
+        scheduler = AlarmScheduler(maxsize=2)
+        scheduler.put(origin('a', 3.0))
+        scheduler.put(origin('b', 4.0))
+        self.assertTrue(scheduler.put(origin('c', 5.0)))
+        self.assertFalse(scheduler.put(origin('d', 2.0)))
+        self.assertTrue(scheduler.put(WorkItem('cancel', 'e')))
+        self.assertEqual(scheduler.stats()['shed'], 2)
+        self.assertEqual(self.drain(scheduler), ['e', 'c', 'b'])
+
+    def testE_Wait(self):
+        """Tests the blocking get and the wait statistics"""
+        scheduler = AlarmScheduler()
+        timer = threading.Timer(0.1, scheduler.put, [origin('a', 3.0)])
+        timer.start()
+        item = scheduler.get(timeout=5)
+        self.assertEqual(item.eventid, 'a')
+        self.assertGreaterEqual(item.wait, 0)
+        self.assertIsNone(scheduler.get(timeout=0.01))
+        stats = scheduler.stats()
+        self.assertEqual(stats['processed'], 1)
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['max_depth'], 1)
+
+    def testF_Cancel(self):
+        """Tests that a cancel supersedes the origins of its event"""
+        scheduler = AlarmScheduler()
+        scheduler.put(origin('ci1', 4.0))
+        scheduler.put(origin('ci2', 3.0))
+        scheduler.put(WorkItem('cancel', 'ci1'))
+        self.assertEqual(self.drain(scheduler), ['ci1', 'ci2'])
+        self.assertEqual(scheduler.stats()['superseded'], 1)
+        # An origin alarmed before the cancel, whose lookup finished
+        # after it, is dropped...
+        late = origin('ci3', 5.0)
+        scheduler.put(WorkItem('cancel', 'ci3'))
+        self.assertFalse(scheduler.put(late))
+        self.assertTrue(scheduler.cancelled('ci3', late.alarmed))
+        # ...but a new alarm of a cancelled event is not
+        scheduler.put(WorkItem('cancel', 'ci4'))
+        again = origin('ci4', 5.0)
+        again.alarmed += 1
+        self.assertTrue(scheduler.put(again))
+        self.assertFalse(scheduler.cancelled('ci4', again.alarmed))
+        self.assertEqual(self.drain(scheduler), ['ci3', 'ci4', 'ci4'])
+        self.assertEqual(scheduler.stats()['superseded'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
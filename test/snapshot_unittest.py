@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""snapshot_unittest runs unit tests on the shared station metadata
+snapshot"""
+
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import numpy as np
+
+from shakemap_aqms import snapshot as snapshot_module
+from shakemap_aqms.epochs import INDEX_PREFIX
+from shakemap_aqms.snapshot import (KEEP_VERSIONS, StationSnapshot,
+                                    load_snapshot, write_snapshot,
+                                    get_snapshot_dir)
+from shakemap_aqms.stations import ChannelEpochs
+
+# Rows of EPOCH_QUERY: (desc, net, sta, chan, loc, lat, lon, elev,
+# staname, ondate, offdate)
+ROWS = [
+    ('Caltech', 'CI', 'ABC', 'HNE', '  ', 34.0, -118.0, 100.0,
+     'Abc Station', datetime(2000, 1, 1), datetime(2010, 1, 1)),
+    ('Caltech', 'CI', 'ABC', 'HNE', '  ', 34.1, -118.1, 110.0,
+     'Abc Station - Pasadena', datetime(2010, 1, 1),
+     datetime(3000, 1, 1)),
+    ('Caltech', 'CI', 'DEF', 'HNZ', '01', 35.0, -117.0, 200.0,
+     'Def Station', datetime(2005, 1, 1), datetime(2015, 1, 1)),
+]
+
+# Rows of read_adhoc(): (sta, net, chan, loc, t6, lat, lon, elev, name)
+ADHOC = [
+    ('ABC', 'CI', 'HNE', '--', 1.5, 34.0, -118.0, 100.0, 'Abc Station'),
+    ('DEF', 'CI', 'HNZ', '01', 2.5, 35.5, -117.5, 250.0,
+     'Def Adhoc - Mojave'),
+]
+
+STAMAPPING = {'CI': {'ABC': 'Los Angeles', 'DEF': 'Abc'}}
+
+
+def get_epochs():
+    return ChannelEpochs(ROWS, STAMAPPING, ADHOC, lambda net: 'Net ' + net,
+                         logging.getLogger('snapshot_unittest'))
+
+
+class TestSnapshot(unittest.TestCase):
+    """Checks that the snapshot gives the same stations as the epochs
+    it was written from"""
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.snapshot_dir = os.path.join(self.tempdir, 'snapshot')
+        self.logger = logging.getLogger('snapshot_unittest')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testA_RoundTrip(self):
+        """Tests that the snapshot gives the same station dictionaries
+        as the channel epochs"""
+        epochs = get_epochs()
+        path = write_snapshot(epochs, self.snapshot_dir)
+        snapshot = StationSnapshot(self.snapshot_dir)
+        self.assertEqual(snapshot.path, os.path.realpath(path))
+        self.assertEqual(snapshot.manifest['nrows'], 5)
+        self.assertLess(snapshot.age, 60)
+        self.assertIsInstance(snapshot.columns['lat'], np.memmap)
+        times = [datetime(1999, 1, 1), datetime(2001, 6, 1),
+                 datetime(2010, 1, 1), datetime(2012, 1, 1),
+                 datetime(2020, 1, 1)]
+        for evtime in times:
+            self.assertEqual(snapshot.stations_at(evtime),
+                             epochs.stations_at(evtime))
+        self.assertEqual(snapshot.stations_at_times(times),
+                         epochs.stations_at_times(times))
+        # The index is rebuilt for snapshots written without one
+        for name in os.listdir(snapshot.path):
+            if name.startswith(INDEX_PREFIX):
+                os.remove(os.path.join(snapshot.path, name))
+        snapshot = StationSnapshot(self.snapshot_dir)
+        for evtime in times:
+            self.assertEqual(snapshot.stations_at(evtime),
+                             epochs.stations_at(evtime))
+
+    def testB_Swap(self):
+        """Tests that a new snapshot replaces the current one, and that
+        an open snapshot keeps working"""
+        write_snapshot(get_epochs(), self.snapshot_dir)
+        old = StationSnapshot(self.snapshot_dir)
+        evtime = datetime(2012, 1, 1)
+        expected = old.stations_at(evtime)
+        epochs = ChannelEpochs(ROWS[:1], {}, None, None, self.logger)
+        new_path = write_snapshot(epochs, self.snapshot_dir)
+        new = StationSnapshot(self.snapshot_dir)
+        self.assertEqual(new.path, os.path.realpath(new_path))
+        self.assertNotEqual(new.path, old.path)
+        self.assertEqual(new.stations_at(evtime), {})
+        self.assertEqual(old.stations_at(evtime), expected)
+        # No temporary files are left behind
+        self.assertEqual([name for name in os.listdir(self.snapshot_dir)
+                          if name.startswith('.')], [])
+
+    def testC_Prune(self):
+        """Tests that old versions are removed"""
+        epochs = get_epochs()
+        paths = []
+        for _ in range(KEEP_VERSIONS + 2):
+            paths.append(write_snapshot(epochs, self.snapshot_dir))
+            # The versions are named by the time in milliseconds
+            time.sleep(0.002)
+        versions = sorted(name for name in os.listdir(self.snapshot_dir)
+                          if name.isdigit())
+        self.assertEqual(versions, [os.path.basename(path) for path in
+                                    paths[-KEEP_VERSIONS:]])
+        self.assertEqual(StationSnapshot(self.snapshot_dir).path,
+                         os.path.realpath(paths[-1]))
+
+    def testD_Load(self):
+        """Tests that a missing or old snapshot isn't used"""
+        install_path = self.tempdir
+        self.assertIsNone(load_snapshot(install_path, 24, self.logger))
+        write_snapshot(get_epochs(), get_snapshot_dir(install_path))
+        self.assertIsNotNone(load_snapshot(install_path, 24, self.logger))
+        snapshot = StationSnapshot(get_snapshot_dir(install_path))
+        snapshot.manifest['created'] -= 2 * 3600
+        with mock.patch.object(snapshot_module, 'StationSnapshot',
+                               return_value=snapshot):
+            self.assertIsNone(load_snapshot(install_path, 1, self.logger))
+            self.assertIs(load_snapshot(install_path, 3, self.logger),
+                          snapshot)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""stations_unittest runs unit tests on the station metadata, the adhoc
+file and the stamapping"""
+
+import logging
+import os.path
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import cx_Oracle
+
+from shakemap_aqms.db import Connector, DBHealth
+from shakemap_aqms.stations import (EPOCH_QUERY, STATION_QUERY,
+                                    ChannelEpochs, get_channel_epochs,
+                                    get_station_dict, read_adhoc)
+
+CONFIG = {'dbs': {'dba': {}, 'dbb': {}},
+          'db_failure_threshold': 2, 'db_retry_interval': 60,
+          'db_order': 'lexicographic', 'connect_timeout': 0,
+          'call_timeout': 0, 'adhoc_file': ''}
+
+# Rows of EPOCH_QUERY: (desc, net, sta, chan, loc, lat, lon, elev,
+# staname, ondate, offdate)
+EPOCHS = [
+    ('Caltech', 'CI', 'ABC', 'HNE', '  ', 34.0, -118.0, 100.0,
+     'Abc Station', datetime(2000, 1, 1), datetime(2010, 1, 1)),
+    ('Caltech', 'CI', 'ABC', 'HNE', '  ', 34.1, -118.1, 110.0,
+     'Abc Station - Pasadena', datetime(2010, 1, 1),
+     datetime(3000, 1, 1)),
+    ('Caltech', 'CI', 'DEF', 'HNZ', '01', 35.0, -117.0, 200.0,
+     'Def Station', datetime(2005, 1, 1), datetime(2015, 1, 1)),
+    ('Caltech', 'CI', 'GHI', 'HNN', '  ', 36.0, -116.0, 300.0,
+     None, datetime(2000, 1, 1), datetime(3000, 1, 1)),
+]
+
+# The stamapping table: (sta, net, locdescr)
+STAMAPPING = [('ABC', 'CI', 'Los Angeles'), ('DEF', 'CI', 'Def')]
+
+# The adhoc file; the columns are fixed-width
+ADHOC_LINES = [
+    ('ABC', 'CI', 'HNE', '--', 1, 34.0, -118.0, 100.0, 'Abc Station'),
+    ('XYZ', 'NP', 'HNZ', '--', 2, 37.0, -122.0, 50.0,
+     'Xyz Adhoc - Oakland'),
+]
+
+
+def write_adhoc(path):
+    with open(path, 'w') as f:
+        for sta, net, chan, loc, t6, lat, lon, elev, name in ADHOC_LINES:
+            f.write('%-6s%-3s%-4s%-3s%4d%10.4f%11.4f%6.0f%s\n' %
+                    (sta, net, chan, loc, t6, lat, lon, elev, name))
+
+
+def active(evtime):
+    """The rows of STATION_QUERY at a time"""
+    return [row[:9] for row in EPOCHS if row[9] <= evtime <= row[10]]
+
+
+class FakeCursor(object):
+    """Answers the station queries from the tables above"""
+    def __init__(self, stamapping=True):
+        self.stamapping = stamapping
+        self.rows = []
+        self.queries = []
+
+    def execute(self, sql, params=None):
+        self.queries.append(sql)
+        if sql == STATION_QUERY:
+            evtime = datetime.strptime(params['evtime'], '%Y/%m/%d %H%M%S')
+            self.rows = active(evtime)
+        elif sql == EPOCH_QUERY:
+            self.rows = list(EPOCHS)
+        elif 'stamapping' in sql:
+            if not self.stamapping:
+                raise cx_Oracle.DatabaseError('ORA-00942')
+            self.rows = list(STAMAPPING)
+        elif 'd_abbreviation' in sql:
+            self.rows = [('Net ' + params['net'],)]
+        else:
+            raise AssertionError('Unexpected query: %s' % sql)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+    def close(self):
+        pass
+
+
+class FakeConnector(Connector):
+    """dba has no stations; dbb has the tables above"""
+    def __init__(self, config, stamapping=True):
+        super().__init__(config, logging.getLogger('stations_unittest'),
+                         DBHealth())
+        self.cursor = FakeCursor(stamapping)
+
+    def _open(self, dbname):
+        if dbname == 'dba':
+            return FakeConnection(EmptyCursor())
+        return FakeConnection(self.cursor)
+
+
+class EmptyCursor(FakeCursor):
+    def execute(self, sql, params=None):
+        self.rows = []
+
+
+class TestStations(unittest.TestCase):
+    """Checks the station dictionary of an event, with the adhoc file
+    and the stamapping applied"""
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.adhoc_file = os.path.join(self.tempdir, 'adhoc.lis')
+        write_adhoc(self.adhoc_file)
+        self.logger = logging.getLogger('stations_unittest')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testA_ReadAdhoc(self):
+        """Tests the reading of the adhoc file"""
+        rows = read_adhoc(self.adhoc_file)
+        self.assertEqual(len(rows), 2)
+        sta, net, chan, loc, t6, lat, lon, elev, name = rows[1]
+        self.assertEqual((sta, net, chan, loc), ('XYZ', 'NP', 'HNZ', '--'))
+        self.assertEqual(t6, 2)
+        self.assertAlmostEqual(lat, 37.0)
+        self.assertEqual(name, 'Xyz Adhoc - Oakland')
+
+    def testB_StationDict(self):
+        """Tests the stations of an event from the database, with no
+        adhoc file"""
+        connector = FakeConnector(CONFIG)
+        stadict = get_station_dict(connector, '2012/01/01 000000', CONFIG,
+                                   self.logger)
+        self.assertEqual(sorted(stadict), ['CI.ABC', 'CI.DEF'])
+        abc = stadict['CI.ABC']['--']['HNE']
+        self.assertEqual((abc['staname'], abc['staloc']),
+                         ('Abc Station', 'Pasadena'))
+        self.assertAlmostEqual(abc['lat'], 34.1)
+        self.assertNotIn('t6', abc)
+        # The stamapping fills in missing locations, unless they
+        # just repeat the station name
+        self.assertEqual(stadict['CI.DEF']['01']['HNZ']['staloc'], '')
+        stadict = get_station_dict(connector, '2001/01/01 000000', CONFIG,
+                                   self.logger)
+        self.assertEqual(stadict['CI.ABC']['--']['HNE']['staloc'],
+                         'Los Angeles')
+        # Without a stamapping table
+        stadict = get_station_dict(FakeConnector(CONFIG, stamapping=False),
+                                   '2001/01/01 000000', CONFIG, self.logger)
+        self.assertEqual(stadict['CI.ABC']['--']['HNE']['staloc'], '')
+
+    def testC_Adhoc(self):
+        """Tests that the adhoc file adds site codes and stations"""
+        config = dict(CONFIG, adhoc_file=self.adhoc_file)
+        stadict = get_station_dict(FakeConnector(config),
+                                   '2001/01/01 000000', config, self.logger)
+        self.assertEqual(sorted(stadict), ['CI.ABC', 'NP.XYZ'])
+        self.assertEqual(stadict['CI.ABC']['--']['HNE']['t6'], 1)
+        self.assertEqual(stadict['CI.ABC']['--']['HNE']['staloc'],
+                         'Los Angeles')
+        xyz = stadict['NP.XYZ']['--']['HNZ']
+        self.assertEqual((xyz['staname'], xyz['staloc'], xyz['netdesc'],
+                          xyz['t6']), ('Xyz Adhoc', 'Oakland', 'Net NP', 2))
+        # A missing adhoc file is ignored
+        config = dict(CONFIG, adhoc_file=self.adhoc_file + '.missing')
+        stadict = get_station_dict(FakeConnector(config),
+                                   '2001/01/01 000000', config, self.logger)
+        self.assertEqual(sorted(stadict), ['CI.ABC'])
+
+
+class TestChannelEpochs(unittest.TestCase):
+    """Checks that the channel epochs give the same stations as the
+    database query for each time"""
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.adhoc_file = os.path.join(self.tempdir, 'adhoc.lis')
+        write_adhoc(self.adhoc_file)
+        self.logger = logging.getLogger('stations_unittest')
+        self.times = [datetime(1999, 1, 1), datetime(2001, 1, 1),
+                      datetime(2010, 1, 1), datetime(2012, 6, 1),
+                      datetime(2020, 1, 1)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testA_Epochs(self):
+        """Tests the epochs against get_station_dict()"""
+        for adhoc_file in ('', self.adhoc_file):
+            config = dict(CONFIG, adhoc_file=adhoc_file)
+            epochs = get_channel_epochs(FakeConnector(config), config,
+                                        self.logger)
+            # The station without a name is skipped
+            self.assertEqual(len(epochs.keys), 3)
+            for evtime in self.times:
+                expected = get_station_dict(
+                    FakeConnector(config), evtime.strftime('%Y/%m/%d %H%M%S'),
+                    config, self.logger) if active(evtime) else None
+                stadict = epochs.stations_at(evtime)
+                if expected is None:
+                    # The database has no stations at this time; only
+                    # the adhoc stations are left
+                    self.assertEqual(sorted(stadict), ['CI.ABC', 'NP.XYZ']
+                                     if adhoc_file else [])
+                    continue
+                self.assertEqual(stadict, expected)
+
+    def testB_Times(self):
+        """Tests that many times are looked up at once, and that times
+        with the same active epochs share a dictionary"""
+        config = dict(CONFIG, adhoc_file=self.adhoc_file)
+        epochs = get_channel_epochs(FakeConnector(config), config,
+                                    self.logger)
+        times = self.times + [datetime(2013, 1, 1)]
+        stadicts = epochs.stations_at_times(times)
+        self.assertEqual(stadicts, [epochs.stations_at(evtime)
+                                    for evtime in times])
+        self.assertIs(stadicts[3], stadicts[5])
+
+    def testC_Adhoc(self):
+        """Tests that adhoc stations fill in only channels without an
+        active epoch"""
+        adhoc = read_adhoc(self.adhoc_file)
+        epochs = ChannelEpochs(EPOCHS, {}, adhoc, lambda net: 'Net ' + net,
+                               self.logger)
+        stadict = epochs.stations_at(datetime(2012, 1, 1))
+        self.assertAlmostEqual(stadict['CI.ABC']['--']['HNE']['lat'], 34.1)
+        self.assertEqual(stadict['CI.ABC']['--']['HNE']['t6'], 1)
+        stadict = epochs.stations_at(datetime(1999, 1, 1))
+        self.assertAlmostEqual(stadict['CI.ABC']['--']['HNE']['lat'], 34.0)
+        self.assertEqual(stadict['CI.ABC']['--']['HNE']['staloc'], '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""telemetry_unittest runs unit tests on the resource telemetry of the
+aqms_queue processes"""
+
+import logging
+import os
+import os.path
+import shutil
+import socket
+import tempfile
+import tracemalloc
+import unittest
+from unittest import mock
+
+from shakemap_aqms.eqinfo import HedgeStats
+from shakemap_aqms.telemetry import (MB, Telemetry, format_status,
+                                     open_files, read_status, rss_bytes)
+
+CONFIG = {'telemetry_interval': 60, 'telemetry_tracemalloc': 0,
+          'telemetry_top': 5, 'telemetry_rss_warning': 0,
+          'telemetry_growth_warning': 0, 'telemetry_fd_warning': 0,
+          'telemetry_alarm_warning': 0}
+
+
+class TestTelemetry(unittest.TestCase):
+    """Checks the samples, the warnings, and the status files"""
+    def setUp(self):
+        self.install_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.install_path, 'logs'))
+        self.telemetry = Telemetry(self.install_path, 'aqms_queue',
+                                   logging.getLogger('telemetry_unittest'))
+
+    def tearDown(self):
+        self.telemetry.configure(CONFIG)
+        shutil.rmtree(self.install_path)
+
+    def testA_Resources(self):
+        """Tests the memory and file counts"""
+        self.assertGreater(rss_bytes(), MB)
+        before = open_files()
+        if before['fds'] is None:
+            self.skipTest('/proc/self/fd is not available')
+        sock = socket.socket()
+        try:
+            after = open_files()
+            self.assertEqual(after['sockets'], before['sockets'] + 1)
+        finally:
+            sock.close()
+
+    def testB_Update(self):
+        """Tests that samples are taken at the interval and published"""
+        sample = self.telemetry.update(CONFIG, now=1000)
+        self.assertIsNotNone(sample)
+        self.assertIsNone(self.telemetry.update(CONFIG, now=1030))
+        self.assertIsNotNone(self.telemetry.update(CONFIG, now=1060))
+        samples = read_status(self.install_path)
+        self.assertEqual(len(samples), 1)
+        self.assertEqual(samples[0]['name'], 'aqms_queue')
+        self.assertEqual(samples[0]['time'], 1060)
+        self.assertIn('resident memory', format_status(samples[0], 1100))
+
+    def testC_Warnings(self):
+        """Tests the threshold warnings, including the memory growth"""
+        config = dict(CONFIG, telemetry_rss_warning=100,
+                      telemetry_growth_warning=10, telemetry_fd_warning=50)
+        for ix in range(6):
+            self.telemetry._rss.append((ix * 600, (100 + 5 * ix) * MB))
+        self.assertIsNone(self.telemetry.growth_rate())
+        self.telemetry._rss.append((3600, 130 * MB))
+        self.assertAlmostEqual(self.telemetry.growth_rate() / MB, 30)
+        sample = {'rss': 130 * MB, 'rss_growth': 30 * MB, 'fds': 20}
+        warnings = self.telemetry.check(sample, config)
+        self.assertEqual(len(warnings), 2)
+        self.assertTrue(warnings[0].startswith('resident memory is 130.0'))
+        self.assertIn('30.0 MB/hour', warnings[1])
+        sample = {'rss': 50 * MB, 'rss_growth': None, 'fds': 60}
+        self.assertEqual(self.telemetry.check(sample, config),
+                         ['60 open file descriptors (limit 50)'])
+
+    def testD_Allocations(self):
+        """Tests the per-alarm allocations and the top allocators"""
+        config = dict(CONFIG, telemetry_tracemalloc=1,
+                      telemetry_alarm_warning=0.5)
+        self.telemetry.configure(config)
+        self.assertTrue(tracemalloc.is_tracing())
+        self.telemetry.top_allocations(5)
+        kept = []
+        with self.telemetry.measure('ci1234'):
+            kept.append(bytearray(2 * MB))
+        sample = self.telemetry.sample(config)
+        self.assertEqual(sample['alarms'], 1)
+        self.assertGreater(sample['alarm_allocations']['max'], 2 * MB)
+        self.assertIn(os.path.basename(__file__),
+                      sample['top_allocations'][0]['where'])
+        self.assertEqual(len(self.telemetry.check(sample, config)), 1)
+        self.telemetry.configure(CONFIG)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def testE_Hedging(self):
+        """Tests the counts of the hedged event lookups"""
+        stats = HedgeStats()
+        stats.add_lookup('dbb', True)
+        stats.add_lookup('dba', False)
+        stats.add_error('dba')
+        with mock.patch('shakemap_aqms.eqinfo.hedge_stats', stats):
+            sample = self.telemetry.sample(CONFIG)
+        self.assertEqual(sample['hedging']['hedged'], 1)
+        self.assertEqual(sample['hedging']['errors'], {'dba': 1})
+        self.assertIn('event lookups: 2, 1 hedged; errors: dba 1',
+                      format_status(sample))
+
+
+if __name__ == '__main__':
+    unittest.main()
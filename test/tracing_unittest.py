@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""tracing_unittest runs unit tests on the per-event trace store"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from shakemap_aqms.tracing import TraceStore
+
+
+class TestTraceStore(unittest.TestCase):
+    """Checks recording and querying traces"""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = TraceStore(os.path.join(self.tmpdir, 'traces.db'),
+                                keep_days=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testA_Timeline(self):
+        """Tests the spans of a trace"""
+        trace_id = self.store.new_trace('ci1234')
+        with self.store.span(trace_id, 'lookup'):
+            pass
+        with self.assertRaises(ValueError):
+            with self.store.span(trace_id, 'send'):
+                raise ValueError('no sm_queue')
+        spans = self.store.timeline(trace_id)
+        self.assertEqual([span[0] for span in spans], ['lookup', 'send'])
+        self.assertEqual(spans[0][3], 'ok')
+        self.assertEqual(spans[1][3:], ('error', 'no sm_queue'))
+        self.assertLessEqual(spans[0][1], spans[0][2])
+
+    def testB_EventTrace(self):
+        """Tests that the coremods find the trace aqms_queue started"""
+        trace_id = self.store.new_trace('ci1234')
+        self.assertEqual(self.store.event_trace('ci1234'), trace_id)
+        other = self.store.event_trace('ci5678')
+        self.assertNotEqual(other, trace_id)
+        self.assertEqual(self.store.find_trace('ci5678'), other)
+
+    def testC_Slowest(self):
+        """Tests the slowest traces, and the removal of old ones"""
+        now = time.time()
+        old = self.store.new_trace('old', now - 2 * 86400)
+        self.store.record(old, 'lookup', now - 2 * 86400, now - 86400)
+        fast = self.store.new_trace('fast', now - 10)
+        self.store.record(fast, 'lookup', now - 10, now - 9)
+        slow = self.store.new_trace('slow', now - 100)
+        self.store.record(slow, 'lookup', now - 100, now - 99)
+        self.store.record(slow, 'db2xml_amps', now - 50, now - 1)
+        rows = self.store.slowest(now - 3 * 86400)
+        self.assertEqual([row[1] for row in rows], ['slow', 'fast'])
+        self.assertAlmostEqual(rows[0][3], 99, places=3)
+        self.assertEqual(self.store.traces('old'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
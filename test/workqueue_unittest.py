@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""workqueue_unittest runs unit tests on the work queue shared by the
+aqms_queue processes"""
+
+import multiprocessing
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+from shakemap_aqms.workqueue import WorkQueue
+
+
+def lease_all(path, owner, results):
+    work_queue = WorkQueue(path)
+    while True:
+        job = work_queue.lease(owner)
+        if job is None:
+            return
+        if work_queue.complete(job, owner):
+            results.put(job.id)
+
+
+class TestWorkQueue(unittest.TestCase):
+    """Checks the leasing of jobs"""
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'workqueue.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testA_Order(self):
+        """Tests that cancels are leased first and then in order"""
+        work_queue = WorkQueue(self.path)
+        work_queue.put('origin', 'a')
+        work_queue.put('origin', 'b')
+        work_queue.put('cancel', 'c')
+        leased = []
+        while True:
+            job = work_queue.lease('w')
+            if job is None:
+                break
+            leased.append(job.eventid)
+            self.assertTrue(work_queue.complete(job, 'w'))
+        self.assertEqual(leased, ['c', 'a', 'b'])
+        self.assertEqual(work_queue.counts(), {'done': 3})
+
+    def testB_Expiry(self):
+        """Tests that an expired lease goes to another worker"""
+        work_queue = WorkQueue(self.path, lease_time=0.1, max_attempts=2)
+        work_queue.put('origin', 'a')
+        job = work_queue.lease('w1')
+        self.assertIsNone(work_queue.lease('w2'))
+        time.sleep(0.2)
+        # The first worker can no longer send it...
+        self.assertFalse(work_queue.renew(job, 'w1'))
+        job2 = work_queue.lease('w2')
+        self.assertEqual(job2.id, job.id)
+        self.assertEqual(job2.attempts, 2)
+        self.assertTrue(work_queue.renew(job2, 'w2'))
+        # ...or mark it done
+        self.assertFalse(work_queue.complete(job, 'w1'))
+        time.sleep(0.2)
+        # It has been tried too many times
+        self.assertIsNone(work_queue.lease('w3'))
+        self.assertEqual(work_queue.counts(), {'failed': 1})
+
+    def testC_Concurrent(self):
+        """Tests that each job is done once by concurrent workers"""
+        work_queue = WorkQueue(self.path)
+        njobs = 200
+        for ix in range(njobs):
+            work_queue.put('origin', 'ev%d' % ix)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=lease_all,
+                                           args=(self.path, 'w%d' % ix,
+                                                 results))
+                   for ix in range(4)]
+        for worker in workers:
+            worker.start()
+        done = [results.get(timeout=60) for _ in range(njobs)]
+        for worker in workers:
+            worker.join()
+        self.assertEqual(sorted(done), list(range(1, njobs + 1)))
+        self.assertEqual(work_queue.counts(), {'done': njobs})
+
+    def testD_Prune(self):
+        """Tests that only old finished jobs are pruned"""
+        work_queue = WorkQueue(self.path)
+        work_queue.put('origin', 'a')
+        work_queue.put('origin', 'b')
+        work_queue.complete(work_queue.lease('w'), 'w')
+        self.assertEqual(work_queue.prune(days=1), 0)
+        self.assertEqual(work_queue.prune(days=0), 1)
+        self.assertEqual(work_queue.counts(), {'pending': 1})
+
+    def testE_Event(self):
+        """Tests that the jobs of an event are done one at a time, in
+        order, and that a cancel supersedes its event's origins"""
+        work_queue = WorkQueue(self.path)
+        work_queue.put('origin', 'ci1')
+        work_queue.put('cancel', 'ci1')
+        job = work_queue.lease('w1')
+        self.assertEqual((job.action, job.eventid), ('cancel', 'ci1'))
+        self.assertIsNone(work_queue.lease('w2'))
+        self.assertEqual(work_queue.counts(), {'done': 1, 'leased': 1})
+        work_queue.complete(job, 'w1')
+        # A new alarm after the cancel waits for the cancel to be done
+        work_queue.put('cancel', 'ci2')
+        work_queue.put('origin', 'ci2')
+        work_queue.put('origin', 'ci3')
+        job = work_queue.lease('w1')
+        self.assertEqual((job.action, job.eventid), ('cancel', 'ci2'))
+        job2 = work_queue.lease('w2')
+        self.assertEqual((job2.action, job2.eventid), ('origin', 'ci3'))
+        self.assertIsNone(work_queue.lease('w3'))
+        work_queue.complete(job, 'w1')
+        job = work_queue.lease('w3')
+        self.assertEqual((job.action, job.eventid), ('origin', 'ci2'))
+
+
+if __name__ == '__main__':
+    unittest.main()